@@ -38,8 +38,12 @@ dimensions.login()
 # publications, then look through each pub's author list and find the authors
 # that have Caltech affiliations.
 
+# Asking Sidewall to prefetch the authors' ORCID values lets it look them up
+# for all the authors in a page of results at once, instead of one at a time.
+
 print('Sending query to Dimensions')
-results = dimensions.query('search publications where research_orgs.id = "grid.20861.3d" return publications')
+results = dimensions.query('search publications where research_orgs.id = "grid.20861.3d" return publications',
+                           prefetch = ['authors.orcid'])
 
 print('Dimensions query found {} publications'.format(len(results)))
 print('Finding publication authors that have Caltech affiliations')
@@ -20,7 +20,13 @@ from .__version__  import __license__, __copyright__
 
 from .exceptions   import *
 from .debug        import set_debug
+from .network      import set_network_probe
+from .retry        import RetryPolicy, set_retry_policy
+from .timeouts     import AdaptiveTimeout, set_timeouts
 from .dimensions   import dimensions, queryresults
+from .cassette     import use_cassette
+from .cursor       import Cursor
+from .asyncdimensions import AsyncDimensions, asyncqueryresults
 
 from .author       import Author
 from .category     import Category
@@ -0,0 +1,247 @@
+'''
+asyncdimensions.py: asyncio interface to Dimensions for Sidewall
+
+The class AsyncDimensions in this module offers the main Sidewall operations
+(login, query, record searches and fill searches) as coroutines, so that
+Sidewall can be used from programs built around asyncio.  Query results are
+returned as an asyncqueryresults object, which is used with "async for":
+
+    from sidewall import AsyncDimensions
+
+    async def main():
+        dim = AsyncDimensions()
+        await dim.login()
+        results = await dim.query('search grants for "SBML" return grants')
+        async for grant in results:
+            print(grant.title)
+
+Implementation notes
+--------------------
+
+AsyncDimensions is a front end to the Dimensions object in dimensions.py,
+and uses the same authentication token, object cache and rate limits.  The
+network layer of Sidewall (network.py) is built on the requests package,
+which is blocking, so AsyncDimensions runs the network operations in an
+executor (by default, the event loop's default thread pool).  The event loop
+is never blocked by network I/O or by waiting on rate limits, and many
+queries can be in progress at the same time.
+
+Accessing a field on a Sidewall object may cause a search to be performed
+behind the scenes to fill in a missing value (see core.py).  That search is
+done synchronously.  To avoid blocking the event loop that way, use the
+'prefetch' argument to query() or call fill() on the objects first.
+
+Authors
+-------
+
+Michael Hucka <mhucka@caltech.edu> -- Caltech Library
+
+Copyright
+---------
+
+Copyright (c) 2019 by the California Institute of Technology.  This code is
+open-source software released under a 3-clause BSD license.  Please see the
+file "LICENSE" for more information.
+'''
+
+import asyncio
+from   collections import deque
+import functools
+from   time import perf_counter
+
+from .core import DimensionsCore
+from .debug import log
+from .dimensions import dimensions, queryresults, _FETCH_SIZE
+
+
+# Classes
+# .............................................................................
+
+class AsyncDimensions(object):
+    '''Asyncio interface to Dimensions.  If 'dimensions_obj' is not given, it
+    uses Sidewall's "dimensions" object.  If 'executor' is not given, network
+    operations are run in the event loop's default executor.'''
+
+    def __init__(self, dimensions_obj = None, executor = None):
+        self._dimensions = dimensions_obj or dimensions
+        self._executor = executor
+
+
+    async def login(self, username = None, password = None,
+                    use_keyring = True, reset_keyring = False, token_cache = None):
+        '''Coroutine version of Dimensions.login().'''
+        await self._run(self._dimensions.login, username, password,
+                        use_keyring, reset_keyring, token_cache)
+
+
+    async def query(self, query_string, limit_results = None,
+                    fetch_size = _FETCH_SIZE, prefetch = None, read_ahead = 0,
+                    deadline = None, raw = False):
+        '''Coroutine version of Dimensions.query().  Returns an
+        asyncqueryresults object, to be used with "async for".'''
+        dim = self._dimensions
+        auto_fetch = fetch_size == 'auto'
+        (query_string, result_type, expanded_query, first_query, fetch_size) \
+            = dim._prepared_query(query_string, limit_results, fetch_size)
+        dim._check_modes(read_ahead, False, prefetch, raw)
+        if deadline is not None:
+            deadline = perf_counter() + deadline
+        data = await self._run(dim._post, first_query, deadline)
+        total = dim._total_count(data, result_type, limit_results)
+        if total == 0:
+            return _emptyresults()
+        if read_ahead + 1 > dim._pool_size:
+            dim.set_pool_size(read_ahead + 1)
+        results = asyncqueryresults(self, query_string, expanded_query,
+                                    limit_results, total, data, result_type,
+                                    fetch_size, read_ahead, None, deadline,
+                                    auto_fetch = auto_fetch, raw = raw)
+        if prefetch:
+            results.prefetch(prefetch)
+        return results
+
+
+    async def record_search(self, query, id, deadline = None):
+        '''Coroutine version of Dimensions.record_search().'''
+        return await self._run(self._dimensions.record_search, query, id,
+                               deadline = deadline)
+
+
+    async def fill(self, objects):
+        '''Fill in missing field values on 'objects' (a single Sidewall object
+        or a list of them) using batched searches, without blocking the
+        event loop.'''
+        if isinstance(objects, DimensionsCore):
+            objects = [objects]
+        await self._run(self._dimensions._filler.fill_objects, list(objects))
+
+
+    async def _run(self, func, *args, **kwargs):
+        loop = asyncio.get_event_loop()
+        call = functools.partial(func, *args, **kwargs)
+        return await loop.run_in_executor(self._executor, call)
+
+
+class asyncqueryresults(queryresults):
+    '''Results of a Dimensions query executed by AsyncDimensions.  Instances
+    of this class behave like asynchronous iterators, and otherwise have the
+    same properties and methods as queryresults, including cursor() and
+    checkpoint().  If the query was started with a 'read_ahead' value, up to
+    that many pages are requested concurrently.
+    '''
+
+    def __init__(self, adim, *args, **kwargs):
+        super().__init__(adim._dimensions, *args, **kwargs)
+        self._adimensions = adim
+        self._queries = self._page_queries()
+        self._objects = None
+        self._fetches = deque()
+        self._pages_done = 0
+        self._page_open = False         # Whether a page is being used.
+        self._done = False
+
+
+    def __aiter__(self):
+        return self
+
+
+    async def __anext__(self):
+        # The bookkeeping of pages and checkpoints is the same as in
+        # queryresults._results_iterator().
+        if self._objects is None:
+            page = await self._checkpointed(self._prepared_page(self._initial_data))
+            self._objects = deque(page)
+            self._page_open = True
+        while not self._objects and self._returned < self.total_count:
+            # The caller has used the whole page.
+            self._end_page()
+            if self._checkpoint and self._pages_done % self._checkpoint[1] == 0:
+                self.cursor().save(self._checkpoint[0])
+            data = await self._checkpointed(self._next_page())
+            if data is None:
+                break
+            self._objects = deque(await self._checkpointed(self._prepared_page(data)))
+            self._page_open = True
+        if self._objects and self._returned < self.total_count:
+            self._returned += 1
+            return self._objects.popleft()
+        if not self._done:
+            self._done = True
+            self._end_page()
+            if self._checkpoint:
+                self.cursor().save(self._checkpoint[0])
+        raise StopAsyncIteration
+
+
+    async def aclose(self):
+        '''Stop iterating and cancel any pending page fetches.'''
+        if __debug__: log('cancelling {} pending page fetches', len(self._fetches))
+        while self._fetches:
+            self._fetches.popleft().cancel()
+        self._queries = iter([])
+        self._objects = deque()
+        self._done = True
+
+
+    async def __aenter__(self):
+        return self
+
+
+    async def __aexit__(self, *args):
+        await self.aclose()
+
+
+    def _end_page(self):
+        if self._page_open:
+            self._page_open = False
+            self._pages_done += 1
+            if self._page_bounds:
+                self._page_bounds.popleft()
+
+
+    async def _checkpointed(self, awaitable):
+        # Save the cursor if getting the next page fails.
+        try:
+            return await awaitable
+        except Exception:
+            if self._checkpoint:
+                self.cursor().save(self._checkpoint[0])
+            raise
+
+
+    async def _next_page(self):
+        # Keep up to _read_ahead page requests in flight, and at least one.
+        loop = asyncio.get_event_loop()
+        while len(self._fetches) < max(1, self._read_ahead):
+            query = next(self._queries, None)
+            if query is None:
+                break
+            call = functools.partial(self._fetched_page, query)
+            executor = self._adimensions._executor
+            self._fetches.append(loop.run_in_executor(executor, call))
+        if not self._fetches:
+            return None
+        return await self._fetches.popleft()
+
+
+    async def _prepared_page(self, data):
+        objects = self._page_objects(data)
+        if self._prefetch:
+            filler = self._dimensions._filler
+            await self._adimensions._run(filler.prefetch, objects, self._prefetch)
+        return objects
+
+
+class _emptyresults(object):
+    '''Asynchronous iterator over no results.'''
+
+    total_count = 0
+
+    def __len__(self):
+        return 0
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        raise StopAsyncIteration
@@ -0,0 +1,343 @@
+'''
+cache.py: caching support for Sidewall
+
+Sidewall keeps an in-memory cache of objects and query results (see the
+class Dimensions in dimensions.py).  The in-memory cache is an ObjectCache,
+which evicts the least-recently used entries when it grows beyond a maximum
+number of items or an (estimated) number of bytes.  It keeps objects that
+are only valid in the context of a single query (i.e., objects that are not
+Persistable, such as Author) in separate "scopes", one for each query, so
+that the objects of one query can be dropped when that query is done
+without affecting other queries running at the same time in other threads.
+
+This module also adds an optional persistent layer underneath the in-memory
+cache: the raw JSON results returned by Dimensions for record searches and
+result pages can be stored in an SQLite database file, so that a later run
+of a program can reuse them instead of spending more of the Dimensions API
+rate limit to fetch the same data again.
+
+Each entry is stored with the time it was written, and entries older than a
+time-to-live (TTL) value are ignored and discarded.  The TTL can be set
+separately for each kind of result (publications, researchers, etc.),
+because some kinds of records change more often than others.
+
+Authors
+-------
+
+Michael Hucka <mhucka@caltech.edu> -- Caltech Library
+
+Copyright
+---------
+
+Copyright (c) 2019 by the California Institute of Technology.  This code is
+open-source software released under a 3-clause BSD license.  Please see the
+file "LICENSE" for more information.
+'''
+
+from   collections import OrderedDict
+import json as jsonlib
+import re
+import sqlite3
+import sys
+import threading
+from   time import time
+
+from .core import DimensionsCore
+from .data_helpers import objattr
+from .debug import log
+
+
+# Constants
+# .............................................................................
+
+_DEFAULT_TTL = 7 * 24 * 60 * 60
+'''Default number of seconds that entries in the disk cache remain valid.'''
+
+
+# Classes
+# .............................................................................
+
+class ObjectCache(object):
+    '''In-memory cache with least-recently-used (LRU) eviction.
+
+    The cache is bounded by 'max_items' entries and by an estimate of the
+    memory used by the cached values ('max_bytes'); a value of None for
+    either of these means there is no limit of that kind.  Sidewall objects
+    that are not Persistable are stored using put() with a 'scope' value
+    identifying the query they belong to, and can be looked up only with the
+    same scope; clear_scoped() drops all the values of a scope.  All other
+    values (Persistable objects and plain data such as search results) are
+    kept in a persistent namespace shared by all scopes.  All methods are
+    safe to call from multiple threads.
+    '''
+
+    def __init__(self, max_items = None, max_bytes = None):
+        self.max_items  = max_items
+        self.max_bytes  = max_bytes
+        self._persistent = OrderedDict()    # key -> (value, size)
+        self._scoped     = OrderedDict()    # (scope, key) -> (value, size)
+        self._scope_keys = {}               # scope -> set of keys
+        self._bytes      = 0
+        self._scoped_bytes = 0
+        self.hits       = 0
+        self.misses     = 0
+        self.evictions  = 0
+        self._lock      = threading.RLock()
+
+
+    def get(self, key, default = None, scope = None):
+        '''Return the value stored under 'key', either in the persistent
+        namespace or in the given 'scope', or 'default' if there is no such
+        entry.  This counts as a use of the entry for LRU purposes.'''
+        with self._lock:
+            for (table, table_key) in ((self._persistent, key),
+                                       (self._scoped, (scope, key))):
+                if table_key in table:
+                    table.move_to_end(table_key)
+                    self.hits += 1
+                    return table[table_key][0]
+            self.misses += 1
+            return default
+
+
+    def __getitem__(self, key):
+        missing = object()
+        value = self.get(key, missing)
+        if value is missing:
+            raise KeyError(key)
+        return value
+
+
+    def __setitem__(self, key, value):
+        self.put(key, value)
+
+
+    def put(self, key, value, scope = None):
+        '''Store 'value' under 'key'.  If 'value' is a Sidewall object that is
+        not Persistable, it is stored in the given 'scope'.'''
+        size = _estimated_size(value) if self.max_bytes is not None else 0
+        with self._lock:
+            if (isinstance(value, DimensionsCore)
+                and not objattr(value, 'persistable', False)):
+                self._remove((scope, key))
+                self._scoped[(scope, key)] = (value, size)
+                self._scope_keys.setdefault(scope, set()).add(key)
+                self._scoped_bytes += size
+            else:
+                self._remove(key)
+                self._persistent[key] = (value, size)
+            self._bytes += size
+            self._evict()
+
+
+    def __delitem__(self, key):
+        with self._lock:
+            if not self._remove(key):
+                raise KeyError(key)
+
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._persistent
+
+
+    def __len__(self):
+        with self._lock:
+            return len(self._persistent) + len(self._scoped)
+
+
+    def clear_scoped(self, scope):
+        '''Drop all the values stored in 'scope'.'''
+        with self._lock:
+            keys = self._scope_keys.pop(scope, ())
+            if __debug__: log('dropping {} cache entries of scope {}', len(keys), scope)
+            for key in keys:
+                size = self._scoped.pop((scope, key))[1]
+                self._bytes -= size
+                self._scoped_bytes -= size
+
+
+    def set_limits(self, max_items = None, max_bytes = None):
+        '''Change the limits on the cache and evict entries as needed.'''
+        with self._lock:
+            if max_bytes is not None and self.max_bytes is None:
+                # Sizes aren't computed when there's no byte limit, so do it now.
+                self._bytes = self._scoped_bytes = 0
+                for table in (self._persistent, self._scoped):
+                    for key, (value, _) in table.items():
+                        size = _estimated_size(value)
+                        table[key] = (value, size)
+                        self._bytes += size
+                        if table is self._scoped:
+                            self._scoped_bytes += size
+            self.max_items = max_items
+            self.max_bytes = max_bytes
+            self._evict()
+
+
+    def clear(self):
+        with self._lock:
+            self._persistent = OrderedDict()
+            self._scoped = OrderedDict()
+            self._scope_keys = {}
+            self._bytes = 0
+            self._scoped_bytes = 0
+
+
+    def stats(self):
+        with self._lock:
+            return {'total_items'     : len(self),
+                    'persistent_items': len(self._persistent),
+                    'scoped_items'    : len(self._scoped),
+                    'scopes'          : len(self._scope_keys),
+                    'bytes'           : self._bytes,
+                    'hits'            : self.hits,
+                    'misses'          : self.misses,
+                    'evictions'       : self.evictions}
+
+
+    def _remove(self, key):
+        # 'key' is a (scope, key) tuple for values in a scope.
+        if key in self._persistent:
+            self._bytes -= self._persistent.pop(key)[1]
+            return True
+        if key in self._scoped:
+            size = self._scoped.pop(key)[1]
+            self._forget_scoped(key)
+            self._bytes -= size
+            self._scoped_bytes -= size
+            return True
+        return False
+
+
+    def _forget_scoped(self, scoped_key):
+        (scope, key) = scoped_key
+        keys = self._scope_keys.get(scope)
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._scope_keys[scope]
+
+
+    def _evict(self):
+        # Scoped values are evicted first, since they are the least likely to
+        # be needed again once the query that produced them is done.
+        while self._over_limit():
+            if self._scoped:
+                (scoped_key, (_, size)) = self._scoped.popitem(last = False)
+                self._forget_scoped(scoped_key)
+                self._scoped_bytes -= size
+            elif self._persistent:
+                size = self._persistent.popitem(last = False)[1][1]
+            else:
+                break
+            self._bytes -= size
+            self.evictions += 1
+
+
+    def _over_limit(self):
+        return ((self.max_items is not None and len(self) > self.max_items)
+                or (self.max_bytes is not None and self._bytes > self.max_bytes))
+
+
+class DiskCache(object):
+    '''Persistent store of Dimensions results, kept in an SQLite file.
+
+    Values are stored under a string key together with the kind of result
+    they represent (e.g., "publications").  The argument 'ttl' can be a
+    number of seconds applied to all kinds of results, or a dict mapping
+    result kinds to seconds; kinds not in the dict get the default TTL.  A
+    TTL value of None means entries of that kind never expire.
+    '''
+
+    def __init__(self, path, ttl = None):
+        self.path = path
+        self._ttl = {}
+        self._default_ttl = _DEFAULT_TTL
+        if isinstance(ttl, dict):
+            self._ttl.update(ttl)
+        elif ttl is not None:
+            self._default_ttl = ttl
+        # The connection may be used from background threads (e.g., by the
+        # page prefetcher), so we do our own locking instead of SQLite's.
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread = False)
+        with self._lock:
+            self._db.execute('CREATE TABLE IF NOT EXISTS results'
+                             ' (key TEXT PRIMARY KEY, kind TEXT,'
+                             '  created REAL, value TEXT)')
+            self._db.commit()
+
+
+    def get(self, key, kind = None):
+        '''Return the value stored under 'key', or None if there is no value
+        or the value has expired.'''
+        with self._lock:
+            row = self._db.execute('SELECT created, value FROM results'
+                                   ' WHERE key = ?', (key,)).fetchone()
+            if not row:
+                return None
+            created, value = row
+            if self._expired(created, kind):
+                if __debug__: log('disk cache entry expired for {}', key)
+                self._db.execute('DELETE FROM results WHERE key = ?', (key,))
+                self._db.commit()
+                return None
+        if __debug__: log('disk cache hit for {}', key)
+        return jsonlib.loads(value)
+
+
+    def put(self, key, value, kind = None):
+        '''Store 'value' (which must be serializable as JSON) under 'key'.'''
+        if __debug__: log('storing disk cache entry for {}', key)
+        with self._lock:
+            self._db.execute('INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?)',
+                             (key, kind, time(), jsonlib.dumps(value)))
+            self._db.commit()
+
+
+    def clear(self):
+        '''Remove all entries from the disk cache.'''
+        with self._lock:
+            self._db.execute('DELETE FROM results')
+            self._db.commit()
+
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+    def __len__(self):
+        with self._lock:
+            return self._db.execute('SELECT COUNT(*) FROM results').fetchone()[0]
+
+
+    def _expired(self, created, kind):
+        ttl = self._ttl.get(kind, self._default_ttl)
+        return ttl is not None and (time() - created) > ttl
+
+
+# Utility functions
+# .............................................................................
+
+def _estimated_size(value):
+    '''Return a rough estimate of the memory used by 'value'.  For Sidewall
+    objects, this is based on the Dimensions data the object was created from.'''
+    size = 0
+    pending = [objattr(value, '_orig_data', value)]
+    while pending:
+        item = pending.pop()
+        size += sys.getsizeof(item)
+        if isinstance(item, dict):
+            pending.extend(item.keys())
+            pending.extend(item.values())
+        elif isinstance(item, (list, tuple)):
+            pending.extend(item)
+    return size
+
+
+def result_kind(query):
+    '''Return the kind of result (e.g., "publications") produced by 'query'.'''
+    match = re.search(r'return\s+(\w+)', query)
+    return match.group(1) if match else None
@@ -0,0 +1,236 @@
+'''
+cassette.py: record and replay network interactions for Sidewall
+
+The transports in this module (see "About transports" in network.py) make
+it possible to run Sidewall without access to Dimensions.  A
+RecordingTransport performs network operations as usual and also writes
+each request and its response to a "cassette" file.  A ReplayTransport
+reads a cassette file and answers requests with the recorded responses,
+without using the network and without waiting on rate limits.  This is
+useful for profiling and testing Sidewall repeatably on computers that
+have no network access or no Dimensions account.
+
+The easiest way to use this is the function use_cassette():
+
+    from sidewall import dimensions, use_cassette
+    use_cassette('session.json', mode = 'record')    # Or mode = 'replay'.
+
+Alternatively, set the environment variable SIDEWALL_CASSETTE to the path
+of a cassette file and SIDEWALL_CASSETTE_MODE to "record" or "replay".
+
+A cassette file has one line of JSON text for each recorded interaction,
+after a first line giving the version of the format.  Interactions are
+appended to the file as they happen, so that recording costs the same for
+every request no matter how many came before it, and a recording that is
+interrupted still holds everything up to that point.
+
+Credentials are not written to cassette files: user names and passwords in
+requests are replaced with a placeholder, Authorization headers are not
+recorded, and tokens in responses are replaced with a placeholder.  Requests
+are matched on replay using the HTTP method, the URL and the (redacted)
+request body.  If the same request was recorded several times, the recorded
+responses are replayed in order, and the last one is repeated if the
+request is made more often than it was recorded.
+
+Authors
+-------
+
+Michael Hucka <mhucka@caltech.edu> -- Caltech Library
+
+Copyright
+---------
+
+Copyright (c) 2019 by the California Institute of Technology.  This code is
+open-source software released under a 3-clause BSD license.  Please see the
+file "LICENSE" for more information.
+'''
+
+from   collections import deque
+import json
+import os
+import requests
+from   requests.structures import CaseInsensitiveDict
+import threading
+
+from .debug import log
+from .exceptions import NetworkFailure, RequestError
+from .network import LiveTransport, set_transport, current_transport
+
+
+# Constants.
+# .............................................................................
+
+_REDACTED = 'REDACTED'
+'''Placeholder written in place of credentials and tokens.'''
+
+_SECRET_FIELDS = ['username', 'password', 'token']
+'''Fields of JSON requests and responses whose values are redacted.'''
+
+_VERSION = 2
+'''Version of the format of cassette files written by this module.'''
+
+_DROPPED_HEADERS = ['content-encoding', 'content-length', 'transfer-encoding',
+                    'set-cookie']
+'''Response headers not recorded, because they don't apply to the recorded
+(decoded) body or they might contain credentials.'''
+
+
+# Classes.
+# .............................................................................
+
+class RecordingTransport(object):
+    '''Transport that performs network operations using 'transport' (by
+    default, a LiveTransport) and records them in the file 'path'.  Call
+    close() when done, to close the file.'''
+
+    offline = False
+
+    def __init__(self, path, transport = None):
+        self.path = path
+        self._transport = transport or LiveTransport()
+        self._lock = threading.Lock()
+        if __debug__: log('recording interactions in {}', path)
+        self._file = open(path, 'w')
+        self._write({'version': _VERSION})
+
+
+    def request(self, get_or_post, url, session, deadline = None, **kwargs):
+        response = self._transport.request(get_or_post, url, session,
+                                           deadline = deadline, **kwargs)
+        # Reading the content here means a streamed response is received in
+        # full before being returned, but it can still be iterated over.
+        interaction = {'request' : {'method': get_or_post,
+                                    'url'   : url,
+                                    'body'  : _request_body(kwargs)},
+                       'response': {'status' : response.status_code,
+                                    'headers': _recorded_headers(response),
+                                    'body'   : _redacted_text(response.text)}}
+        with self._lock:
+            self._write(interaction)
+        return response
+
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+    def _write(self, value):
+        self._file.write(json.dumps(value) + '\n')
+        self._file.flush()
+
+
+class ReplayTransport(object):
+    '''Transport that answers requests using the interactions recorded in the
+    file 'path'.  Raises NetworkFailure for requests that were not recorded.'''
+
+    offline = True
+
+    def __init__(self, path):
+        self.path = path
+        self._responses = {}
+        self._lock = threading.Lock()
+        with open(path, 'r') as f:
+            try:
+                header = json.loads(f.readline())
+            except ValueError:
+                header = None
+            if not isinstance(header, dict) or header.get('version') != _VERSION:
+                raise RequestError('{} is not a cassette file of version {}'
+                                   .format(path, _VERSION))
+            for line in f:
+                if not line.strip():
+                    continue
+                interaction = json.loads(line)
+                req = interaction['request']
+                key = (req['method'], req['url'], req['body'])
+                self._responses.setdefault(key, deque()).append(interaction['response'])
+
+
+    def request(self, get_or_post, url, session, deadline = None, **kwargs):
+        key = (get_or_post, url, _request_body(kwargs))
+        with self._lock:
+            responses = self._responses.get(key)
+            if not responses:
+                raise NetworkFailure('No recorded response for {} {} with {}'
+                                     .format(get_or_post, url, key[2]))
+            recorded = responses.popleft() if len(responses) > 1 else responses[0]
+        if __debug__: log('replaying response for {} {}', get_or_post, url)
+        return _response(url, recorded)
+
+
+# Exported functions.
+# .............................................................................
+
+def use_cassette(path, mode = 'replay'):
+    '''Record network interactions in the file 'path' (if 'mode' is "record")
+    or replay them from it (if 'mode' is "replay").  A 'path' of None
+    restores normal network operation.'''
+    if path is None:
+        transport = None
+    elif mode == 'record':
+        transport = RecordingTransport(path)
+    elif mode == 'replay':
+        transport = ReplayTransport(path)
+    else:
+        raise RequestError('Unknown cassette mode "{}"'.format(mode))
+    previous = current_transport()
+    if isinstance(previous, RecordingTransport):
+        previous.close()
+    set_transport(transport)
+
+
+# Helper functions.
+# .............................................................................
+
+def _request_body(kwargs):
+    if kwargs.get('json') is not None:
+        return json.dumps(_redacted(kwargs['json']), sort_keys = True)
+    data = kwargs.get('data')
+    if isinstance(data, bytes):
+        data = data.decode('utf-8')
+    return data
+
+
+def _redacted(value):
+    if isinstance(value, dict):
+        return {k: (_REDACTED if k in _SECRET_FIELDS else _redacted(v))
+                for k, v in value.items()}
+    return value
+
+
+def _redacted_text(text):
+    # Only the top level of JSON results is checked for secrets.  Results
+    # are not rewritten unless they have a secret, to keep them unchanged.
+    try:
+        value = json.loads(text)
+    except ValueError:
+        return text
+    if isinstance(value, dict) and any(k in value for k in _SECRET_FIELDS):
+        return json.dumps(_redacted(value))
+    return text
+
+
+def _recorded_headers(response):
+    return {k: v for k, v in response.headers.items()
+            if k.lower() not in _DROPPED_HEADERS}
+
+
+def _response(url, recorded):
+    '''Return a requests.Response object built from the 'recorded' response.'''
+    response = requests.Response()
+    response.url = url
+    response.status_code = recorded['status']
+    response.headers = CaseInsensitiveDict(recorded['headers'])
+    response.encoding = 'utf-8'
+    response._content = recorded['body'].encode('utf-8')
+    response._content_consumed = True
+    return response
+
+
+# Initialization.
+# .............................................................................
+
+if os.environ.get('SIDEWALL_CASSETTE'):
+    use_cassette(os.environ['SIDEWALL_CASSETTE'],
+                 os.environ.get('SIDEWALL_CASSETTE_MODE', 'replay'))
@@ -14,8 +14,10 @@ open-source software released under a 3-clause BSD license.  Please see the
 file "LICENSE" for more information.
 '''
 
+from   contextlib import nullcontext
 import inspect
 import json as jsonlib
+import threading
 
 from .debug import log
 from .data_helpers import dimensions_id, objattr, set_objattr
@@ -41,6 +43,15 @@ from .data_helpers import dimensions_id, objattr, set_objattr
 #   Dimensions aren't always complete.  In some cases, we have a way to query
 #   Dimensions in a different way to get additional field values.  The logic
 #   for doing the secondary search is also in __getattribute__() below.
+#
+# - Objects may be shared by several threads, so every object has a lock that
+#   is held while the object's attributes are being expanded or filled in.
+#   The lock is not held during the network search for filling in values;
+#   instead, Dimensions makes sure that only one thread searches for a given
+#   object at a time (see dimensions.py and fill.py).  Expansion and filling
+#   can create objects that need resolving with searches (e.g., organizations
+#   known only by id); those searches are deferred until the lock has been
+#   released, using _deferring() below.
 
 class DimensionsCore(object):
     _attributes = []
@@ -48,12 +59,14 @@ class DimensionsCore(object):
     def __init__(self, data, creator = None, dimensions_obj = None):
         if not isinstance(data, dict):
             raise InternalError('Data not in dict format')
+        self._lock = threading.RLock() # Guards expansion and filling.
         self._orig_data = data         # A dict.
         self._fill_data = None         # If we ever run a fill search
         self._hash = None
         self._dimensions = None
         self._lazy_expanded = False
         self._attributes_done = set()  # Attributes we have finished filling.
+        self._scope = None             # Cache scope, set by Dimensions.factory().
 
         if dimensions_obj:
             self._dimensions = dimensions_obj
@@ -71,11 +84,14 @@ class DimensionsCore(object):
             return objattr(self, attr)
         attrib_dict = objattr(self, '__dict__')
         if attr not in attrib_dict or not objattr(self, '_lazy_expanded'):
-            # Attribute has no value, but we haven't expanded all attributes.
-            if __debug__: log('"{}" isn\'t set yet on {}', attr, id(self))
-            lazy_expand = objattr(self, '_lazy_expand')
-            lazy_expand(objattr(self, '_orig_data'))
-            set_objattr(self, '_lazy_expanded', True)
+            with _deferring(self), objattr(self, '_lock'):
+                # Check again, in case another thread expanded it meanwhile.
+                if attr not in attrib_dict or not objattr(self, '_lazy_expanded'):
+                    # Attribute has no value, but we haven't expanded all attributes.
+                    if __debug__: log('"{}" isn\'t set yet on {}', attr, id(self))
+                    lazy_expand = objattr(self, '_lazy_expand')
+                    lazy_expand(objattr(self, '_orig_data'))
+                    set_objattr(self, '_lazy_expanded', True)
         if ((attr not in attrib_dict or not objattr(self, attr))
             and attr not in objattr(self, '_attributes_done')):
             # Attribute still has no value, but we haven't tried searching yet.
@@ -85,32 +101,17 @@ class DimensionsCore(object):
             mark_done = objattr(self, '_mark_done')
             if dim and dim_id:
                 if __debug__: log('still missing value for "{}" on {}', attr, id(self))
-                try:
-                    # If we know of a way to expand values on this object, there
-                    # will be a class attribute providing a search template.
-                    search_tmpl = objattr(self, '_search_tmpl')
-                except:
-                    if __debug__: log("no search template -- can't fill in values")
+                # If we know of a way to expand values on this object, there
+                # will be a class attribute providing a search template.
+                cls = type(self)
+                if hasattr(cls, '_batch_tmpl') or hasattr(cls, '_search_tmpl'):
+                    # Dimensions decides whether to do a search for this object
+                    # alone or a batched search (see fill.py), and then calls
+                    # our _apply_fill() with the results.
+                    fill = objattr(dim, 'fill')
+                    fill(self)
                 else:
-                    search = objattr(dim, 'record_search')
-                    search_results = search(search_tmpl, dim_id)
-                    # Store the results on this object, to help debugging.
-                    set_objattr(self, '_fill_data', search_results)
-                    # Subclasses may have their own _fill_record.  Look for all.
-                    classes = inspect.getmro(self.__class__)
-                    for c in classes[:-1]:  # Skip class 'object'.
-                        try:
-                            fill_record = objattr(c, '_fill_record')
-                            fill_record(self, search_results)
-                            # If we call a class' _fill_record(), we assume it
-                            # fills all attributes to the extent possible.
-                            # We mark them all as done so we don't try again.
-                            attributes_filled = objattr(self, '_new_attributes', [])
-                            if __debug__: log('marking filled attributes: {}',
-                                              attributes_filled)
-                            mark_done(attributes_filled)
-                        except:
-                            pass
+                    if __debug__: log("no search template -- can't fill in values")
             else:
                 if __debug__: log("missing id -- can't search for \"{}\"", attr)
                 # We now set the flag that we tried, whether we can search or not.
@@ -120,6 +121,45 @@ class DimensionsCore(object):
         return value
 
 
+    def _expand(self):
+        # Perform the lazy expansion now, if it hasn't been done yet.
+        with _deferring(self), objattr(self, '_lock'):
+            if not objattr(self, '_lazy_expanded'):
+                lazy_expand = objattr(self, '_lazy_expand')
+                lazy_expand(objattr(self, '_orig_data'))
+                set_objattr(self, '_lazy_expanded', True)
+
+
+    def _apply_fill(self, search_results):
+        with _deferring(self), objattr(self, '_lock'):
+            apply_fill = objattr(self, '_apply_fill_unlocked')
+            apply_fill(search_results)
+
+
+    def _apply_fill_unlocked(self, search_results):
+        # Store the results on this object, to help debugging.
+        set_objattr(self, '_fill_data', search_results)
+        mark_done = objattr(self, '_mark_done')
+        # Subclasses may have their own _fill_record.  Look for all.
+        classes = inspect.getmro(self.__class__)
+        for c in classes[:-1]:  # Skip class 'object'.
+            try:
+                fill_record = objattr(c, '_fill_record')
+                fill_record(self, search_results)
+                # If we call a class' _fill_record(), we assume it
+                # fills all attributes to the extent possible.
+                # We mark them all as done so we don't try again.
+                attributes_filled = objattr(self, '_new_attributes', [])
+                if __debug__: log('marking filled attributes: {}',
+                                  attributes_filled)
+                mark_done(attributes_filled)
+            except:
+                pass
+        # The search won't give different results if we do it again, so there
+        # is nothing more to be learned about the remaining attributes either.
+        mark_done(list(objattr(self, '_attributes')))
+
+
     def _mark_done(self, attr):
         if __debug__: log('marking "{}" as final on {}', attr, id(self))
         done = objattr(self, '_attributes_done')
@@ -200,3 +240,15 @@ class DimensionsCore(object):
         else:
             self._hash = hash(self)
         return self._hash
+
+
+# Helper functions.
+# .............................................................................
+
+def _deferring(obj):
+    '''Return a context manager that postpones the batched searches for
+    resolving objects (see fill.py) requested while it is active, so that
+    they are done after the lock of 'obj' has been released.'''
+    dim = objattr(obj, '_dimensions', None)
+    filler = objattr(dim, '_filler', None) if dim is not None else None
+    return filler.deferred() if filler is not None else nullcontext()
@@ -0,0 +1,118 @@
+'''
+cursor.py: positions in the results of Dimensions queries
+
+Iterating over a large set of results takes a long time under the Dimensions
+rate limit.  A Cursor records how far the iteration over the results of a
+query has gotten, so that if the program stops (e.g., because of a network
+failure), the iteration can be resumed later with dimensions.resume()
+without fetching the pages of results already done.  A Cursor can be saved
+to a file and loaded from it; the file contains JSON text.
+
+A Cursor is obtained by calling cursor() on a queryresults object, or saved
+automatically using checkpoint().  For example,
+
+    results = dimensions.query('search publications ...').checkpoint('pubs.json')
+    for pub in results:
+        ...
+
+and after a failure,
+
+    results = dimensions.resume('pubs.json')
+
+Authors
+-------
+
+Michael Hucka <mhucka@caltech.edu> -- Caltech Library
+
+Copyright
+---------
+
+Copyright (c) 2019 by the California Institute of Technology.  This code is
+open-source software released under a 3-clause BSD license.  Please see the
+file "LICENSE" for more information.
+'''
+
+import json
+import os
+
+from .debug import log
+from .exceptions import RequestError
+
+
+# Constants.
+# .............................................................................
+
+_FIELDS = ['query', 'expanded_query', 'result_type', 'fetch_size', 'skip',
+           'offset', 'total', 'limit_results']
+'''Names of the attributes of Cursor objects, in the order of arguments.'''
+
+
+# Classes.
+# .............................................................................
+
+class Cursor(object):
+    '''Position in the results of a query.  'query' is the query as given by
+    the user, 'expanded_query' is the query sent to Dimensions (without limit
+    and skip clauses), 'result_type' is the kind of results, and 'fetch_size'
+    is the number of results per page.  'skip' is the position of the first
+    result of the page containing the next result to be returned, and
+    'offset' is the position of the next result within that page.  'total' is
+    the number of results the iteration produces in all, and 'limit_results'
+    is the limit given to the query, if any.'''
+
+    def __init__(self, query, expanded_query, result_type, fetch_size, skip,
+                 offset, total, limit_results = None):
+        self.query          = query
+        self.expanded_query = expanded_query
+        self.result_type    = result_type
+        self.fetch_size     = fetch_size
+        self.skip           = skip
+        self.offset         = offset
+        self.total          = total
+        self.limit_results  = limit_results
+
+
+    def __repr__(self):
+        return 'Cursor({})'.format(', '.join('{} = {!r}'.format(f, getattr(self, f))
+                                             for f in _FIELDS))
+
+
+    def __eq__(self, other):
+        return isinstance(other, Cursor) and self.as_dict() == other.as_dict()
+
+
+    @property
+    def position(self):
+        '''The number of results that have been returned.'''
+        return self.skip + self.offset
+
+
+    @property
+    def finished(self):
+        '''True if all the results have been returned.'''
+        return self.position >= self.total
+
+
+    def as_dict(self):
+        '''Return the values of this cursor as a dict.'''
+        return {f: getattr(self, f) for f in _FIELDS}
+
+
+    def save(self, path):
+        '''Write this cursor to the file 'path'.  The file is replaced in one
+        step, so that it's never left incomplete.'''
+        if __debug__: log('saving cursor at {} to {}', self.position, path)
+        tmp = path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.as_dict(), f)
+        os.replace(tmp, path)
+
+
+    @classmethod
+    def load(cls, path):
+        '''Return the Cursor saved in the file 'path'.'''
+        with open(path, 'r') as f:
+            values = json.load(f)
+        if not isinstance(values, dict) or any(f not in values for f in _FIELDS):
+            raise RequestError('File {} does not contain a cursor'.format(path))
+        return cls(*[values[f] for f in _FIELDS])
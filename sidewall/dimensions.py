@@ -7,11 +7,14 @@ Implementation notes
 Sidewall caches the returned values of Dimensions queries as well as the data
 objects created by Sidewall.  Not all objects are persisted, because some
 objects only make sense when interpreted in the context of a query.  Only
-those classes that use the mixin "Persistable" are stored.
+those classes that use the mixin "Persistable" are kept across queries.
 
-Currently, the cache is simply a Python dict and it is not saved to disk.  A
-future enhancement would be to provide a way to save the values to disk so
-that they can be retained across invocations of Sidewall.
+The in-memory cache is an ObjectCache (see cache.py), which is bounded in
+size and evicts the least-recently used entries.  Optionally, the raw
+results of record searches and result pages can also be saved to disk (in
+an SQLite file managed by DiskCache in cache.py) so that they can be
+retained across invocations of Sidewall.  Use dimensions.use_disk_cache(...)
+to enable it.
 
 Authors
 -------
@@ -26,28 +29,47 @@ open-source software released under a 3-clause BSD license.  Please see the
 file "LICENSE" for more information.
 '''
 
-from   collections import Iterable, Iterator, namedtuple
+import base64
+from   collections import Iterable, Iterator, deque, namedtuple
+from   concurrent.futures import ThreadPoolExecutor
+from   datetime import date
 import getpass
+import itertools
 import json as jsonlib
 import keyring
+import os
+import queue
 import re
 import requests
 import string
 import sys
+import threading
+from   time import perf_counter, time
+import weakref
 
 if sys.platform.startswith('win'):
     import keyring.backends
     from keyring.backends.Windows import WinVaultKeyring
 
+from .cache import ObjectCache, DiskCache, result_kind
+from .core import DimensionsCore
+from .cursor import Cursor
 from .data_helpers import dimensions_id, list_diff, matching_record, objattr
+from .data_helpers import set_objattr
 from .debug import log
 from .exceptions import *
+from .export import Exportable
+from .fill import BatchFiller
 from .grant import Grant
-from .network import network_available, timed_request, net
+from .network import network_available, timed_request, net, set_probe_default
+from .network import new_session, set_pool_size, _POOL_SIZE
 from .organization import Organization
 from .publication import Publication
 from .researcher import Researcher
+from .retry import retry_policy
 from .singleton import Singleton
+from .streaming import stream_response
+from .timeouts import current_timeouts
 
 
 # Type definitions
@@ -63,11 +85,21 @@ Handler.__doc__ = '''Convenience class for storing info about return types.
 # Constants
 # .............................................................................
 
-_AUTH_URL = 'https://app.dimensions.ai/api/auth.json'
-'''The authentication URL used by Dimensions.'''
+_BASE_URL = 'https://app.dimensions.ai'
+'''The default address of the Dimensions API server.'''
 
-_DSL_URL = 'https://app.dimensions.ai/api/dsl.json'
-'''The DSL network URL used by Dimensions.'''
+_AUTH_PATH = '/api/auth.json'
+'''The path of the authentication endpoint used by Dimensions.'''
+
+_DSL_PATH = '/api/dsl.json'
+'''The path of the DSL endpoint used by Dimensions.'''
+
+_TOKEN_MARGIN = 60
+'''Number of seconds before a token expires that we log in again.'''
+
+_TOKEN_LIFETIME = 30 * 60
+'''Lifetime assumed for tokens that don't say when they expire.  This is
+only used to decide how long to keep a token in the token cache file.'''
 
 _KEYRING = "org.caltech.library.sidewall"
 '''Prefix used to create a keyring entry for the user's credentials.'''
@@ -80,16 +112,32 @@ _KNOWN_RESULT_TYPES = {
     }
 '''Known types of results that we can handle in a query.'''
 
-_MAX_RETRIES = 3
-'''Number of times to retry a request when server says results are not ready.'''
-
-_RETRY_SLEEP = 2
-'''How many seconds to wait between retrying a query.'''
+_CACHE_MAX_ITEMS = 100000
+'''Default maximum number of objects and results kept in the memory cache.'''
 
 # Note: my informal testing consistently showed 100 is better than 50, 200, 500
 _FETCH_SIZE = 100
 '''How many results to get at a time from Dimensions.'''
 
+_MAX_FETCH_SIZE = 1000
+'''The largest number of results Dimensions returns at a time.'''
+
+_AUTO_MAX_BYTES = 16 * 1024 * 1024
+'''Largest size (in bytes) of a page of results with fetch_size = 'auto'.'''
+
+_DEFAULT_LIMIT = 20
+'''Number of results returned by Dimensions for queries without "limit".'''
+
+_RECORD_SIZE = 4096
+'''Size (in bytes) assumed for a record of results until one is observed.'''
+
+_MAX_SKIP = 50000
+'''Maximum number of results of a single query that Dimensions will return
+using "skip".  Partitioned queries keep each partition below this.'''
+
+_PARTITION_WORKERS = 4
+'''Default number of partitions of a partitioned query fetched concurrently.'''
+
 
 # Classes
 # .............................................................................
@@ -100,13 +148,30 @@ class Dimensions(Singleton):
         self._use_keyring      = True
         self._reset_keyring    = False
         self._dimensions_token = None
-        self._session          = requests.Session()
+        self._token_expiry     = None
+        self._login_creds      = None
+        self._token_cache      = None
+        self._session          = new_session()
+        self._pool_size        = _POOL_SIZE
+        self._disk_cache       = None
+        self._filler           = BatchFiller(self)
+        self._record_sizes     = {}
+        self.set_base_url(os.environ.get('SIDEWALL_DIMENSIONS_URL') or _BASE_URL)
+
+        # The following are for using one Dimensions object from multiple
+        # threads.  _object_lock guards the creation of objects in factory(),
+        # and _in_flight maps the keys of searches in progress to events
+        # that are set when the searches finish (see _single_flight()).
+        self._login_lock       = threading.Lock()
+        self._object_lock      = threading.RLock()
+        self._flight_lock      = threading.Lock()
+        self._in_flight        = {}
 
         self._init_cache()
 
 
     def login(self, username = None, password = None,
-              use_keyring = True, reset_keyring = False):
+              use_keyring = True, reset_keyring = False, token_cache = None):
         '''Store credentials for using the Dimensions network API.
         If values for 'username' and 'password' are not provided, this will
         ask the user for them interactively.  Values will be stored in the
@@ -117,30 +182,141 @@ class Dimensions(Singleton):
         keyring/keychain system), invoke this method with reset_keyring = True.
         It will then query for the user name and password again, even if values
         already exist in the keyring or keychain.
+
+        The credentials are also kept in memory, so that when the token issued
+        by Dimensions expires (or is about to), Sidewall can log in again
+        behind the scenes and repeat the request that failed.
+
+        If the user name or password is not given, the values of the
+        environment variables SIDEWALL_USERNAME and SIDEWALL_PASSWORD are used
+        if they are set, before trying the keyring.  This is convenient for
+        programs running without a user present.
+
+        If 'token_cache' (or the environment variable SIDEWALL_TOKEN_CACHE) is
+        the path of a file, the token obtained from Dimensions is saved in
+        that file, readable only by the user, and later calls to login() reuse
+        it until it expires, without consulting the keyring or contacting
+        Dimensions.
         '''
         if __debug__: log('user = {}, pass = {}', username, 'X' if password else '')
         self._use_keyring = use_keyring
         self._reset_keyring = reset_keyring
+        self._token_cache = token_cache or os.environ.get('SIDEWALL_TOKEN_CACHE')
+        username = username or os.environ.get('SIDEWALL_USERNAME')
+        password = password or os.environ.get('SIDEWALL_PASSWORD')
+        if self._token_cache and not reset_keyring:
+            with self._login_lock:
+                if self._load_token(username, password):
+                    return
         if not username or not password:
             (username, password) = self._credentials(username, password)
 
         if not network_available():
             raise NetworkFailure('No network.')
 
-        self._dimensions_token = None
+        with self._login_lock:
+            self._authenticate(username, password)
+
+
+    def _authenticate(self, username, password):
+        '''Get a new token from Dimensions.  The caller must hold _login_lock.'''
+        # Other threads may be using the current token while we log in, so
+        # the token is only replaced once we have a new one.
         creds = {'username': username, 'password': password}
-        (resp, error) = net('post', _AUTH_URL, session = self._session, json = creds)
+        (resp, error) = net('post', self._auth_url, session = self._session, json = creds)
         if error:
+            self._dimensions_token = None
             raise error
 
         data = resp.json()
         if 'token' in data:
             self._dimensions_token = data['token']
+            self._token_expiry = token_expiry(data['token'])
+            # Remember the credentials (in memory only) for renewing the token.
+            self._login_creds = (username, password)
+            if self._token_cache:
+                self._save_token(username)
         else:
+            self._dimensions_token = None
             raise AuthenticationFailure('Dimensions did not return a token')
 
 
-    def query(self, query_string, limit_results = None, fetch_size = _FETCH_SIZE):
+    def _renew_token(self, old_token):
+        '''Log in again using the credentials given to login(), unless another
+        thread has already replaced 'old_token' with a new token.'''
+        with self._login_lock:
+            if self._dimensions_token != old_token:
+                if __debug__: log('token was renewed by another thread')
+                return
+            (username, password) = self._login_creds or (None, None)
+            if not username or not password:
+                # We started with a cached token and haven't needed these yet.
+                (username, password) = self._credentials(username, password)
+            if __debug__: log('renewing Dimensions token')
+            self._authenticate(username, password)
+
+
+    def _load_token(self, username, password):
+        '''Use the token in the token cache file if it's still valid and was
+        issued for 'username' (if given).  Returns True if the token is used.
+        The caller must hold _login_lock.'''
+        path = self._token_cache
+        try:
+            if os.name == 'posix' and os.stat(path).st_mode & 0o077:
+                if __debug__: log('ignoring {} -- others can access it', path)
+                return False
+            with open(path, 'r') as f:
+                cached = jsonlib.load(f)
+            token, expiry = cached['token'], cached['expiry']
+        except (OSError, ValueError, KeyError, TypeError):
+            if __debug__: log('no usable token in {}', path)
+            return False
+        if username and cached.get('username') != username:
+            if __debug__: log('token in {} is for another user', path)
+            return False
+        if time() > expiry - _TOKEN_MARGIN:
+            if __debug__: log('token in {} has expired', path)
+            return False
+        if __debug__: log('using token from {}', path)
+        self._dimensions_token = token
+        self._token_expiry = expiry
+        self._login_creds = (username or cached.get('username'), password)
+        return True
+
+
+    def _save_token(self, username):
+        '''Write the current token to the token cache file, creating the file
+        so that only the user can read it.  The caller must hold _login_lock.'''
+        path = self._token_cache
+        expiry = self._token_expiry or time() + _TOKEN_LIFETIME
+        content = jsonlib.dumps({'username': username,
+                                 'token'   : self._dimensions_token,
+                                 'expiry'  : expiry})
+        tmp = path + '.tmp'
+        try:
+            fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            if hasattr(os, 'fchmod'):
+                os.fchmod(fd, 0o600)    # In case the file already existed.
+            with os.fdopen(fd, 'w') as f:
+                f.write(content)
+            os.replace(tmp, path)
+        except OSError as ex:
+            if __debug__: log('unable to write token to {}: {}', path, ex)
+
+
+    def _current_token(self):
+        '''Return the current token, renewing it first if it is about to expire.'''
+        token = self._dimensions_token
+        expiry = self._token_expiry
+        if token and expiry is not None and time() > expiry - _TOKEN_MARGIN:
+            self._renew_token(token)
+            token = self._dimensions_token
+        return token
+
+
+    def query(self, query_string, limit_results = None, fetch_size = _FETCH_SIZE,
+              prefetch = None, read_ahead = 0, stream = False, deadline = None,
+              raw = False):
         '''Issue the DSL 'query_string' to Dimensions and return an iterator
         for the results.  Each item in the results will be an object such as
         Researcher, Publication, etc.
@@ -151,13 +327,206 @@ class Dimensions(Singleton):
 
         The number of results fetched per network access can be set using the
         parameter 'fetch_size'.  The maximum is 1000; this is set by the
-        Dimensions service.
+        Dimensions service.  If 'fetch_size' is 'auto', the number is adjusted
+        as pages are received, based on the time taken per result and the
+        size of the results, to get as many results per network access (and
+        thus per unit of the rate limit) as possible without risking
+        timeouts.
+
+        The parameter 'prefetch' can be a list of field names (which may be
+        dotted paths, such as 'authors.orcid') whose values should be filled
+        in for all the objects in a page of results at once, using as few
+        searches as possible, before the objects are returned by the iterator.
+        See queryresults.prefetch().
+
+        If 'read_ahead' is greater than 0, that many pages of results are
+        fetched from Dimensions in a background thread while the caller is
+        still working on the current page, hiding the network latency.  The
+        background fetches are subject to the same rate limits as all other
+        calls, and are cancelled when the iterator is closed.
+
+        If 'stream' is True, each page of results is decoded as it is received
+        from Dimensions, and objects are returned as soon as their data has
+        arrived instead of after the whole page has been received.  This
+        lowers memory use and the time to the first result for large pages.
+        It can't be combined with 'read_ahead', and when 'prefetch' is used,
+        pages are still decoded incrementally but the objects are only
+        returned once the whole page has been received.
+
+        If 'deadline' is not None, it is a number of seconds within which all
+        the pages of results must have been obtained from Dimensions.  Every
+        network request made for the query (including retries and waits for
+        the rate limit) is limited to the time remaining, and the exception
+        DeadlineExceeded is raised if a page can't be obtained in time.
+
+        If 'raw' is True, the iterator returns the records received from
+        Dimensions as dicts, instead of Sidewall objects.  No objects are
+        created and Sidewall's cache is not used, which makes this much faster
+        for bulk processing of results.  It can't be combined with 'prefetch'.
         '''
 
+        auto_fetch = fetch_size == 'auto'
+        (query_string, result_type, expanded_query, first_query, fetch_size) \
+            = self._prepared_query(query_string, limit_results, fetch_size)
+        self._check_modes(read_ahead, stream, prefetch, raw)
+        if deadline is not None:
+            deadline = perf_counter() + deadline
+
+        # Need run the first query here, to get the total_count.
+        started = perf_counter()
+        if stream:
+            (data, rest) = self._first_streamed_page(first_query, result_type,
+                                                     deadline)
+        else:
+            (data, rest) = (self._post(first_query, deadline), None)
+        total = self._total_count(data, result_type, limit_results,
+                                  check_records = not stream)
+        if total == 0:
+            if rest is not None:
+                rest.close()
+            return []
+
+        # Hand off results processing and query iteration to the iterator.
+        if read_ahead + 1 > self._pool_size:
+            self.set_pool_size(read_ahead + 1)
+        results = queryresults(self, query_string, expanded_query, limit_results,
+                               total, data, result_type, fetch_size, read_ahead,
+                               rest, deadline, auto_fetch = auto_fetch, raw = raw)
+        if not stream:
+            results._measure(len(data[result_type]), perf_counter() - started)
+        if prefetch:
+            results.prefetch(prefetch)
+        return results
+
+
+    def resume(self, cursor, prefetch = None, read_ahead = 0, stream = False,
+               deadline = None, raw = False):
+        '''Continue iterating over the results of a query from the position
+        recorded in 'cursor', which can be a Cursor object (see the method
+        cursor() on queryresults) or the path of a file in which one was saved
+        (see the method checkpoint() on queryresults).  Pages of results before
+        that position are not fetched again.  The other parameters are as for
+        query().  Returns an iterator for the rest of the results.
+        '''
+        if isinstance(cursor, str):
+            cursor = Cursor.load(cursor)
+        self._check_modes(read_ahead, stream, prefetch, raw)
+        if cursor.finished:
+            return []
+        if deadline is not None:
+            deadline = perf_counter() + deadline
+        if __debug__: log('resuming query at position {}', cursor.position)
+
+        size = min(cursor.fetch_size, cursor.total - cursor.skip)
+        page_query = '{} limit {} skip {}'.format(cursor.expanded_query, size,
+                                                  cursor.skip)
+        data = self._post(page_query, deadline)
+        if cursor.result_type not in data:
+            raise DataMismatch('Data from Dimensions does not have expected type')
+        data[cursor.result_type] = data[cursor.result_type][cursor.offset:]
+
+        if read_ahead + 1 > self._pool_size:
+            self.set_pool_size(read_ahead + 1)
+        results = queryresults(self, cursor.query, cursor.expanded_query,
+                               cursor.limit_results, cursor.total, data,
+                               cursor.result_type, cursor.fetch_size, read_ahead,
+                               iter([]) if stream else None, deadline,
+                               cursor.skip, cursor.offset, raw = raw)
+        if prefetch:
+            results.prefetch(prefetch)
+        return results
+
+
+    def partitioned_query(self, query_string, field, start, end,
+                          limit_results = None, fetch_size = _FETCH_SIZE,
+                          prefetch = None, workers = _PARTITION_WORKERS,
+                          max_results = _MAX_SKIP, raw = False):
+        '''Issue the DSL 'query_string' to Dimensions as a number of queries
+        ("partitions") over disjoint ranges of values of 'field', and return
+        an iterator for all their results.  This is for queries with too many
+        results to get using one query, because Dimensions doesn't return
+        results past a certain number (_MAX_SKIP), and it lets several
+        partitions be fetched at the same time.
+
+        'field' must be a field whose values are integers (e.g., 'year') or
+        dates (e.g., 'date_inserted').  'start' and 'end' are the lowest and
+        highest values to include, as integers or datetime.date objects.  The
+        range is divided in halves, using searches that only count results,
+        until each part has at most 'max_results' results.  Results whose
+        values of 'field' are outside the range or missing are not included.
+
+        Up to 'workers' partitions are fetched concurrently, all subject to
+        the same rate limit.  The results of different partitions are
+        interleaved in the order they arrive.  The other parameters are as
+        for query().
+        '''
+        (query_string, result_type, _, _, _) \
+            = self._prepared_query(query_string, limit_results, fetch_size)
+        ranges = self._partition_ranges(query_string, result_type, field,
+                                        _ordinal(start), _ordinal(end),
+                                        isinstance(start, date), max_results)
+        if __debug__: log('query split into {} partitions', len(ranges))
+        if workers + 1 > self._pool_size:
+            self.set_pool_size(workers + 1)
+        executor = ThreadPoolExecutor(max_workers = workers)
+        queries = [_partition_query(query_string, condition) for condition in ranges]
+        try:
+            started = executor.map(lambda q: self.query(q, None, fetch_size, prefetch,
+                                                        raw = raw),
+                                   queries)
+            partitions = [results for results in started if len(results) > 0]
+        except Exception:
+            executor.shutdown(wait = False)
+            raise
+        return partitionedresults(self, query_string, result_type, partitions,
+                                  limit_results, executor)
+
+
+    def _partition_ranges(self, query_string, result_type, field, low, high,
+                          dates, max_results):
+        '''Return a list of conditions on 'field' that divide the range from
+        'low' to 'high' (ordinals) into parts with at most 'max_results'
+        results of 'query_string' each.'''
+        condition = _range_condition(field, low, high, dates)
+        # Only the count is needed, so ask for as little data as possible.
+        count_query = re.sub(r'return\s+{}(\[[^\]]*\])?'.format(result_type),
+                             'return {}[id]'.format(result_type),
+                             _partition_query(query_string, condition))
+        data = self._post(count_query + ' limit 1')
+        total = data.get('_stats', {}).get('total_count', 0)
+        if __debug__: log('{} results for {}', total, condition)
+        if total == 0:
+            return []
+        if total <= max_results:
+            return [condition]
+        if low == high:
+            if __debug__: log('cannot split {} further; only {} results will be '
+                              'returned', condition, max_results)
+            return [condition]
+        middle = (low + high) // 2
+        return (self._partition_ranges(query_string, result_type, field, low,
+                                       middle, dates, max_results)
+                + self._partition_ranges(query_string, result_type, field,
+                                         middle + 1, high, dates, max_results))
+
+
+    def _check_modes(self, read_ahead, stream, prefetch, raw):
+        '''Raise RequestError if the query options can't be used together.'''
+        if stream and read_ahead:
+            raise RequestError('Cannot use both stream and read_ahead')
+        if raw and prefetch:
+            raise RequestError('Cannot use both raw and prefetch')
+
+
+    def _prepared_query(self, query_string, limit_results, fetch_size):
+        '''Check the query and return a tuple of (query string, result type,
+        expanded query string, first query string, fetch size).'''
         # Begin with some sanity checks
         if not query_string.startswith('search'):
             raise RequestError('Query must begin with "search"')
-        if fetch_size > 1000:
+        if fetch_size == 'auto':
+            fetch_size = _FETCH_SIZE
+        elif fetch_size > _MAX_FETCH_SIZE:
             raise RequestError('Dimensions does not accept fetch_size > 1000"')
         # Remove result limits in the query because we need to handle that.
         limit_skip = r'limit\s+[0-9]+(\s+skip\s+[0-9]+)?'
@@ -173,12 +542,33 @@ class Dimensions(Singleton):
             fetch_size = limit_results
         expanded_query = self._expanded_query(query_string)
         first_query = expanded_query + ' limit ' + str(fetch_size)
+        return (query_string, result_type, expanded_query, first_query, fetch_size)
+
+
+    def _first_streamed_page(self, query, result_type, deadline = None):
+        '''Post the 'query' with streaming, and read the results until the
+        statistics about the results have been received.  Returns a tuple of
+        (data, rest), where 'data' is a dict with the values received so far
+        and 'rest' is a generator for the rest of the results.'''
+        rest = self._post_stream(query, result_type, deadline)
+        data = {result_type: []}
+        for key, value in rest:
+            if key == result_type:
+                data[key].append(value)
+            else:
+                data[key] = value
+                if key == '_stats':
+                    break
+        return (data, rest)
 
-        # Need run the first query here, to get the total_count.
-        data = self._post(first_query)
+
+    def _total_count(self, data, result_type, limit_results, check_records = True):
+        '''Check the first page of results and return the number of results
+        that the results iterator should produce.  If 'check_records' is
+        False, the records in the page are not expected to be all there.'''
         if result_type not in data:
             raise DataMismatch('Data from Dimensions does not have expected type')
-        if len(data[result_type]) == 0:
+        if check_records and len(data[result_type]) == 0:
             raise DataMismatch('Data inconsistency in results from Dimensions')
         if '_stats' not in data:
             raise DataMismatch('Data from Dimensions not in expected form')
@@ -188,36 +578,28 @@ class Dimensions(Singleton):
         total = data['_stats']['total_count']
         if total == 0:
             if __debug__: log('query produced 0 results')
-            return []
         else:
             if __debug__: log('query produced {}', total)
-            if limit_results:
+            if limit_results and limit_results < total:
                if __debug__: log('will use limit_results {}', limit_results)
                total = limit_results
-
-        # If we get this far, the next step will start creating objects. Clear
-        # the cache of any objects that mustn't be persisted across queries.
-        self._clear_cache()
-
-        # Hand off results processing and query iteration to the iterator.
-        return queryresults(self, query_string, expanded_query, limit_results,
-                            total, data, result_type, fetch_size)
+        return total
 
 
     _strip_whitespace = str.maketrans('', '', string.whitespace)
 
-    def record_search(self, query, id, retry = 1):
-        '''Internal method for filling in missing data field values.'''
+    def record_search(self, query, id, retry = 1, deadline = None):
+        '''Internal method for filling in missing data field values.  If
+        'deadline' is not None, it is the number of seconds within which the
+        search must be done, or else DeadlineExceeded is raised.'''
         if __debug__: log('initiating record search involving {}'.format(id))
+        if deadline is not None:
+            deadline = perf_counter() + deadline
         search = 'search ' + query.format(id)
         key = search.translate(self._strip_whitespace)
-        if key in self._cache:
-            if __debug__: log("returning cached value for '{}'", search)
-            return self._cache[key]
-
-        data = self._post(search)
+        data = self._single_flight(key, lambda: self._post(search, deadline),
+                                   deadline)
         if __debug__: log('response: {}', data)
-        self._cache[key] = data
         if data == {}:
             return {}
         # Due to the fact that the results may not be unique and contain a
@@ -234,33 +616,180 @@ class Dimensions(Singleton):
         return matching_record(data, result_keys[0], id)
 
 
-    def _post(self, query, retry = 1):
-        '''Internal method to post the 'query' string to the server and return
-        the result as a dict.
+    def _single_flight(self, key, fetch, deadline = None):
+        '''Return the value cached under 'key', calling fetch() to get it and
+        cache it if necessary.  If several threads ask for the same key at the
+        same time, only one of them calls fetch() and the others wait for it,
+        but not past 'deadline' (a value of time.perf_counter()) if given.
+        '''
+        while True:
+            with self._flight_lock:
+                value = self._cache.get(key)
+                if value is not None:
+                    if __debug__: log("returning cached value for '{}'", key)
+                    return value
+                event = self._in_flight.get(key)
+                if event is None:
+                    event = self._in_flight[key] = threading.Event()
+                    break
+            # Another thread is fetching it.  When it's done, look again; if
+            # it failed, the value won't be in the cache and we'll try.
+            if __debug__: log("waiting on another thread for '{}'", key)
+            wait = None if deadline is None else max(0, deadline - perf_counter())
+            if not event.wait(wait):
+                raise DeadlineExceeded('Search did not finish before its deadline')
+        try:
+            value = fetch()
+            self._cache[key] = value
+            return value
+        finally:
+            with self._flight_lock:
+                del self._in_flight[key]
+            event.set()
+
+
+    def fill(self, obj):
+        '''Internal method for filling in missing data field values on 'obj'.
+        If the object's class supports it, this does a batched search that
+        also fills in other pending objects of the same kind (see fill.py).
         '''
-        if __debug__: log("posting query to server: '{}'", query)
-        headers = {'Authorization': "JWT " + self._dimensions_token}
-        (resp, error) = net('post', _DSL_URL, session = self._session,
-                            data = query, headers = headers)
+        if objattr(obj, '_batch_tmpl', None):
+            self._filler.fill(obj)
+        else:
+            search_tmpl = objattr(obj, '_search_tmpl')
+            search_results = self.record_search(search_tmpl, objattr(obj, 'id'))
+            apply_fill = objattr(obj, '_apply_fill')
+            apply_fill(search_results)
+
+
+    def resolve(self, objects):
+        '''Internal method for filling in the objects in the list 'objects'
+        (e.g., organizations known only by id) using batched searches.'''
+        self._filler.resolve(objects)
 
-        # Deal with problems, retry if appropriate, or fail.
-        if isinstance(error, NoContent):
+
+    def _post(self, query, deadline = None):
+        '''Internal method to post the 'query' string to the server and return
+        the result as a dict.  'deadline' is as for _response().
+        '''
+        key = query.translate(self._strip_whitespace)
+        kind = result_kind(query)
+        if self._disk_cache is not None:
+            data = self._disk_cache.get(key, kind)
+            if data is not None:
+                return data
+
+        resp = self._response(query, deadline = deadline)
+        data = {} if resp is None else resp.json()
+        if resp is not None and kind in data:
+            self._record_size(kind, len(data[kind]), len(resp.content))
+        if self._disk_cache is not None:
+            self._disk_cache.put(key, data, kind)
+        return data
+
+
+    def _post_stream(self, query, result_type, deadline = None):
+        '''Internal method to post the 'query' string to the server and return
+        a generator of (key, value) pairs for the members of the result.  The
+        records in the 'result_type' member are produced one at a time, as
+        they are received (see streaming.py).  When the disk cache is in use,
+        the result is stored there whole, so it's not streamed.
+        '''
+        if self._disk_cache is not None:
+            data = self._post(query, deadline)
+            return ((key, item) for key, value in data.items()
+                    for item in (value if key == result_type else [value]))
+        resp = self._response(query, stream = True, deadline = deadline)
+        if resp is None:
+            return iter([])
+        return self._resumed_stream(resp, query, result_type, deadline)
+
+
+    def _resumed_stream(self, resp, query, result_type, deadline = None):
+        '''Return a generator of the (key, value) pairs in the response 'resp'
+        to 'query', as for _post_stream().  If the connection fails while the
+        response is being read, the query is posted again, with retries done
+        according to the current retry policy, and the pairs already produced
+        are skipped in the new response.  Raises NetworkFailure if the retries
+        are exhausted.'''
+        policy = retry_policy()
+        started = perf_counter()
+        retries = 0
+        done = 0
+        while True:
+            try:
+                for (count, item) in enumerate(stream_response(resp, result_type)):
+                    if count >= done:
+                        done += 1
+                        yield item
+                return
+            except requests.exceptions.RequestException as ex:
+                if __debug__: log('lost connection after {} items: {}', done, ex)
+                retries += 1
+                if not policy.wait(retries, started, until = deadline):
+                    raise NetworkFailure('Connection lost while receiving results: {}'
+                                         .format(ex))
+            resp = self._response(query, stream = True, deadline = deadline)
+            if resp is None:
+                raise DataMismatch('Server returned no content when a query was repeated')
+
+
+    def _response(self, query, stream = False, deadline = None):
+        '''Post the 'query' string to the server and return the response, or
+        None if the server says there is no content.  Raises an exception if
+        the query fails.  If 'deadline' is not None, it is a value of
+        time.perf_counter() by which the response must have been received,
+        or else DeadlineExceeded is raised.'''
+        # net() does the retrying, including on code 202, which means the
+        # request was received by the server but not acted upon yet.
+        renewed = False
+        while True:
+            if __debug__: log("posting query to server: '{}'", query)
+            token = self._current_token()
+            headers = {'Authorization': "JWT " + token}
+            (resp, error) = net('post', self._dsl_url, session = self._session,
+                                data = query, headers = headers, stream = stream,
+                                deadline = deadline,
+                                expected_size = self._expected_size(query))
+            if (isinstance(error, AuthenticationFailure) and resp is not None
+                and resp.status_code == 401 and not renewed):
+                # The token may have expired. Get a new one and try again.
+                if __debug__: log('got code 401 -- renewing token & retrying')
+                resp.close()
+                self._renew_token(token)
+                renewed = True
+                continue
+            break
+
+        # Deal with problems or fail.
+        if not error and resp.status_code == 202:
+            resp.close()
+            raise ServiceFailure('Server returned code 202 multiple times')
+        elif isinstance(error, NoContent):
             if __debug__: log('server returned a "no content" code')
-            return {}
-        elif resp.status_code == 202:
-            # Request was received by the server but not acted upon.
-            if retry <= _MAX_RETRIES:
-                if __debug__: log('got code 202 -- pausing & retrying')
-                sleep(_RETRY_SLEEP)     # Sleep a short time and try again.
-                return self._post(query, retry + 1)
-            else:
-                raise ServiceFailure('Server returned code 202 multiple times')
-        elif resp.status_code == 400:
+            return None
+        elif resp is not None and resp.status_code == 400:
             raise RequestError(self._request_error_msg(resp))
         elif error:
             raise error
-        else:
-            return resp.json()
+        return resp
+
+
+    def _expected_size(self, query):
+        '''Return the size (in bytes) expected for the response to 'query',
+        based on the sizes of the records of that kind received so far.'''
+        limit = re.search(r'limit\s+([0-9]+)', query)
+        count = int(limit.group(1)) if limit else _DEFAULT_LIMIT
+        return count * self._record_sizes.get(result_kind(query), _RECORD_SIZE)
+
+
+    def _record_size(self, kind, count, size):
+        '''Note that a response with 'count' records of the given 'kind' was
+        'size' bytes long.  The largest size per record seen is kept, because
+        underestimating it leads to timeouts.'''
+        if count > 0:
+            per_record = max(self._record_sizes.get(kind, 0), size // count)
+            self._record_sizes[kind] = per_record
 
 
     def _credentials(self, user, pswd):
@@ -323,31 +852,97 @@ class Dimensions(Singleton):
         return query
 
 
+    def set_pool_size(self, pool_size):
+        '''Set the number of connections to Dimensions kept open for reuse.
+        This should be at least the number of threads making calls at the
+        same time.  Queries started with a 'read_ahead' value larger than the
+        pool size increase it as needed.'''
+        with self._login_lock:
+            self._pool_size = pool_size
+            set_pool_size(self._session, pool_size)
+
+
+    def set_base_url(self, url = _BASE_URL):
+        '''Send requests to the Dimensions API server at 'url' instead of the
+        default.  This is mainly for testing with a stand-in for Dimensions
+        such as the one in standin.py.  The initial value is taken from the
+        environment variable SIDEWALL_DIMENSIONS_URL if it is set.  Unless
+        another address has been set using set_network_probe(), this also
+        becomes the address tested by network_available().'''
+        if __debug__: log('using Dimensions API server at {}', url)
+        url = url.rstrip('/')
+        self._auth_url = url + _AUTH_PATH
+        self._dsl_url  = url + _DSL_PATH
+        set_probe_default(url)
+
+
     def _init_cache(self):
-        self._cache = dict()
+        self._cache = ObjectCache(max_items = _CACHE_MAX_ITEMS)
+        # Each query gets its own cache scope for the objects it creates.
+        self._scopes = itertools.count(1)
+
+
+    def _new_scope(self):
+        return next(self._scopes)
+
+
+    def set_cache_limits(self, max_items = _CACHE_MAX_ITEMS, max_bytes = None):
+        '''Set the maximum number of items and/or the maximum (estimated)
+        number of bytes of data kept in the in-memory cache.  When either
+        limit is exceeded, the least-recently used items are dropped.  A
+        value of None for either limit means there is no limit of that kind.
+        '''
+        self._cache.set_limits(max_items, max_bytes)
+
 
+    def use_disk_cache(self, path, ttl = None):
+        '''Save the results of Dimensions searches in the SQLite database file
+        at 'path', and reuse them in this and later runs.  Record searches
+        (done behind the scenes to fill in object values) and pages of query
+        results are both saved.  If 'path' is None, stop using a disk cache.
 
-    def _clear_cache(self):
-        for key in list(self._cache.keys()):
-            if not objattr(self._cache[key], 'persistable', False):
-                del self._cache[key]
+        Entries expire after a time-to-live given by 'ttl'.  It can be a
+        number of seconds applied to all results, or a dict mapping result
+        types (e.g., 'publications', 'researchers') to seconds.  A value of
+        None in the dict means results of that type never expire.
+        '''
+        if self._disk_cache is not None:
+            self._disk_cache.close()
+            self._disk_cache = None
+        if path:
+            if __debug__: log('using disk cache {}', path)
+            self._disk_cache = DiskCache(path, ttl)
 
 
     def cache_stats(self):
-        return {'total_items': len(self._cache)}
+        stats = self._cache.stats()
+        if self._disk_cache is not None:
+            stats['disk_items'] = len(self._disk_cache)
+        return stats
 
 
-    def factory(self, cls, data, creator):
+    def factory(self, cls, data, creator, scope = None):
+        # Objects that aren't Persistable are cached in the scope of the query
+        # that created them, directly or through the object 'creator'.
+        if scope is None and isinstance(creator, DimensionsCore):
+            scope = objattr(creator, '_scope')
         dim_id = dimensions_id(data)
-        if dim_id in self._cache:
-            if __debug__: log('returning cached object for "{}"', dim_id)
-            return self._cache[dim_id]
-        if __debug__: log('creating new {} object for "{}"', cls.__name__, dim_id)
-        new_obj = cls(data, creator = creator, dimensions_obj = self)
-        if __debug__: log('object {} has class {}', id(new_obj), cls.__name__)
-        if dim_id:
-            self._cache[dim_id] = new_obj
-        return new_obj
+        # The lock ensures that threads creating objects for the same id at
+        # the same time all end up with the same object.  Creating an object
+        # doesn't involve network access, so the lock isn't held for long.
+        with self._object_lock:
+            cached = self._cache.get(dim_id, scope = scope) if dim_id else None
+            if cached is not None:
+                if __debug__: log('returning cached object for "{}"', dim_id)
+                return cached
+            if __debug__: log('creating new {} object for "{}"', cls.__name__, dim_id)
+            new_obj = cls(data, creator = creator, dimensions_obj = self)
+            set_objattr(new_obj, '_scope', scope)
+            if __debug__: log('object {} has class {}', id(new_obj), cls.__name__)
+            if dim_id:
+                self._cache.put(dim_id, new_obj, scope)
+                self._filler.add(new_obj)
+            return new_obj
 
 
     def _request_error_msg(self, resp):
@@ -367,7 +962,7 @@ class Dimensions(Singleton):
         return text
 
 
-class queryresults(Iterator):
+class queryresults(Iterator, Exportable):
     '''Results of a Dimensions query executed by Sidewall.  Instances of this
     class behave like iterators. They also have the following additional
     properties:
@@ -375,10 +970,45 @@ class queryresults(Iterator):
      'query': the original query string issued to dimensions.query(...)
      'limit_results': the limit on number of results set in the original query
      'total_count': the number of results returned by Dimensions
+
+    If the query was started with a 'read_ahead' value, pages of results are
+    fetched in a background thread.  Calling close() (or using the object in
+    a "with" statement) stops the background fetches.
+
+    If 'initial_stream' is given, the query was started with stream = True.
+    'initial_data' then holds the part of the first page received so far,
+    'initial_stream' produces the rest of it, and the other pages are
+    streamed too.
+
+    If 'deadline' is given, it is the value of time.perf_counter() by which
+    all pages must have been obtained.
+
+    If 'start' is given, 'initial_data' is the page of results starting at
+    that position rather than the first page, without its first 'offset'
+    results.  This is used by Dimensions.resume().
+
+    If 'auto_fetch' is True, 'fetch_size' is the size of the first page, and
+    the sizes of the following pages are chosen by an _AutoFetchSize object
+    using the time taken by the pages fetched so far.
+
+    If 'raw' is True, the results are the records from Dimensions as dicts,
+    rather than objects.
+
+    The method cursor() returns the position reached in the results, which
+    checkpoint() can save to a file as the iteration proceeds.  The methods
+    iter_batches(), to_csv() and to_parquet() convert the results into
+    columns of values (see export.py).
+
+    The objects created for the results, other than Persistable ones, are
+    cached in a cache scope of their own (see cache.py), which is dropped
+    when this object is garbage-collected.  This keeps queries done at the
+    same time in different threads from dropping each other's objects.
     '''
 
     def __init__(self, dim, orig_query, expanded_query, limit_results, total,
-                 initial_data, result_type, fetch_size):
+                 initial_data, result_type, fetch_size, read_ahead = 0,
+                 initial_stream = None, deadline = None, start = 0, offset = 0,
+                 auto_fetch = False, raw = False):
         if not isinstance(dim, Dimensions):
             raise TypeError('First argument must be a Dimensions object')
 
@@ -391,31 +1021,359 @@ class queryresults(Iterator):
         self._dimensions     = dim
         self._expanded_query = expanded_query
         self._initial_data   = initial_data
+        self._initial_stream = initial_stream
+        self._stream         = initial_stream is not None
         self._result_type    = result_type
         self._fetch_size     = fetch_size
+        self._read_ahead     = read_ahead
+        self._deadline       = deadline
+        self._start          = start
+        self._returned       = start + offset
+        self._page_bounds    = deque([(start, fetch_size)])
+        self._sizer          = _AutoFetchSize(fetch_size) if auto_fetch else None
+        self._checkpoint     = None
+        self._raw            = raw
         self._new            = _KNOWN_RESULT_TYPES[result_type].objclass
+        self._prefetch       = []
+        self._scope          = dim._new_scope()
         self._iterator       = self._results_iterator()
+        weakref.finalize(self, dim._cache.clear_scoped, self._scope)
+
+
+    def prefetch(self, fields):
+        '''Arrange for the values of the named 'fields' to be filled in for
+        all objects of each page of results at once, before the objects are
+        returned.  This replaces many separate behind-the-scenes searches
+        done as fields are accessed with a few batched searches per page.
+        Field names can be dotted paths to reach into objects in lists; for
+        example, 'authors.orcid' for publications.  Returns this object, so
+        that calls can be chained.
+        '''
+        if self._raw and fields:
+            raise RequestError('Cannot use both raw and prefetch')
+        self._prefetch = list(fields)
+        return self
+
+
+    def cursor(self):
+        '''Return a Cursor object for the current position in the results.
+        Passing it to dimensions.resume() continues the iteration from here,
+        without fetching the pages of results already done.'''
+        # The first of _page_bounds is the page being used, unless we've
+        # used all of it and not yet asked for the next one.
+        (page_start, size) = self._page_bounds[0] if self._page_bounds else (0, 0)
+        if self._returned >= page_start + size:
+            page_start = self._returned
+        return Cursor(self.query, self._expanded_query, self._result_type,
+                      self._next_fetch_size(), page_start,
+                      self._returned - page_start, self.total_count,
+                      self.limit_results)
+
+
+    def checkpoint(self, path, pages = 1):
+        '''Save the cursor for these results (see cursor()) in the file 'path'
+        each time 'pages' pages of results have been used, and also if the
+        iteration fails with an exception.  Returns this object, so that
+        calls can be chained.'''
+        self._checkpoint = (path, pages)
+        return self
 
 
     def _results_iterator(self):
-        skip = 0
-        data = self._initial_data
-        while skip < self.total_count:
-            for record in data[self._result_type]:
-                obj_id = record['id']
-                if obj_id in self._dimensions._cache:
-                    if __debug__: log('returning cached copy of {}', obj_id)
-                    yield self._dimensions._cache[obj_id]
+        pages_done = 0
+        try:
+            for objects in self._page_objects_iterator():
+                for obj in objects:
+                    if self._returned >= self.total_count:
+                        break
+                    self._returned += 1
+                    yield obj
+                # We only get here when the caller asks for the object after
+                # the last one of the page, so the whole page has been used.
+                pages_done += 1
+                if self._page_bounds:
+                    self._page_bounds.popleft()
+                if self._returned >= self.total_count:
+                    break
+                if self._checkpoint and pages_done % self._checkpoint[1] == 0:
+                    self.cursor().save(self._checkpoint[0])
+        except Exception:
+            if self._checkpoint:
+                self.cursor().save(self._checkpoint[0])
+            raise
+        if self._checkpoint:
+            self.cursor().save(self._checkpoint[0])
+
+
+    def _page_objects_iterator(self):
+        dim = self._dimensions
+        if self._stream and self._raw:
+            yield from self._streamed_pages()
+        elif self._stream and not self._prefetch:
+            # Create the objects as their records arrive.
+            for records in self._streamed_pages():
+                yield (dim.factory(self._new, record, dim, self._scope)
+                       for record in records)
+        else:
+            for data in self._pages():
+                # Create all the objects for this page before returning any,
+                # so that fill searches can be batched across the whole page.
+                objects = self._page_objects(data)
+                if self._prefetch:
+                    dim._filler.prefetch(objects, self._prefetch)
+                yield objects
+
+
+    def _pages(self):
+        if self._stream:
+            first_page = {self._result_type: list(self._initial_records())}
+        else:
+            first_page = self._initial_data
+        if self._read_ahead > 0:
+            yield from self._background_pages(first_page, self._page_queries())
+        else:
+            yield first_page
+            for query in self._page_queries():
+                if self._stream:
+                    started = perf_counter()
+                    stream = self._dimensions._post_stream(query, self._result_type,
+                                                           self._deadline)
+                    records = list(_records(stream, self._result_type))
+                    self._measure(len(records), perf_counter() - started)
+                    yield {self._result_type: records}
                 else:
-                    if __debug__: log('caching {}', obj_id)
-                    new_object = self._new(record, creator = self._dimensions)
-                    self._dimensions._cache[obj_id] = new_object
-                    yield new_object
-            skip += self._fetch_size
-            query = (self._expanded_query + ' limit ' + str(self._fetch_size)
-                     + ' skip ' + str(skip))
-            data = self._dimensions._post(query)
-        raise StopIteration
+                    yield self._fetched_page(query)
+
+
+    def _streamed_pages(self):
+        yield self._initial_records()
+        for query in self._page_queries():
+            stream = self._dimensions._post_stream(query, self._result_type,
+                                                   self._deadline)
+            yield self._measured(_records(stream, self._result_type))
+
+
+    def _initial_records(self):
+        received = self._initial_data[self._result_type]
+        rest = _records(self._initial_stream, self._result_type)
+        return itertools.chain(received, rest)
+
+
+    def _page_queries(self):
+        # The skip value advances by the size of each page actually asked
+        # for, because with auto_fetch, page sizes vary.
+        skip = self._start + self._fetch_size
+        while skip < self.total_count:
+            size = min(self._next_fetch_size(), self.total_count - skip)
+            self._page_bounds.append((skip, size))
+            yield self._expanded_query + ' limit ' + str(size) + ' skip ' + str(skip)
+            skip += size
+
+
+    def _next_fetch_size(self):
+        return self._sizer.size if self._sizer else self._fetch_size
+
+
+    def _fetched_page(self, query):
+        '''Post the 'query' for a page of results and return the data.'''
+        started = perf_counter()
+        data = self._dimensions._post(query, self._deadline)
+        self._measure(len(data.get(self._result_type, [])), perf_counter() - started)
+        return data
+
+
+    def _measured(self, records):
+        # Measure the time taken by a streamed page.  This includes the time
+        # the caller spends on the records, so it errs on the side of caution.
+        started = perf_counter()
+        count = 0
+        for record in records:
+            count += 1
+            yield record
+        self._measure(count, perf_counter() - started)
+
+
+    def _measure(self, count, seconds):
+        if self._sizer:
+            record_size = self._dimensions._record_sizes.get(self._result_type)
+            self._sizer.record(count, seconds, record_size or _RECORD_SIZE)
+
+
+    def _background_pages(self, first_page, queries):
+        # A background thread fetches pages and puts them on a queue.  The
+        # semaphore keeps it from getting more than _read_ahead pages ahead of
+        # us, and the event tells it to stop when we're closed.
+        pages = queue.Queue()
+        slots = threading.Semaphore(self._read_ahead)
+        stop = threading.Event()
+
+        def fetch_pages():
+            try:
+                for query in queries:
+                    while not slots.acquire(timeout = 0.1):
+                        if stop.is_set():
+                            return
+                    if stop.is_set():
+                        return
+                    pages.put((self._fetched_page(query), None))
+            except Exception as ex:
+                pages.put((None, ex))
+            pages.put((None, None))
+
+        thread = threading.Thread(target = fetch_pages, daemon = True)
+        thread.start()
+        try:
+            yield first_page
+            while True:
+                data, error = pages.get()
+                if error:
+                    raise error
+                if data is None:
+                    return
+                slots.release()
+                yield data
+        finally:
+            if __debug__: log('stopping background page fetches')
+            stop.set()
+
+
+    def _page_objects(self, data):
+        if self._raw:
+            return data[self._result_type]
+        dim = self._dimensions
+        return [dim.factory(self._new, record, dim, self._scope)
+                for record in data[self._result_type]]
+
+
+    def __len__(self):
+        return self.total_count
+
+
+    def __iter__(self):
+        return self
+
+
+    def __next__(self):
+        return next(self._iterator)
+
+
+    def close(self):
+        '''Stop iterating and cancel any pending background page fetches.'''
+        self._iterator.close()
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class _AutoFetchSize(object):
+    '''Chooses the sizes of pages of results for fetch_size = 'auto'.  Each
+    page costs one unit of the rate limit whatever its size, so pages should
+    be as large as possible, but a page must arrive well within the longest
+    timeout allowed by the current AdaptiveTimeout object (see timeouts.py),
+    and shouldn't take up too much memory.  The size can double from one page
+    to the next, and drops at once if a page turns out to be too slow.'''
+
+    def __init__(self, size):
+        self.size = size
+
+
+    def record(self, count, seconds, record_size):
+        '''Note that a page of 'count' results took 'seconds' to get, where a
+        result takes 'record_size' bytes.'''
+        if count == 0:
+            return
+        timeouts = current_timeouts()
+        # The time per result includes the fixed cost of a request, so this
+        # underestimates how many results fit in the time, which is safe.
+        by_time = timeouts.maximum / timeouts.factor / max(seconds / count, 1e-6)
+        by_bytes = _AUTO_MAX_BYTES / record_size
+        best = min(_MAX_FETCH_SIZE, by_time, by_bytes, 2 * self.size)
+        self.size = max(1, int(best))
+        if __debug__: log('page of {} took {:.2f} s; next fetch size {}',
+                          count, seconds, self.size)
+
+
+class partitionedresults(Iterator, Exportable):
+    '''Results of a query executed by Dimensions.partitioned_query().  This
+    behaves like an iterator, and has the properties 'query',
+    'limit_results' and 'total_count' like queryresults.  The property
+    'partitions' is the list of queryresults objects of the partitions that
+    have results.  Partitions are iterated over in threads run by
+    'executor', and the objects they produce are handed over through a
+    queue.  Calling close() (or using the object in a "with" statement) stops
+    the iteration of the partitions.  The results can be exported like those
+    of queryresults (see export.py).
+    '''
+
+    def __init__(self, dim, orig_query, result_type, partitions, limit_results,
+                 executor):
+        total = sum(results.total_count for results in partitions)
+        if limit_results and limit_results < total:
+            total = limit_results
+
+        # Attributes we expose
+        self.query         = orig_query
+        self.total_count   = total
+        self.limit_results = limit_results
+        self.partitions    = partitions
+
+        # Internal attributes.
+        self._dimensions   = dim
+        self._executor     = executor
+        self._new          = _KNOWN_RESULT_TYPES[result_type].objclass
+        self._items        = queue.Queue(maxsize = 2 * len(partitions) + 1)
+        self._stop         = threading.Event()
+        for results in partitions:
+            executor.submit(self._drain, results)
+        self._iterator     = self._results_iterator()
+
+
+    def _drain(self, results):
+        # Runs in a worker thread.  Each partition ends with (None, None) or
+        # (None, exception), so that we know when they're all done.
+        try:
+            for obj in results:
+                if not self._put((obj, None)):
+                    results.close()
+                    return
+        except Exception as ex:
+            self._put((None, ex))
+            return
+        self._put((None, None))
+
+
+    def _put(self, item):
+        while not self._stop.is_set():
+            try:
+                self._items.put(item, timeout = 0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+
+    def _results_iterator(self):
+        remaining = len(self.partitions)
+        count = 0
+        try:
+            while remaining > 0 and count < self.total_count:
+                obj, error = self._items.get()
+                if error:
+                    raise error
+                if obj is None:
+                    remaining -= 1
+                    continue
+                count += 1
+                yield obj
+        finally:
+            if __debug__: log('stopping partition fetches')
+            self._stop.set()
+            self._executor.shutdown(wait = False)
 
 
     def __len__(self):
@@ -429,6 +1387,69 @@ class queryresults(Iterator):
     def __next__(self):
         return next(self._iterator)
 
+
+    def close(self):
+        '''Stop iterating and stop fetching the results of the partitions.'''
+        self._iterator.close()
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *args):
+        self.close()
+
+
+# Utility functions
+# .............................................................................
+
+def _records(stream, result_type):
+    '''Return a generator of the records in the (key, value) pairs produced
+    by the generator 'stream' (see Dimensions._post_stream()).'''
+    return (value for key, value in stream if key == result_type)
+
+
+def _ordinal(value):
+    '''Return the integer used for 'value' (an integer or a date) when
+    dividing ranges of values for partitioned queries.'''
+    return value.toordinal() if isinstance(value, date) else int(value)
+
+
+def _range_condition(field, low, high, dates):
+    '''Return a DSL condition for 'field' having a value between the
+    ordinals 'low' and 'high' (inclusive), which are dates if 'dates' is True.'''
+    if dates:
+        (low, high) = ('"{}"'.format(date.fromordinal(n).isoformat())
+                       for n in (low, high))
+    if low == high:
+        return '{} = {}'.format(field, low)
+    return '{0} >= {1} and {0} <= {2}'.format(field, low, high)
+
+
+def _partition_query(query_string, condition):
+    '''Return 'query_string' with 'condition' added to its "where" clause.'''
+    ret = list(re.finditer(r'\s+return\s+', query_string))[-1]
+    (head, tail) = (query_string[:ret.start()], query_string[ret.start():])
+    where = re.search(r'\swhere\s', head)
+    if where:
+        head = '{}({}) and {}'.format(head[:where.end()], head[where.end():].strip(),
+                                      condition)
+    else:
+        head = '{} where {}'.format(head, condition)
+    return head + tail
+
+
+def token_expiry(token):
+    '''Return the expiration time (in seconds since the epoch) given by the
+    "exp" claim of the JSON Web Token 'token', or None if it has none.'''
+    try:
+        payload = token.split('.')[1]
+        payload += '=' * (-len(payload) % 4)
+        return float(jsonlib.loads(base64.urlsafe_b64decode(payload))['exp'])
+    except (IndexError, ValueError, KeyError, TypeError):
+        return None
+
 
 # Main entry point.
 # .............................................................................
@@ -45,3 +45,7 @@ class DataMismatch(Exception):
 class RequestError(Exception):
     '''Problem with the Dimensions query or request.'''
     pass
+
+class DeadlineExceeded(Exception):
+    '''An operation could not be completed within the time allowed for it.'''
+    pass
@@ -0,0 +1,230 @@
+'''
+export.py: columnar export of the results of Dimensions queries
+
+Putting a large number of results into a data frame or a file by iterating
+over Sidewall objects and reading their fields is slow: every object is
+created and cached, and reading fields can make Sidewall expand objects and
+do additional searches to fill in values.  The class Exportable in this
+module is a mixin for the classes of query results that adds methods to
+convert the results directly into columns of values, one batch of results
+at a time, so that memory use does not depend on the number of results:
+
+    iter_batches(n):  generator of dicts mapping column names to lists of
+                      the values of up to n results
+    to_csv(path):     write the results to the CSV file 'path'
+    to_parquet(path): write the results to the Parquet file 'path'
+
+The columns are the fields of the object class of the results (e.g.,
+Publication) that are set from the records returned by Dimensions, in the
+order in which the class lists them, and their values are those Sidewall
+would give the fields of new objects, without any additional searches.
+Lists of plain values (e.g., the "references" of a publication) are joined
+into one string using "; ", objects (e.g., the "journal" of a publication)
+are represented by their identifiers, and missing values are None.  The
+conversion is fastest when the query is started with raw = True, so that no
+objects are created at all.
+
+Writing Parquet files requires the package PyArrow (https://arrow.apache.org),
+which is not otherwise needed by Sidewall and is not installed with it.
+
+Authors
+-------
+
+Michael Hucka <mhucka@caltech.edu> -- Caltech Library
+
+Copyright
+---------
+
+Copyright (c) 2019 by the California Institute of Technology.  This code is
+open-source software released under a 3-clause BSD license.  Please see the
+file "LICENSE" for more information.
+'''
+
+import csv
+
+from .core import DimensionsCore
+from .data_helpers import objattr
+from .debug import log
+from .exceptions import RequestError
+
+
+# Constants.
+# .............................................................................
+
+_BATCH_SIZE = 1000
+'''Default number of results per batch.'''
+
+_SEPARATOR = '; '
+'''String used to join the items of lists of plain values.'''
+
+
+# Classes.
+# .............................................................................
+
+class Exportable(object):
+    '''Mixin for classes of query results.  Classes using it must be
+    iterators over results that are objects of the class given by their
+    attribute '_new', or records (dicts) for objects of that class.
+    Exporting results consumes them, like iterating over them does.'''
+
+    def iter_batches(self, n = _BATCH_SIZE):
+        '''Return a generator of dicts, each mapping the names of the columns
+        for these results to lists of the values of the next 'n' results.'''
+        columns = export_columns(self._new)
+        for rows in self._row_batches(n):
+            yield dict(zip(columns, (list(values) for values in zip(*rows))))
+
+
+    def to_csv(self, path, n = _BATCH_SIZE):
+        '''Write the results to the CSV file 'path', with a header line giving
+        the names of the columns.  The results are converted 'n' at a time.
+        Returns the number of results written.'''
+        if __debug__: log('writing results to CSV file {}', path)
+        count = 0
+        with open(path, 'w', newline = '') as f:
+            writer = csv.writer(f)
+            writer.writerow(export_columns(self._new))
+            for rows in self._row_batches(n):
+                writer.writerows(rows)
+                count += len(rows)
+        return count
+
+
+    def to_parquet(self, path, n = _BATCH_SIZE, schema = None):
+        '''Write the results to the Parquet file 'path', converting them 'n'
+        at a time into row groups.  Unless a pyarrow.Schema is given as
+        'schema', the type of each column is chosen using the values in the
+        first batch: numbers are written as floating-point values (because
+        Dimensions gives some fields as integers in some records and as
+        fractions in others), and columns with no values are strings.
+        Returns the number of results written.  Requires the package PyArrow.'''
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise RequestError('Writing Parquet files requires the package pyarrow')
+        if __debug__: log('writing results to Parquet file {}', path)
+        count = 0
+        writer = None
+        kinds = None
+        try:
+            for batch in self.iter_batches(n):
+                if schema is None:
+                    kinds = {column: _kind(values) for column, values in batch.items()}
+                    schema = pyarrow.schema([(column, _arrow_type(pyarrow, kind))
+                                             for column, kind in kinds.items()])
+                if writer is None:
+                    writer = pyarrow.parquet.ParquetWriter(path, schema)
+                if kinds:
+                    batch = {column: [_converted(value, kinds[column]) for value in values]
+                             for column, values in batch.items()}
+                writer.write_table(pyarrow.Table.from_pydict(batch, schema = schema))
+                count += len(next(iter(batch.values()), []))
+            if writer is None:
+                # No results, but write a valid file with the column names.
+                if schema is None:
+                    schema = pyarrow.schema([(column, pyarrow.string())
+                                             for column in export_columns(self._new)])
+                writer = pyarrow.parquet.ParquetWriter(path, schema)
+        finally:
+            if writer is not None:
+                writer.close()
+        return count
+
+
+    def _row_batches(self, n):
+        # Produces lists of up to 'n' rows, each a list of column values.
+        cls = self._new
+        columns = export_columns(cls)
+        rows = []
+        for result in self:
+            rows.append(_row(result, cls, columns))
+            if len(rows) >= n:
+                yield rows
+                rows = []
+        if rows:
+            yield rows
+
+
+class _Holder(object):
+    '''Object on which the _set_attributes() method of a class of Sidewall
+    objects can set values, without the overhead of a real object.'''
+    pass
+
+
+# Exported functions.
+# .............................................................................
+
+def export_columns(cls):
+    '''Return the list of the names of the columns exported for results that
+    are objects of class 'cls'.'''
+    if cls not in _columns:
+        holder = _Holder()
+        cls._set_attributes(holder, {}, overwrite = True)
+        _columns[cls] = [attr for attr in dict.fromkeys(cls._attributes)
+                         if attr in holder.__dict__]
+    return _columns[cls]
+
+
+# Helper functions.
+# .............................................................................
+
+def _row(result, cls, columns):
+    '''Return the list of column values for 'result', which is either an
+    object of class 'cls' or a record for one.'''
+    if not isinstance(result, DimensionsCore):
+        record = result
+        result = _Holder()
+        cls._set_attributes(result, record, overwrite = True)
+    # objattr() reads the values without triggering expansion or filling.
+    return [_plain(objattr(result, column, None)) for column in columns]
+
+
+def _plain(value):
+    '''Return the column value for the field value 'value'.'''
+    if isinstance(value, DimensionsCore):
+        value = objattr(value, 'id', None)
+    elif isinstance(value, list):
+        if not all(isinstance(item, (str, int, float)) for item in value):
+            return None
+        value = _SEPARATOR.join(str(item) for item in value)
+    elif isinstance(value, dict):
+        return None
+    return None if value == '' else value
+
+
+def _kind(values):
+    '''Return the kind of column ('str', 'bool' or 'float') for 'values'.'''
+    kinds = set(type(value) for value in values if value is not None)
+    if kinds == {bool}:
+        return 'bool'
+    if kinds and kinds <= {int, float}:
+        return 'float'
+    return 'str'
+
+
+def _arrow_type(pyarrow, kind):
+    '''Return the PyArrow type for the given kind of column.'''
+    if kind == 'bool':
+        return pyarrow.bool_()
+    if kind == 'float':
+        return pyarrow.float64()
+    return pyarrow.string()
+
+
+def _converted(value, kind):
+    '''Return 'value' converted to the given kind of column, or None.'''
+    if value is None:
+        return None
+    if kind == 'str':
+        return str(value)
+    if kind == 'float':
+        return float(value) if isinstance(value, (int, float)) else None
+    return value if isinstance(value, bool) else None
+
+
+# Module variables.
+# .............................................................................
+
+_columns = {}
+'''Cache of the lists of columns for each class, set by export_columns().'''
@@ -0,0 +1,295 @@
+'''
+fill.py: batched searches for filling in missing object field values
+
+As explained in core.py and person.py, Sidewall objects are sometimes
+missing field values that Dimensions can provide if asked in a different
+way.  Doing a separate search for every such object is very costly when
+iterating over many results, because each search counts against the
+Dimensions API rate limit.  For example, iterating over the authors of 1000
+publications can lead to thousands of searches.
+
+The class BatchFiller in this module reduces the number of searches by
+grouping them.  Object classes that support this define a class attribute,
+'_batch_tmpl', containing a search template with a placeholder for a list of
+Dimensions identifiers (e.g., 'researchers where id in [{}] return
+researchers').  As objects of those classes are created, Dimensions registers
+them with the BatchFiller as pending.  When a missing value on one of them
+is needed, the BatchFiller issues one search for that object together with
+other pending objects of the same kind, and hands the records in the
+results to the _fill_record() methods of all those objects.
+
+Some objects are created with nothing but an identifier -- for example, the
+organizations listed for researchers in the results of 'return researchers'
+are only grid id's.  Code that creates such objects can call resolve() to
+fill them in right away using batched searches.  While a batch of search
+results is being applied to objects, calls to resolve() are deferred until
+all the objects in the batch are done, so that the organizations created for
+all of them are resolved together instead of one object at a time.
+
+Finally, prefetch() lets the results iterator in dimensions.py fill in
+selected fields for all the objects of a page of results at once, before any
+of them are handed to the caller.  Fields are named using dotted paths such
+as 'authors.orcid', meaning "the 'orcid' field of every object in the
+'authors' field of each result".
+
+A BatchFiller can be used by several threads at once.  The set of pending
+objects is guarded by a lock, deferral of resolve() calls is tracked per
+thread, and an object that is already part of a batch search being done by
+one thread is not searched for again by another thread; the second thread
+waits for the first one to finish instead.
+
+Authors
+-------
+
+Michael Hucka <mhucka@caltech.edu> -- Caltech Library
+
+Copyright
+---------
+
+Copyright (c) 2019 by the California Institute of Technology.  This code is
+open-source software released under a 3-clause BSD license.  Please see the
+file "LICENSE" for more information.
+'''
+
+from   contextlib import contextmanager
+import string
+import threading
+import weakref
+
+from .cache import result_kind
+from .core import DimensionsCore
+from .data_helpers import objattr, dimensions_id
+from .debug import log
+from .exceptions import RequestError
+
+
+# Constants
+# .............................................................................
+
+_BATCH_SIZE = 100
+'''Maximum number of identifiers put into a single batched search.'''
+
+
+# Classes
+# .............................................................................
+
+class BatchFiller(object):
+    '''Fills in missing values on Sidewall objects using batched searches.'''
+
+    def __init__(self, dimensions, batch_size = _BATCH_SIZE):
+        self._dimensions = dimensions
+        self._batch_size = batch_size
+        # Dict of template -> WeakValueDictionary of id -> object.  Weak
+        # references are used so that being pending doesn't keep objects alive.
+        self._pending = {}
+        # Dict of (template, id) -> Event, for batch searches in progress.
+        self._in_flight = {}
+        self._lock = threading.Lock()
+        # Deferral of resolve() calls applies to the thread doing the deferring.
+        self._local = threading.local()
+
+
+    def add(self, obj):
+        '''Register 'obj' as an object that may need to be filled later.'''
+        tmpl = objattr(obj, '_batch_tmpl', None)
+        obj_id = objattr(obj, 'id', None)
+        if tmpl and obj_id and needs_fill(obj):
+            with self._lock:
+                pending = self._pending.setdefault(tmpl, weakref.WeakValueDictionary())
+                pending[obj_id] = obj
+
+
+    def fill(self, obj):
+        '''Fill in 'obj', along with other pending objects of the same kind.'''
+        tmpl = objattr(obj, '_batch_tmpl')
+        batch = [obj]
+        with self._lock:
+            pending = self._pending.get(tmpl, {})
+            pending.pop(objattr(obj, 'id'), None)
+            while pending and len(batch) < self._batch_size:
+                other = pending.popitem()[1]
+                if needs_fill(other):
+                    batch.append(other)
+        self._fill_batch(tmpl, batch)
+
+
+    def fill_objects(self, objects):
+        '''Fill in all the objects in the list 'objects' that need it, using
+        as few searches as possible.'''
+        by_tmpl = {}
+        seen = set()
+        for obj in objects:
+            tmpl = objattr(obj, '_batch_tmpl', None)
+            if (tmpl and objattr(obj, 'id', None) and needs_fill(obj)
+                and id(obj) not in seen):
+                seen.add(id(obj))
+                by_tmpl.setdefault(tmpl, []).append(obj)
+        for tmpl, batch in by_tmpl.items():
+            with self._lock:
+                pending = self._pending.get(tmpl, {})
+                for obj in batch:
+                    pending.pop(objattr(obj, 'id'), None)
+            for start in range(0, len(batch), self._batch_size):
+                self._fill_batch(tmpl, batch[start : start + self._batch_size])
+
+
+    def resolve(self, objects):
+        '''Fill in 'objects' now using batched searches, or if we are in the
+        middle of applying a batch of results, when that batch is done.'''
+        local = self._local
+        if getattr(local, 'depth', 0) > 0:
+            local.deferred.extend(objects)
+        else:
+            self.fill_objects(objects)
+
+
+    @contextmanager
+    def deferred(self):
+        '''Context manager that postpones resolve() calls made by the current
+        thread until it exits.'''
+        local = self._local
+        if getattr(local, 'depth', 0) == 0:
+            local.depth = 0
+            local.deferred = []
+        local.depth += 1
+        try:
+            yield
+        finally:
+            local.depth -= 1
+            if local.depth == 0 and local.deferred:
+                objects, local.deferred = local.deferred, []
+                self.fill_objects(objects)
+
+
+    def prefetch(self, objects, fields):
+        '''Expand and fill in the named 'fields' on all of the 'objects'.
+        Each field name can be a dotted path (e.g., 'authors.orcid').'''
+        with self.deferred():
+            for path in fields:
+                current = objects
+                for attr in path.split('.'):
+                    current = self._prefetch_attr(current, attr)
+
+
+    def _prefetch_attr(self, objects, attr):
+        # Lazy expansion is local and cheap, so do that for all objects first.
+        # Then fill the ones that are still missing values, in bulk.
+        to_fill = []
+        for obj in objects:
+            if (attr not in objattr(obj, '_attributes')
+                and not hasattr(type(obj), attr)):
+                raise RequestError('{} objects have no field "{}"'
+                                   .format(type(obj).__name__, attr))
+            objattr(obj, '_expand')()
+            if (not objattr(obj, attr, None)
+                and attr not in objattr(obj, '_attributes_done')):
+                to_fill.append(obj)
+        if to_fill:
+            if __debug__: log('prefetching "{}" on {} objects', attr, len(to_fill))
+            self.fill_objects(to_fill)
+        # Return the values of the field, flattening lists, for the next step.
+        values = []
+        for obj in objects:
+            value = getattr(obj, attr)
+            if isinstance(value, list):
+                values += [item for item in value if isinstance(item, DimensionsCore)]
+            elif isinstance(value, DimensionsCore):
+                values.append(value)
+        return values
+
+
+    def _fill_batch(self, tmpl, batch):
+        # Claim the ids in the batch that no other thread is searching for.
+        # The objects whose ids are claimed by others are filled after those
+        # other threads are done, normally from the records they cached.
+        mine, theirs, claimed = [], [], {}
+        with self._lock:
+            for obj in batch:
+                key = (tmpl, objattr(obj, 'id'))
+                if key in claimed:
+                    mine.append(obj)
+                elif key in self._in_flight:
+                    theirs.append((obj, self._in_flight[key]))
+                else:
+                    claimed[key] = self._in_flight[key] = threading.Event()
+                    mine.append(obj)
+        try:
+            if mine:
+                self._search_and_fill(tmpl, mine)
+        finally:
+            with self._lock:
+                for key, event in claimed.items():
+                    del self._in_flight[key]
+                    event.set()
+        for obj, event in theirs:
+            if __debug__: log('waiting on another thread to fill {}', id(obj))
+            event.wait()
+            if needs_fill(obj):
+                self._fill_batch(tmpl, [obj])
+
+
+    def _search_and_fill(self, tmpl, batch):
+        dim = self._dimensions
+        kind = result_kind(tmpl)
+        records = {}
+        to_search = []
+        for obj in batch:
+            obj_id = objattr(obj, 'id')
+            if obj_id in records or obj_id in to_search:
+                continue
+            record = dim._cache.get(record_key(tmpl, obj_id))
+            if record is None and dim._disk_cache is not None:
+                record = dim._disk_cache.get(record_key(tmpl, obj_id), kind)
+            if record is None:
+                to_search.append(obj_id)
+            else:
+                records[obj_id] = record
+
+        if to_search:
+            if __debug__: log('batch search for {} ids', len(to_search))
+            id_list = ', '.join('"{}"'.format(obj_id) for obj_id in to_search)
+            search = 'search ' + tmpl.format(id_list) + ' limit ' + str(len(to_search))
+            data = dim._post(search)
+            found = {dimensions_id(rec): rec for rec in data.get(kind, [])}
+            for obj_id in to_search:
+                # Ids without a record get an empty one, so we don't search again.
+                record = found.get(obj_id, {})
+                key = record_key(tmpl, obj_id)
+                dim._cache[key] = record
+                if dim._disk_cache is not None:
+                    dim._disk_cache.put(key, record, kind)
+                records[obj_id] = record
+
+        with self.deferred():
+            for obj in batch:
+                fill_object(obj, records[objattr(obj, 'id')])
+
+
+# Utility functions
+# .............................................................................
+
+def needs_fill(obj):
+    '''Return True if 'obj' has attributes that have not been filled yet.'''
+    done = objattr(obj, '_attributes_done')
+    return any(attr not in done for attr in objattr(obj, '_attributes'))
+
+
+def id_only(obj):
+    '''Return True if 'obj' was created from data holding only an id.'''
+    return set(objattr(obj, '_orig_data').keys()) <= {'id'}
+
+
+def fill_object(obj, record):
+    '''Apply the search result 'record' to 'obj', expanding it first if it has
+    not been expanded yet so that expansion doesn't overwrite filled values.'''
+    objattr(obj, '_expand')()
+    objattr(obj, '_apply_fill')(record)
+
+
+def record_key(tmpl, obj_id):
+    '''Return the key used to cache the record for 'obj_id' found by 'tmpl'.'''
+    search = 'search ' + tmpl.format('"{}"'.format(obj_id))
+    return search.translate(_strip_whitespace)
+
+
+_strip_whitespace = str.maketrans('', '', string.whitespace)
@@ -26,6 +26,7 @@ from .country      import Country
 from .data_helpers import objattr, set_objattr, new_object
 from .debug        import log
 from .exceptions   import DataMismatch
+from .fill         import id_only
 from .organization import Organization
 from .researcher   import Researcher
 from .state        import State
@@ -123,6 +124,14 @@ class Grant(DimensionsCore, Persistable):
                     if res_org.id == aff_org['id']:
                         res_org._set_attributes(aff_org, overwrite = False)
 
+        # Organizations for which we still only have an id get filled in bulk.
+        dimensions = objattr(self, '_dimensions')
+        if dimensions:
+            bare = [org for org in objattr(self, 'funders') + research_orgs
+                    if id_only(org)]
+            if bare:
+                dimensions.resolve(bare)
+
 
     def _fill_record(self, data):
         # Be careful not to invoke "self.x" b/c it causes infinite recursion.
@@ -5,17 +5,72 @@ About rate limit tracking
 -------------------------
 
 All network calls in Sidewall use net(), which itself funnels all calls to a
-single function, timed_request().  Rate limits are tracked using the counting
-code in ratelimit.py and a Python decorator around timed_request().  However,
+single function, timed_request().  That function hands the actual network
+operation to the current transport object (see "About transports" below).
+Rate limits are tracked using the counting code in ratelimit.py, by the
+function used by the normal transport.  However,
 the Dimensions rate limit is counted per IP address, and there's just no way
 to track if the user is doing things like starting/restarting a program or
 running multiple programs.  This means that in addition to the direct
 tracking done for timed_request() (which helps for long-running single
 programs), the code in net() also detects when a rate limit is hit despite
-our efforts.  If the limit is hit, then the code uses a geometric
-back-off-and-retry strategy.  This is necessary because the Dimensions API
-doesn't offer any way to find out the time remaining in the rate limit time
-window -- or really any info at all about the status of the rate limit.
+our efforts.  If the limit is hit, then the code backs off and retries
+according to the current retry policy (see retry.py).  This is necessary
+because the Dimensions API doesn't offer any way to find out the time
+remaining in the rate limit time window -- or really any info at all about
+the status of the rate limit.
+
+To coordinate multiple programs running on the same computer, set the
+environment variable SIDEWALL_RATE_LIMIT_FILE to the path of a file.  All
+Sidewall processes that use the same file then share one rate limit (see
+SharedRateLimit in ratelimit.py).
+
+The rate limit above is based on observations made in 2019.  To have
+Sidewall learn the actual limit instead, set the environment variable
+SIDEWALL_ADAPTIVE_RATE_FILE to the path of a file.  The allowed rate is then
+raised gradually while calls succeed and lowered when Dimensions returns
+code 429, and the learned rate is saved in the file for the next run.  The
+rate is never raised above the limit stated in the Dimensions documentation.
+
+About transports
+----------------
+
+The object that performs network operations for timed_request() is called a
+transport.  The default transport, LiveTransport, uses the requests package.
+Other transports can be installed using set_transport(); for example,
+cassette.py provides transports that record network interactions in a file
+and replay them later without network access.  A transport has a method
+request(get_or_post, url, session, deadline = None, **kwargs) that returns
+a requests Response object, and an attribute 'offline' that is True if the
+transport doesn't use the network (in which case network_available()
+returns True).  The 'deadline' is a value of time.perf_counter() by which
+the request must be made, or None.
+
+About connections
+-----------------
+
+All calls made by Sidewall go through requests.Session objects created by
+new_session().  Sessions keep connections to the server open for reuse (and,
+like all requests sessions, ask for gzip or deflate compression).
+new_session() sets the size of their connection pools, and turns off the
+retries done by the requests package itself, since Sidewall does its own
+(see retry.py).  Calls made without a session use a module-level session,
+so they benefit from connection reuse too.  The number of connections kept
+open per host is the pool size; it should be at least the number of threads
+making calls at the same time, or else connections are closed and reopened
+instead of being reused.
+
+About network availability tests
+--------------------------------
+
+Some errors are reported differently depending on whether the network as a
+whole is reachable.  network_available() tests this by opening a TCP
+connection to a probe address (by default, the Dimensions server) and
+remembers the result for a while, so that repeated tests don't cost a round
+trip each.  Use set_network_probe() or the environment variable
+SIDEWALL_NETWORK_PROBE to change the address, or set it to "off" to skip the
+tests entirely, for example on hosts where outgoing connections are blocked
+except to Dimensions.
 
 Authors
 -------
@@ -33,114 +88,202 @@ file "LICENSE" for more information.
 import datetime
 import http.client
 from   http.client import responses as http_responses
+import os
 from   os import path
 import requests
+from   requests.adapters import HTTPAdapter
 from   requests.packages.urllib3.exceptions import InsecureRequestWarning
-from   time import sleep
+from   time import perf_counter
 import shutil
+import socket
 import ssl
-import urllib
-from   urllib import request
+import threading
 from   urllib.parse import urlsplit
 import urllib3
 import validators
 import warnings
 
 from .debug import log
-from .ratelimit import RateLimit, rate_limit
+from .ratelimit import RateLimit, SharedRateLimit
+from .retry import retry_policy, retry_after
+from .timeouts import current_timeouts
 from .exceptions import *
 
 
 # Constants.
 # .............................................................................
 
-_MAX_RECURSIVE_CALLS = 10
-'''How many times can certain network functions call themselves upcon
-encountering a network error before they stop and give up.'''
-
-_MAX_FAILURES = 5
-'''Maximum number of network failures before we give up.'''
+_RETRY_CODES = [202, 429, 502, 503, 504]
+'''HTTP status codes indicating a transient problem worth retrying.'''
 
-_MAX_RETRIES = 5
-'''Maximum number of times we back off and try again.  This also affects the
-maximum wait time that will be reached after repeated retries.'''
+_FATAL_EXCEPTIONS = (requests.exceptions.InvalidSchema,
+                     requests.exceptions.InvalidURL,
+                     requests.exceptions.MissingSchema,
+                     NetworkFailure)
+'''Exceptions that are not worth retrying.'''
 
 # The Dimensions documentation at https://docs.dimensions.ai/dsl/api.html
 # states that the rate limit is 30 calls/minute, but as of today (2019-03-08)
 # I am certain this is not true. I get a code 429 on the 22nd or 23rd call.
+# The documented limit is used as the maximum in adaptive mode.
+
+def _dimensions_rate_limit(max_calls, time_limit, max_rate):
+    '''Return the RateLimit object to use for calls to Dimensions.'''
+    filename = os.environ.get('SIDEWALL_RATE_LIMIT_FILE')
+    rate_file = os.environ.get('SIDEWALL_ADAPTIVE_RATE_FILE')
+    adaptive = bool(rate_file)
+    if filename:
+        try:
+            return SharedRateLimit(max_calls, time_limit, filename, adaptive,
+                                   rate_file, max_rate)
+        except OSError as ex:
+            if __debug__: log('cannot use rate limit file {}: {}', filename, ex)
+    return RateLimit(max_calls, time_limit, adaptive, rate_file, max_rate)
 
-_DIMENSIONS_RATE_LIMIT = RateLimit(22, 60)
+_DIMENSIONS_RATE_LIMIT = _dimensions_rate_limit(22, 60, 30)
 '''Rate limit imposed by Dimensions API service.'''
 
+_POOL_SIZE = 32
+'''Default number of connections per host kept open for reuse.'''
+
+_PROBE_URL = 'https://app.dimensions.ai'
+'''Default address contacted by network_available().'''
+
+_PROBE_TTL = 60
+'''Number of seconds for which a result of network_available() is reused.'''
+
+_PROBE_TIMEOUT = 5
+'''Number of seconds to wait for a connection in network_available().'''
+
 
 # Main functions.
 # .............................................................................
 
+def new_session(pool_size = _POOL_SIZE):
+    '''Return a new requests.Session object set up for use by Sidewall, with
+    a connection pool of 'pool_size' connections per host.'''
+    session = requests.Session()
+    set_pool_size(session, pool_size)
+    return session
+
+
+def set_pool_size(session, pool_size):
+    '''Replace the connection pools of 'session' with ones that can keep
+    'pool_size' connections per host open.'''
+    if __debug__: log('setting connection pool size to {}', pool_size)
+    # Retries are done by us (see retry.py), so the adapter must not retry.
+    adapter = HTTPAdapter(pool_connections = pool_size, pool_maxsize = pool_size,
+                          max_retries = 0)
+    old_adapters = set(session.adapters.values())
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    # Close the replaced pools, so that their connections are not left open.
+    for old in old_adapters:
+        old.close()
+
+
+def set_network_probe(url = None, ttl = _PROBE_TTL, enabled = True):
+    '''Configure network_available().  'url' is the address it tries to
+    connect to (by default, the Dimensions server), 'ttl' is the number of
+    seconds its result is reused, and if 'enabled' is False, no tests are
+    done and the network is assumed to be available.'''
+    with _probe_lock:
+        _probe.update(url = url, ttl = ttl, enabled = enabled,
+                      result = None, time = None)
+
+
+def set_probe_default(url):
+    '''Make 'url' the default address tested by network_available(), which
+    is used unless another one has been set using set_network_probe() or the
+    environment variable SIDEWALL_NETWORK_PROBE.'''
+    global _probe_default
+    with _probe_lock:
+        if _probe['url'] is None:
+            _probe.update(result = None, time = None)
+        _probe_default = url
+
+
 def network_available():
     '''Return True if it appears we have a network connection, False if not.'''
-    r = None
-    try:
-        r = urllib.request.urlopen("http://www.google.com")
-        return True
-    except Exception:
-        if __debug__: log('could not connect to https://www.google.com')
-        return False
-    if r:
-        r.close()
-
-
-@rate_limit(_DIMENSIONS_RATE_LIMIT)
-def timed_request(get_or_post, url, session = None, timeout = 10, **kwargs):
-    '''Perform a network "get" or "post", handling timeouts and retries.
-    If "session" is not None, it is used as a requests.Session object.
-    "Timeout" is a timeout (in seconds) on the network requests get or post.
-    Other keyword arguments are passed to the network call.
-    '''
-    failures = 0
-    retries = 0
-    retry = True
-    error = None
-    while retry and failures < _MAX_FAILURES:
-        retry = False
+    with _probe_lock:
+        if not _probe['enabled'] or _transport.offline:
+            return True
+        now = perf_counter()
+        if _probe['time'] is not None and now - _probe['time'] < _probe['ttl']:
+            return _probe['result']
+        url = _probe['url'] or _probe_default
+        parts = urlsplit(url)
+        port = parts.port or (80 if parts.scheme == 'http' else 443)
         try:
-            with warnings.catch_warnings():
-                # The underlying urllib3 library used by the Python requests
-                # module will issue a warning about missing SSL certificates.
-                # We don't care here.  See also this for a discussion:
-                # https://github.com/kennethreitz/requests/issues/2214
-                warnings.simplefilter("ignore", InsecureRequestWarning)
-                if __debug__: log('doing http {} on {}', get_or_post, url)
-                if session:
-                    method = getattr(session, get_or_post)
-                else:
-                    method = requests.get if get_or_post == 'get' else requests.post
-                response = method(url, timeout = timeout, verify = False, **kwargs)
-                if __debug__: log('received {} bytes', len(response.content))
-                return response
-        except Exception as ex:
-            # Problem might be transient.  Don't quit right away.
-            if __debug__: log('timed_request() exception: {}', str(ex))
-            failures += 1
-            retry = True
-            # Record the first error we get, not the subsequent ones, because
-            # in the case of network outages, the subsequent ones will be
-            # about being unable to connect and not the original problem.
-            if not error:
-                error = ex
-        if failures >= _MAX_FAILURES:
-            # Try pause & continue, in case of transient network issues.
-            if retries < _MAX_RETRIES:
-                retries += 1
-                if __debug__: log('pausing because of consecutive failures')
-                sleep(60 * retries)
-                failures = 0
-                retry = True
+            with socket.create_connection((parts.hostname, port), _PROBE_TIMEOUT):
+                result = True
+        except (OSError, ValueError):
+            if __debug__: log('could not connect to {}', url)
+            result = False
+        _probe.update(result = result, time = perf_counter())
+        return result
+
+
+def set_transport(transport):
+    '''Make 'transport' the object used to perform network operations.  If
+    'transport' is None, the default (LiveTransport) is used.'''
+    global _transport
+    _transport = transport or LiveTransport()
+
+
+def current_transport():
+    '''Return the object currently used to perform network operations.'''
+    return _transport
+
+
+def timed_request(get_or_post, url, session = None, timeout = None,
+                  deadline = None, expected_size = None, **kwargs):
+    '''Perform a network "get" or "post", handling timeouts.  If "session"
+    is not None, it is used as a requests.Session object.  "Timeout" is a
+    timeout (in seconds) on the network requests get or post; if it is None,
+    timeouts are chosen by the current AdaptiveTimeout object (see
+    timeouts.py) for a response of "expected_size" bytes.  If "deadline" is
+    not None, it is a value of time.perf_counter() by which the request must
+    be done, and DeadlineExceeded is raised if it can't be.  Other keyword
+    arguments are passed to the network call.  This makes a single attempt;
+    failed attempts are retried by net(), so that all retries of a call come
+    out of one budget set by the current retry policy (see retry.py).
+    '''
+    timeouts = current_timeouts()
+    attempt_timeout = timeout or timeouts.timeout(expected_size)
+    if deadline is not None:
+        attempt_timeout = _bounded_timeout(attempt_timeout, deadline)
+    try:
+        with warnings.catch_warnings():
+            # The underlying urllib3 library used by the Python requests
+            # module will issue a warning about missing SSL certificates.
+            # We don't care here.  See also this for a discussion:
+            # https://github.com/kennethreitz/requests/issues/2214
+            warnings.simplefilter("ignore", InsecureRequestWarning)
+            if __debug__: log('doing http {} on {} with timeout {}',
+                              get_or_post, url, attempt_timeout)
+            attempt_started = perf_counter()
+            response = _transport.request(get_or_post, url,
+                                          session or _default_session,
+                                          deadline = deadline,
+                                          timeout = attempt_timeout,
+                                          verify = False, **kwargs)
+            # When streaming, the body hasn't been read yet, and must not be.
+            if kwargs.get('stream'):
+                timeouts.record(response.elapsed.total_seconds())
             else:
-                # We've already paused & restarted once.
-                raise error
+                size = len(response.content)
+                if __debug__: log('received {} bytes', size)
+                timeouts.record(response.elapsed.total_seconds(), size,
+                                perf_counter() - attempt_started)
+            return response
+    except requests.exceptions.Timeout:
+        timeouts.record_timeout()
+        raise
 
 
-def net(get_or_post, url, session = None, polling = False, recursing = 0, **kwargs):
+def net(get_or_post, url, session = None, polling = False, deadline = None,
+        **kwargs):
     '''Gets or posts the 'url' with optional keyword arguments provided.
     Returns a tuple of (response, exception), where the first element is
     the response from the get or post http call, and the second element is
@@ -153,42 +296,84 @@ def net(get_or_post, url, session = None, polling = False, recursing = 0, **kwar
 
     If keyword 'polling' is True, certain statuses like 404 are ignored and
     the response is returned; otherwise, they are considered errors.
+
+    Transient problems such as rate limit errors (code 429), unavailable
+    servers, timeouts and lost connections, as well as code 202 (meaning
+    the server has accepted a query but has no results yet), are retried
+    according to the current retry policy (see retry.py).  This is the only
+    place where calls are retried, so the policy's limits on the number of
+    retries and the total time apply to the call as a whole.  If the server
+    still returns code 202 after the last retry, the response is returned
+    with no exception.
+
+    If keyword 'deadline' is not None, it is a value of time.perf_counter()
+    by which the call must be done, including retries; if it can't be, the
+    exception returned is DeadlineExceeded.
     '''
+    policy = retry_policy()
+    started = perf_counter()
+    retries = 0
+    while True:
+        (req, error, transient) = _net_attempt(get_or_post, url, session,
+                                               polling, deadline = deadline,
+                                               **kwargs)
+        if not transient:
+            return (req, error)
+        retries += 1
+        try:
+            retrying = policy.wait(retries, started, retry_after(req), deadline)
+        except DeadlineExceeded as ex:
+            return (req, ex)
+        if not retrying:
+            if __debug__: log('giving up on {}: {}', url, error)
+            return (req, error)
+        if req is not None:
+            # Let the connection be reused, in case the body wasn't read.
+            req.close()
+
+
+def _net_attempt(get_or_post, url, session, polling, **kwargs):
+    '''Make one attempt at a get or post for net().  Returns a tuple of
+    (response, exception, transient), where 'transient' is True if the
+    problem is one that may go away if the call is retried.'''
     def addurl(text):
         return (text + ' for {}').format(url)
 
     req = None
     try:
         req = timed_request(get_or_post, url, session, **kwargs)
+    except requests.exceptions.InvalidSchema as ex:
+        return (req, NetworkFailure(addurl('Unsupported network protocol')), False)
     except requests.exceptions.ConnectionError as ex:
-        if recursing >= _MAX_RECURSIVE_CALLS:
-            return (req, NetworkFailure(addurl('Too many connection errors')))
-        arg0 = ex.args[0]
+        arg0 = ex.args[0] if ex.args else None
         if isinstance(arg0, urllib3.exceptions.MaxRetryError):
             if __debug__: log(str(arg0))
             original = unwrapped_urllib3_exception(arg0)
             if isinstance(original, str) and 'unreacheable' in original:
-                return (req, NetworkFailure(addurl('Unable to connect to server')))
+                return (req, NetworkFailure(addurl('Unable to connect to server')), False)
             elif network_available():
-                raise NetworkFailure(addurl('Unable to resolve host'))
+                return (req, NetworkFailure(addurl('Unable to resolve host')), True)
             else:
-                raise NetworkFailure(addurl('Lost network connection with server'))
+                return (req, NetworkFailure(addurl('Lost network connection with server')), True)
         elif (isinstance(arg0, urllib3.exceptions.ProtocolError)
-              and arg0.args and isinstance(args0.args[1], ConnectionResetError)):
-            if __debug__: log('net() got ConnectionResetError; will recurse')
-            sleep(1)                    # Sleep a short time and try again.
-            return net(get_or_post, url, session, polling, recursing + 1, **kwargs)
+              and len(arg0.args) > 1 and isinstance(arg0.args[1], ConnectionResetError)):
+            if __debug__: log('net() got ConnectionResetError; will retry')
+            return (req, NetworkFailure(addurl('Connection reset by server')), True)
         else:
-            return (req, NetworkFailure(str(ex)))
-    except requests.exceptions.ReadTimeout as ex:
+            return (req, NetworkFailure(str(ex)), True)
+    except requests.exceptions.Timeout as ex:
         if network_available():
-            return (req, ServiceFailure(addurl('Timed out reading data from server')))
+            return (req, ServiceFailure(addurl('Timed out reading data from server')), True)
         else:
-            return (req, NetworkFailure(addurl('Timed out reading data over network')))
-    except requests.exceptions.InvalidSchema as ex:
-        return (req, NetworkFailure(addurl('Unsupported network protocol')))
+            return (req, NetworkFailure(addurl('Timed out reading data over network')), True)
+    except _FATAL_EXCEPTIONS as ex:
+        return (req, ex, False)
+    except requests.exceptions.RequestException as ex:
+        # Other problems, such as a connection broken while reading the
+        # response, might be transient.
+        return (req, ex, True)
     except Exception as ex:
-        return (req, ex)
+        return (req, ex, False)
 
     # Interpret the response.  Note that the requests library handles code 301
     # and 302 redirects automatically, so we don't need to do it here.
@@ -205,19 +390,58 @@ def net(get_or_post, url, session = None, polling = False, recursing = 0, **kwar
     elif code in [415, 416]:
         error = ServiceFailure(addurl('Server rejected the request'))
     elif code == 429:
-        if recursing < _MAX_RECURSIVE_CALLS:
-            pause = 5 * (recursing + 1)   # +1 b/c we start with recursing = 0.
-            if __debug__: log('rate limit hit -- sleeping {}', pause)
-            sleep(pause)                  # 5 s, then 10 s, then 15 s, etc.
-            return net(get_or_post, url, session, polling, recursing + 1, **kwargs)
+        if __debug__: log('rate limit hit')
+        _DIMENSIONS_RATE_LIMIT.record_throttled()
         error = RateLimitExceeded('Server blocking further requests due to rate limits')
     elif code == 503:
         error = ServiceFailure('Server is unavailable -- try again later')
-    elif code in [500, 501, 502, 506, 507, 508]:
+    elif code in [500, 501, 502, 504, 506, 507, 508]:
         error = ServiceFailure('Dimensions server error (HTTP code {})'.format(code))
     elif not (200 <= code < 400):
         error = NetworkFailure("Unable to resolve {}".format(url))
-    return (req, error)
+    else:
+        _DIMENSIONS_RATE_LIMIT.record_success()
+    return (req, error, code in _RETRY_CODES)
+
+
+class LiveTransport(object):
+    '''Transport that performs network operations using requests.'''
+
+    offline = False
+
+    def request(self, get_or_post, url, session, deadline = None, **kwargs):
+        # This is equivalent to using the @rate_limit decorator, except that
+        # waiting for the rate limit must not go past the deadline.
+        wait = None if deadline is None else max(0, deadline - perf_counter())
+        if not _DIMENSIONS_RATE_LIMIT.acquire(wait):
+            raise DeadlineExceeded('Rate limit would delay request past its deadline')
+        return getattr(session, get_or_post)(url, **kwargs)
+
+
+def _initial_probe():
+    setting = os.environ.get('SIDEWALL_NETWORK_PROBE', '').strip()
+    if setting.lower() in ['off', 'none', 'false', '0']:
+        return {'url': None, 'ttl': _PROBE_TTL, 'enabled': False,
+                'result': None, 'time': None}
+    return {'url': setting or None, 'ttl': _PROBE_TTL, 'enabled': True,
+            'result': None, 'time': None}
+
+_default_session = new_session()
+_transport = LiveTransport()
+_probe = _initial_probe()
+_probe_default = _PROBE_URL
+_probe_lock = threading.Lock()
+
+
+def _bounded_timeout(timeout, deadline):
+    '''Return 'timeout' (a number of seconds or a tuple of them, as used by
+    requests) reduced so that it doesn't extend past 'deadline'.'''
+    remaining = deadline - perf_counter()
+    if remaining <= 0:
+        raise DeadlineExceeded('Deadline passed before request could be made')
+    if isinstance(timeout, tuple):
+        return tuple(min(value, remaining) for value in timeout)
+    return min(timeout, remaining)
 
 
 def unwrapped_urllib3_exception(ex):
@@ -36,7 +36,7 @@ class Organization(DimensionsCore, Persistable):
     _new_attributes = ['acronym', 'city', 'city_id', 'country', 'country_code',
                        'country_name', 'id', 'name', 'state', 'state_code']
     _attributes     = _new_attributes + DimensionsCore._attributes
-    _search_tmpl    = 'publications where research_orgs.id="{}" return research_orgs'
+    _batch_tmpl     = 'research_orgs where id in [{}] return research_orgs[all]'
 
 
     def _set_attributes(self, data, overwrite = False):
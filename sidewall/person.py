@@ -101,6 +101,15 @@ from .organization import Organization
 #
 # So, that's the explanation for why the search template returns many results
 # instead of a single one, and why _fill_record() iterates the way it does.
+#
+# Searching the researchers source directly doesn't have this problem, and it
+# lets us ask for many researchers at once.  That's what the batch template is
+# used for: the batched fill code in fill.py puts a list of researcher id's
+# into it, and hands the matching record to _fill_record() for each object.
+# The default fieldset of researchers doesn't include the current research
+# organization, so the template asks for it explicitly.
+# The search template is only used, by Dimensions.fill(), if a subclass sets
+# the batch template to None.
 
 class Person(DimensionsCore):
     # The 'middle_name' field does not seem to show up in publication author
@@ -109,6 +118,8 @@ class Person(DimensionsCore):
                        'orcid', 'current_organization']
     _attributes     = _new_attributes + DimensionsCore._attributes
     _search_tmpl    = 'publications where researchers.id="{}" return researchers'
+    _batch_tmpl     = ('researchers where id in [{}]'
+                       ' return researchers[basics+current_research_org]')
 
 
     def _set_attributes(self, data, overwrite = False):
@@ -166,6 +177,14 @@ class Person(DimensionsCore):
 
     def _org_from_data(self, data):
         org_id = data.get('current_organization_id', None)
+        if not org_id and data.get('current_research_org', None):
+            # Records from "search researchers" use a different field name,
+            # and the value may be either an org id or a dict of org data.
+            current = data['current_research_org']
+            if isinstance(current, dict):
+                org_id = current.get('id', None)
+            else:
+                org_id = current
         if org_id:
             org_record = {'id': org_id} # Fallback value.
             dimensions = objattr(self, '_dimensions', None)
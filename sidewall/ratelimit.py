@@ -1,12 +1,17 @@
 '''
 limitcalls.py: implement rate limit handling for API calls
 
-Object class RateLimit implements a token tracking mechanism that arranges
-to return a maximum of a given number of tokens in a given amount of time.
-There are to ways of using this.  The first way is simple but only suitable
-when there is only one function making calls to a particular API.  Then,
-the @rate_limit() decorator can be used on the function making the calls.
-E.g.,
+Object class RateLimit implements a token bucket that hands out a maximum
+of a given number of tokens in a given amount of time.  The bucket is
+refilled smoothly (rather than all at once at the end of each time window)
+and holds at most one token, so that the calls are spaced evenly and no
+period of time_limit seconds has more than max_calls calls, even right after
+the bucket is created or has been idle.  Callers that have to wait for a
+token are served in the order in which they asked for one, and RateLimit
+objects can be shared by multiple threads.  There are two ways of using
+this.  The first way is simple but only suitable when there is only one
+function making calls to a particular API.  Then, the @rate_limit()
+decorator can be used on the function making the calls.  E.g.,
 
     @rate_limit(max_calls = 100, time_limit = 60)
 
@@ -24,6 +29,23 @@ and hand that object to the @rate_limit() decorator.  E.g.:
     def second_function_calling_api():
         ... code calling the network API ...
 
+Finally, class SharedRateLimit keeps the state of the token bucket in a
+file, so that all processes on a computer that use the same file draw tokens
+from the same bucket.  This is useful for services such as Dimensions that
+count calls per IP address.  Access to the file is serialized using file
+locks (via fcntl), which are only available on Unix-like systems.
+
+Both kinds of RateLimit objects can also be made adaptive, for services
+whose real limit is unknown or changes over time.  Callers report the
+outcome of each call using record_success() and record_throttled(), and the
+number of calls allowed per time_limit is halved when the service says the
+limit was exceeded and raised by one after a run of successful calls (the
+"additive increase, multiplicative decrease" scheme used by TCP).  The rate
+is only raised if callers had to wait for tokens during the run, because
+otherwise the rate limit was not what limited the calls, and it is never
+raised above a given maximum.  The learned rate can be saved in a file so
+that the next run starts from it.
+
 Acknowledgments
 ---------------
 
@@ -39,42 +61,272 @@ Authors
 Michael Hucka <mhucka@caltech.edu> -- Caltech Library
 '''
 
+from   collections import deque
 import functools
-from time import sleep, perf_counter
+import json
+import os
+import threading
+from   time import perf_counter, time
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
 from .debug import log
 
-
+
+# Constants.
+# .............................................................................
+
+_CAPACITY = 1
+'''Number of tokens the bucket can hold.  A bucket holding more tokens would
+allow bursts of calls, and since it is also refilled at max_calls tokens per
+time_limit, more than max_calls calls in some periods of time_limit.'''
+
+_RATE_INCREASE = 1
+'''Number of calls per time window added after a run of successes.'''
+
+_RATE_DECREASE = 0.5
+'''Factor applied to the number of calls per time window upon throttling.'''
+
+_MIN_RATE = 1
+'''Lower bound on the number of calls per time window in adaptive mode.'''
+
+
 # Classes.
 # .............................................................................
 
 class RateLimit:
-    '''Object that distributes a maximum number of tokens every
-    time_limit seconds.'''
+    '''Token bucket that distributes at most max_calls tokens in any period of
+    time_limit seconds.  It can be shared by multiple threads.  If
+    'adaptive' is True, max_calls is adjusted based on the outcomes reported
+    to record_success() and record_throttled(), but not above 'max_rate' (if
+    given), and if 'rate_file' is also given, the adjusted value is saved in
+    that file and reused next time.'''
+
+    _clock = staticmethod(perf_counter)
 
-    def __init__(self, max_calls, time_limit):
+    def __init__(self, max_calls, time_limit, adaptive = False, rate_file = None,
+                 max_rate = None):
         self.max_calls = max_calls
         self.time_limit = time_limit
-        self.token = max_calls
-        self.time = perf_counter()
+        self.adaptive = adaptive
+        self.rate_file = rate_file
+        self.max_rate = max_rate
+        if adaptive and rate_file:
+            self.max_calls = self._capped(self._saved_rate(max_calls))
+        self._tokens = float(_CAPACITY)
+        self._time = self._clock()
+        self._cond = threading.Condition()
+        self._waiting = deque()         # Tickets of callers, in FIFO order.
+        self._successes = 0
+        self._waited = False            # Whether callers waited for tokens.
+        self._last_decrease = None
+
+
+    def acquire(self, timeout = None):
+        '''Take a token, waiting until one is available.  Returns True if a
+        token was obtained, or False if 'timeout' seconds passed first.'''
+        deadline = None if timeout is None else perf_counter() + timeout
+        ticket = object()
+        with self._cond:
+            self._waiting.append(ticket)
+            try:
+                while True:
+                    # Only the first caller in line waits for the next token;
+                    # the others wait until the one ahead of them is served.
+                    first = self._waiting[0] is ticket
+                    delay = self._take() if first else None
+                    if delay == 0:
+                        return True
+                    self._waited = True
+                    if deadline is not None:
+                        remaining = deadline - perf_counter()
+                        if remaining <= 0:
+                            return False
+                        delay = remaining if delay is None else min(delay, remaining)
+                    if __debug__: log('waiting on rate limit')
+                    self._cond.wait(delay)
+            finally:
+                self._waiting.remove(ticket)
+                self._cond.notify_all()
+
+
+    def try_acquire(self):
+        '''Take a token if one is available right now and nobody else is
+        waiting.  Returns True if a token was obtained, False otherwise.'''
+        return self.acquire(timeout = 0)
 
 
     def pause(self):
-        if self.token <= 0 and not self.restock():
-            return True
-        self.token -= 1
-        return False
+        '''Return True if the caller must wait before proceeding; otherwise,
+        take a token and return False.'''
+        return not self.try_acquire()
+
+
+    def record_success(self):
+        '''Note that a call completed without exceeding the rate limit.'''
+        if not self.adaptive:
+            return
+        with self._cond:
+            self._successes += 1
+            if self._successes >= self.max_calls:
+                self._successes = 0
+                if self._waited and self._update(self._increase):
+                    self._save_rate()
+                self._waited = False
+
+
+    def record_throttled(self):
+        '''Note that a call was refused because of the rate limit.'''
+        if not self.adaptive:
+            return
+        with self._cond:
+            self._successes = 0
+            self._waited = False
+            if self._update(self._decrease):
+                self._save_rate()
+
+
+    def _increase(self):
+        new_rate = self._capped(self.max_calls + _RATE_INCREASE)
+        if new_rate <= self.max_calls:
+            return False
+        self.max_calls = new_rate
+        if __debug__: log('rate limit raised to {:.1f}', self.max_calls)
+        return True
+
+
+    def _capped(self, rate):
+        return rate if self.max_rate is None else min(rate, self.max_rate)
 
 
-    def restock(self):
-        now = perf_counter()
-        if (now - self.time) < self.time_limit:
+    def _decrease(self):
+        # Calls made before the last decrease took effect may also get
+        # refused, so decrease only once per time window.
+        now = self._clock()
+        if self._last_decrease is not None and now - self._last_decrease < self.time_limit:
             return False
-        self.token = self.max_calls
-        self.time = now
+        self._last_decrease = now
+        self.max_calls = max(_MIN_RATE, self.max_calls * _RATE_DECREASE)
+        self._tokens = 0
+        self._time = now
+        if __debug__: log('rate limit lowered to {:.1f}', self.max_calls)
         return True
 
-
+
+    def _update(self, func):
+        # Call func() to change the state of the token bucket.  Subclasses
+        # keeping the state elsewhere override this to load and save it.
+        return func()
+
+
+    def _saved_rate(self, default):
+        try:
+            with open(self.rate_file, 'r') as f:
+                return max(_MIN_RATE, float(json.load(f)['max_calls']))
+        except (OSError, ValueError, KeyError, TypeError):
+            return default
+
+
+    def _save_rate(self):
+        if not self.rate_file:
+            return
+        try:
+            tmp = self.rate_file + '.tmp'
+            with open(tmp, 'w') as f:
+                json.dump({'max_calls': self.max_calls, 'time_limit': self.time_limit}, f)
+            os.replace(tmp, self.rate_file)
+        except OSError as ex:
+            if __debug__: log('unable to save rate in {}: {}', self.rate_file, ex)
+
+
+    def _take(self):
+        # Take a token if there is one and return 0; otherwise, return the
+        # number of seconds until there should be one.
+        self._refill()
+        if self._tokens >= 1:
+            self._tokens -= 1
+            return 0
+        return self._delay()
+
+
+    def _refill(self):
+        now = self._clock()
+        rate = self.max_calls / self.time_limit
+        elapsed = max(0, now - self._time)
+        self._tokens = min(_CAPACITY, self._tokens + elapsed * rate)
+        self._time = now
+
+
+    def _delay(self):
+        # Seconds until the bucket will hold one whole token.
+        return max(0, (1 - self._tokens) * self.time_limit / self.max_calls)
+
+
+class SharedRateLimit(RateLimit):
+    '''RateLimit whose token bucket is kept in the file 'path', so that it
+    is shared by all processes using the same file.  In adaptive mode, the
+    adjusted rate is shared too.  Raises OSError if file locking is not
+    available or the file cannot be opened.'''
+
+    # Different processes need to agree on the time, so use the system clock.
+    _clock = staticmethod(time)
+
+    def __init__(self, max_calls, time_limit, path, adaptive = False,
+                 rate_file = None, max_rate = None):
+        if fcntl is None:
+            raise OSError('File locking is not supported on this system')
+        super().__init__(max_calls, time_limit, adaptive, rate_file, max_rate)
+        self.path = path
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+
+
+    def _take(self):
+        return self._update(super()._take)
+
+
+    def _update(self, func):
+        # Threads of this process are serialized by our condition variable,
+        # and the file lock serializes us with respect to other processes.
+        fcntl.flock(self._fd, fcntl.LOCK_EX)
+        try:
+            self._load()
+            result = func()
+            self._save()
+            return result
+        finally:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+
+    def _load(self):
+        os.lseek(self._fd, 0, os.SEEK_SET)
+        content = os.read(self._fd, 4096)
+        try:
+            state = json.loads(content.decode('utf-8'))
+            self._tokens = float(state['tokens'])
+            self._time = float(state['time'])
+            if self.adaptive and 'max_calls' in state:
+                self.max_calls = self._capped(float(state['max_calls']))
+                self._last_decrease = state.get('last_decrease')
+        except (ValueError, KeyError, TypeError):
+            # New or damaged file.  Start with a full bucket.
+            if __debug__: log('initializing rate limit state in {}', self.path)
+            self._tokens = float(_CAPACITY)
+            self._time = self._clock()
+
+
+    def _save(self):
+        state = {'tokens': self._tokens, 'time': self._time}
+        if self.adaptive:
+            state['max_calls'] = self.max_calls
+            state['last_decrease'] = self._last_decrease
+        os.lseek(self._fd, 0, os.SEEK_SET)
+        os.ftruncate(self._fd, 0)
+        os.write(self._fd, json.dumps(state).encode('utf-8'))
+
+
 # Decorator function.
 # .............................................................................
 
@@ -87,10 +339,7 @@ def rate_limit(obj = None, *, max_calls = 30, time_limit = 60):
     def limit_decorator(func):
         @functools.wraps(func)
         def limit_wrapper(*args, **kwargs):
-            while obj.pause():
-                if __debug__: log('waiting on rate limit')
-                now = perf_counter()
-                sleep(obj.time_limit - (now - obj.time))
+            obj.acquire()
             return func(*args, **kwargs)
         return limit_wrapper
     return limit_decorator
@@ -62,14 +62,19 @@ class Researcher(Person):
         affiliations = objattr(self, 'affiliations', [])
         dimensions = objattr(self, '_dimensions', None)
         if isinstance(data[field_name][0], str):
-            # Case 1: it's a list of grid id's.
+            # Case 1: it's a list of grid id's.  The new Organization objects
+            # will only have id's, so we ask Dimensions to fill them in bulk.
+            new_orgs = []
             for org_id in data[field_name]:
                 for existing_org in affiliations:
                     if org_id == existing_org.id:
                         # Nothing more to do, b/c all we have is the id.
                         break
                 else: # This 'else' is for the inner 'for' loop, not the 'if' stmt.
-                    affiliations.append(new_object(Organization, {'id': org_id}, dimensions, self))
+                    new_orgs.append(new_object(Organization, {'id': org_id}, dimensions, self))
+            affiliations += new_orgs
+            if dimensions and new_orgs:
+                dimensions.resolve(new_orgs)
         else:
             # Case 2: it's a list of dict's containing org field/value data.
             for org_data in data[field_name]:
@@ -0,0 +1,134 @@
+'''
+retry.py: retry policy for network operations in Sidewall
+
+Network operations fail for transient reasons all the time: connections get
+reset, servers time out, Dimensions returns code 429 when the rate limit is
+exceeded, or code 202 when it has accepted a query but doesn't have results
+yet.  All the code in Sidewall that retries an operation in those cases asks
+the current RetryPolicy object how long to wait before each retry, and
+whether to give up instead.
+
+The delays follow an exponential back-off with "full jitter": the delay
+before retry number n is a random value between 0 and base_delay * 2^(n-1),
+capped at max_delay.  The randomness keeps many threads or processes that
+failed at the same moment from all retrying at the same moment again.  If
+the server says how long to wait (in a Retry-After header), the delay is at
+least that long.  Retrying stops after max_retries retries, or when the
+next delay would take the total time spent on the operation past the
+deadline.
+
+The policy can be changed using set_retry_policy().  For example,
+
+    from sidewall import RetryPolicy, set_retry_policy
+    set_retry_policy(RetryPolicy(max_retries = 3, deadline = 30))
+
+Authors
+-------
+
+Michael Hucka <mhucka@caltech.edu> -- Caltech Library
+
+Copyright
+---------
+
+Copyright (c) 2019 by the California Institute of Technology.  This code is
+open-source software released under a 3-clause BSD license.  Please see the
+file "LICENSE" for more information.
+'''
+
+from   datetime import datetime, timezone
+from   email.utils import parsedate_to_datetime
+import random
+from   time import perf_counter, sleep
+
+from .debug import log
+from .exceptions import DeadlineExceeded
+
+
+# Classes.
+# .............................................................................
+
+class RetryPolicy(object):
+    '''Policy for retrying failed network operations.  Delays are given in
+    seconds.  A 'deadline' of None means there is no limit on the total time
+    spent on an operation.'''
+
+    def __init__(self, max_retries = 8, base_delay = 1, max_delay = 60,
+                 deadline = 300):
+        self.max_retries = max_retries
+        self.base_delay  = base_delay
+        self.max_delay   = max_delay
+        self.deadline    = deadline
+
+
+    def delay(self, retry, retry_after = None):
+        '''Return the number of seconds to wait before retry number 'retry'
+        (counting from 1).  'retry_after' is the delay requested by the
+        server, if any.'''
+        backoff = min(self.max_delay, self.base_delay * 2 ** (retry - 1))
+        delay = random.uniform(0, backoff)
+        if retry_after is not None:
+            delay = max(delay, retry_after)
+        return delay
+
+
+    def wait(self, retry, started, retry_after = None, until = None):
+        '''Wait before retry number 'retry' of an operation that began at time
+        'started' (a value of time.perf_counter()).  Returns True after the
+        wait, or False without waiting if the operation should be abandoned.
+        If 'until' is not None, it is a value of time.perf_counter() by which
+        the caller must be done, and DeadlineExceeded is raised if the retry
+        could not begin before then.'''
+        if retry > self.max_retries:
+            if __debug__: log('giving up after {} retries', self.max_retries)
+            return False
+        delay = self.delay(retry, retry_after)
+        if until is not None and perf_counter() + delay >= until:
+            raise DeadlineExceeded('Retry would take operation past its deadline')
+        if self.deadline is not None:
+            if perf_counter() - started + delay > self.deadline:
+                if __debug__: log('giving up: retry would pass the deadline')
+                return False
+        if __debug__: log('retry {} in {:.2f} s', retry, delay)
+        sleep(delay)
+        return True
+
+
+# Exported functions.
+# .............................................................................
+
+def set_retry_policy(policy):
+    '''Make 'policy' (a RetryPolicy object) the policy used by Sidewall for
+    retrying failed network operations.'''
+    global _policy
+    _policy = policy
+
+
+def retry_policy():
+    '''Return the current RetryPolicy object.'''
+    return _policy
+
+
+def retry_after(response):
+    '''Return the number of seconds requested in the Retry-After header of
+    the 'response', or None if there is no such header or it can't be read.'''
+    value = response.headers.get('Retry-After') if response is not None else None
+    if not value:
+        return None
+    try:
+        return max(0, float(value))
+    except ValueError:
+        pass
+    try:
+        when = parsedate_to_datetime(value)
+        if when.tzinfo is None:
+            when = when.replace(tzinfo = timezone.utc)
+        return max(0, (when - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        if __debug__: log('cannot understand Retry-After value "{}"', value)
+        return None
+
+
+# Module variables.
+# .............................................................................
+
+_policy = RetryPolicy()
@@ -0,0 +1,364 @@
+'''
+standin.py: a local stand-in for the Dimensions API server
+
+The Dimensions API limits the number of calls per minute, which makes it
+impractical to test how Sidewall behaves under load or when the service
+misbehaves.  StandinServer is a small HTTP server that implements the two
+Dimensions endpoints Sidewall uses (/api/auth.json and /api/dsl.json) well
+enough for Sidewall to work with it.  Search results come from JSON files
+("fixtures") in the format returned by Dimensions, such as the examples in
+the tests/test-data directory of the Sidewall source code.  The server
+honors the "limit" and "skip" clauses of queries, searches by identifiers
+(e.g., 'where id in [...]'), and comparisons of top-level fields with
+numbers or strings (e.g., 'year >= 2010'), all taken to be combined with
+"and".  Other conditions in queries are ignored.
+
+The server can be told to add latency to every response and to answer a
+given fraction of queries with code 202 (results not ready), 429 (rate
+limit exceeded) or 5xx server errors, chosen at random.  By default, the
+server errors are 502, 503 and 504, which Sidewall retries; other codes
+(e.g., 500, which Sidewall reports as a ServiceFailure) can be chosen using
+the parameter 'error_codes'.  Example of use:
+
+    from sidewall import dimensions
+    from sidewall.standin import StandinServer
+
+    with StandinServer(['example-publications.json'], throttle = 0.1) as server:
+        dimensions.set_base_url(server.url)
+        dimensions.login(username = 'user', password = 'password', use_keyring = False)
+        for pub in dimensions.query('search publications return publications'):
+            ...
+
+Alternatively, start the server from a shell using
+
+    python3 -m sidewall.standin --port 8000 example-publications.json
+
+and set the environment variable SIDEWALL_DIMENSIONS_URL to
+http://localhost:8000 before starting the program using Sidewall.
+
+Authors
+-------
+
+Michael Hucka <mhucka@caltech.edu> -- Caltech Library
+
+Copyright
+---------
+
+Copyright (c) 2019 by the California Institute of Technology.  This code is
+open-source software released under a 3-clause BSD license.  Please see the
+file "LICENSE" for more information.
+'''
+
+import base64
+from   collections import Counter
+import gzip
+from   http.server import BaseHTTPRequestHandler, HTTPServer
+import json
+import operator
+import random
+import re
+from   socketserver import ThreadingMixIn
+import threading
+from   time import sleep, time
+import uuid
+
+from .debug import log
+
+
+# Constants.
+# .............................................................................
+
+_AUTH_PATH = '/api/auth.json'
+'''Path of the authentication endpoint.'''
+
+_DSL_PATH = '/api/dsl.json'
+'''Path of the DSL query endpoint.'''
+
+_DEFAULT_LIMIT = 20
+'''Number of results returned by Dimensions for queries without "limit".'''
+
+_ERROR_CODES = [502, 503, 504]
+'''Default codes of the server errors injected by StandinServer.  These are
+the codes Sidewall retries (see _RETRY_CODES in network.py).'''
+
+_OPERATORS = {'=' : operator.eq, '>' : operator.gt, '<' : operator.lt,
+              '>=': operator.ge, '<=': operator.le}
+'''Comparison operators understood by StandinServer in queries.'''
+
+
+# Classes.
+# .............................................................................
+
+class StandinServer(object):
+    '''HTTP server imitating the Dimensions API.  'fixtures' is a list of
+    paths to JSON files of search results.  If 'port' is 0, a free port is
+    chosen.  'latency' is a number of seconds added to each response.
+    'not_ready', 'throttle' and 'errors' are the fractions (between 0 and 1)
+    of queries answered with code 202, code 429, and a 5xx code, respectively.
+    The 5xx codes are chosen from the list 'error_codes'.  'retry_after' is
+    the value of the Retry-After header sent with code 429.
+    'token_lifetime' is the number of seconds for which tokens are valid.
+    'seed' makes the injected failures repeatable.'''
+
+    def __init__(self, fixtures = [], host = '127.0.0.1', port = 0,
+                 latency = 0, not_ready = 0, throttle = 0, errors = 0,
+                 retry_after = 1, token_lifetime = 30 * 60, seed = None,
+                 error_codes = _ERROR_CODES):
+        self.latency        = latency
+        self.not_ready      = not_ready
+        self.throttle       = throttle
+        self.errors         = errors
+        self.retry_after    = retry_after
+        self.error_codes    = list(error_codes)
+        self.token_lifetime = token_lifetime
+        self.counts         = Counter()
+        self._records       = {}
+        self._tokens        = {}
+        self._random        = random.Random(seed)
+        self._lock          = threading.Lock()
+        self._thread        = None
+        for path in fixtures:
+            self.add_fixture(path)
+        self._httpd = _HTTPServer((host, port), _Handler)
+        self._httpd.standin = self
+
+
+    @property
+    def url(self):
+        '''The base URL of the server, e.g., "http://127.0.0.1:8000".'''
+        (host, port) = self._httpd.server_address[:2]
+        return 'http://{}:{}'.format(host, port)
+
+
+    def add_fixture(self, path):
+        '''Add the records in the JSON file 'path' to those served.'''
+        if __debug__: log('loading fixture {}', path)
+        with open(path, 'r') as f:
+            data = json.load(f)
+        for (result_type, records) in data.items():
+            if result_type.startswith('_') or not isinstance(records, list):
+                continue
+            known = self._records.setdefault(result_type, [])
+            ids = set(r.get('id') for r in known)
+            known += [r for r in records if r.get('id') not in ids]
+
+
+    def start(self):
+        '''Start serving requests in a background thread.'''
+        if __debug__: log('starting stand-in server at {}', self.url)
+        self._thread = threading.Thread(target = self._httpd.serve_forever,
+                                        daemon = True)
+        self._thread.start()
+        return self
+
+
+    def stop(self):
+        '''Stop serving requests.'''
+        if __debug__: log('stopping stand-in server at {}', self.url)
+        self._httpd.shutdown()
+        self._httpd.server_close()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+
+
+    def __enter__(self):
+        return self.start()
+
+
+    def __exit__(self, *args):
+        self.stop()
+
+
+    def expire_tokens(self):
+        '''Make all the tokens issued so far invalid, as if they had expired,
+        so that queries using them are answered with code 401.'''
+        with self._lock:
+            self._tokens.clear()
+
+
+    def serve_forever(self):
+        '''Serve requests in the current thread until interrupted.'''
+        try:
+            self._httpd.serve_forever()
+        finally:
+            self._httpd.server_close()
+
+
+    def _login(self, body):
+        # Any user name and password are accepted, but both must be present.
+        try:
+            creds = json.loads(body)
+        except ValueError:
+            return (400, {'errors': {'query': {'header': 'Malformed request'}}})
+        if not creds.get('username') or not creds.get('password'):
+            return (401, {'errors': {'query': {'header': 'Invalid credentials'}}})
+        expiry = time() + self.token_lifetime
+        token = _fake_token(expiry)
+        with self._lock:
+            self._tokens[token] = expiry
+        return (200, {'token': token})
+
+
+    def _authorized(self, header):
+        token = (header or '').replace('JWT ', '', 1).strip()
+        with self._lock:
+            expiry = self._tokens.get(token)
+        return expiry is not None and time() < expiry
+
+
+    def _fault(self):
+        # Returns the code of an injected failure, or None.
+        with self._lock:
+            draw = self._random.random()
+            code = self._random.choice(self.error_codes)
+        if draw < self.not_ready:
+            return 202
+        if draw < self.not_ready + self.throttle:
+            return 429
+        if draw < self.not_ready + self.throttle + self.errors:
+            return code
+        return None
+
+
+    def _search(self, query):
+        match = re.search(r'\breturn\s+(\w+)', query)
+        if not match or match.group(1) not in self._records:
+            return (400, {'errors': {'query': {'header': 'Semantic Error',
+                                               'details': ['Unknown result type']}}})
+        records = self._records[match.group(1)]
+        ids = _requested_ids(query)
+        if ids is not None:
+            records = [r for r in records if r.get('id') in ids]
+        for (field, op, value) in _comparisons(query):
+            records = [r for r in records if isinstance(r.get(field), type(value))
+                       and op(r[field], value)]
+        limit = re.search(r'\blimit\s+(\d+)', query)
+        limit = int(limit.group(1)) if limit else _DEFAULT_LIMIT
+        skip = re.search(r'\bskip\s+(\d+)', query)
+        skip = int(skip.group(1)) if skip else 0
+        return (200, {'_stats': {'total_count': len(records)},
+                      match.group(1): records[skip:skip + limit]})
+
+
+class _HTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        standin = self.server.standin
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length).decode('utf-8')
+        if standin.latency:
+            sleep(standin.latency)
+        if self.path == _AUTH_PATH:
+            (code, data) = standin._login(body)
+        elif self.path != _DSL_PATH:
+            (code, data) = (404, {'errors': {'query': {'header': 'Not found'}}})
+        elif not standin._authorized(self.headers.get('Authorization')):
+            (code, data) = (401, {'errors': {'query': {'header': 'Expired token'}}})
+        else:
+            code = standin._fault()
+            if code is None:
+                (code, data) = standin._search(body)
+            else:
+                data = None
+        with standin._lock:
+            standin.counts[code] += 1
+        self._reply(code, data)
+
+
+    def _reply(self, code, data):
+        self.send_response(code)
+        if code == 429:
+            self.send_header('Retry-After', str(self.server.standin.retry_after))
+        content = b''
+        if data is not None:
+            content = json.dumps(data).encode('utf-8')
+            self.send_header('Content-Type', 'application/json')
+            if 'gzip' in self.headers.get('Accept-Encoding', ''):
+                content = gzip.compress(content)
+                self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        try:
+            self.wfile.write(content)
+        except (BrokenPipeError, ConnectionResetError):
+            # The client gave up waiting, e.g., because of a timeout.
+            if __debug__: log('stand-in server: client closed connection')
+
+
+    def log_message(self, format, *args):
+        if __debug__: log('stand-in server: {}', format % args)
+
+
+# Helper functions.
+# .............................................................................
+
+def _fake_token(expiry):
+    '''Return a string that looks like a JSON Web Token expiring at 'expiry'.'''
+    def encoded(value):
+        text = base64.urlsafe_b64encode(json.dumps(value).encode('utf-8'))
+        return text.decode('ascii').rstrip('=')
+    return '.'.join([encoded({'alg': 'none', 'typ': 'JWT'}),
+                     encoded({'exp': int(expiry), 'jti': uuid.uuid4().hex}),
+                     'standin'])
+
+
+def _comparisons(query):
+    '''Return a list of tuples (field, operator, value) for the comparisons
+    of top-level fields with values in the "where" clause of 'query'.'''
+    where = re.search(r'\bwhere\b(.*?)\breturn\b', query)
+    if not where:
+        return []
+    found = re.findall(r'(?<![\w.])(\w+)\s*(>=|<=|=|>|<)\s*("[^"]*"|-?[0-9]+)',
+                       where.group(1))
+    return [(field, _OPERATORS[op], value.strip('"') if value.startswith('"')
+             else int(value)) for (field, op, value) in found]
+
+
+def _requested_ids(query):
+    '''Return the set of identifiers named in a condition of the form
+    'id = "..."' or 'id in [...]' in 'query', or None if there is none.'''
+    match = re.search(r'\bid\s+in\s+\[([^\]]*)\]', query)
+    if match:
+        return set(re.findall(r'"([^"]*)"', match.group(1)))
+    match = re.search(r'\bid\s*=\s*"([^"]*)"', query)
+    if match:
+        return set([match.group(1)])
+    return None
+
+
+# Main entry point.
+# .............................................................................
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description = 'Stand-in for the Dimensions API.')
+    parser.add_argument('fixtures', nargs = '+', help = 'JSON files of search results')
+    parser.add_argument('--host', default = '127.0.0.1')
+    parser.add_argument('--port', type = int, default = 8000)
+    parser.add_argument('--latency', type = float, default = 0,
+                        help = 'seconds added to each response')
+    parser.add_argument('--not-ready', type = float, default = 0,
+                        help = 'fraction of queries answered with code 202')
+    parser.add_argument('--throttle', type = float, default = 0,
+                        help = 'fraction of queries answered with code 429')
+    parser.add_argument('--errors', type = float, default = 0,
+                        help = 'fraction of queries answered with a 5xx code')
+    parser.add_argument('--error-codes', default = ','.join(map(str, _ERROR_CODES)),
+                        help = 'comma-separated 5xx codes to use (default: %(default)s)')
+    parser.add_argument('--seed', type = int, default = None)
+    args = parser.parse_args()
+    server = StandinServer(args.fixtures, args.host, args.port, args.latency,
+                           args.not_ready, args.throttle, args.errors,
+                           seed = args.seed,
+                           error_codes = [int(code) for code in args.error_codes.split(',')])
+    print('Serving at {}'.format(server.url))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,159 @@
+'''
+streaming.py: incremental decoding of JSON results for Sidewall
+
+Pages of results from Dimensions are JSON objects of the form
+
+    {"_stats": {"total_count": 1234}, "publications": [{...}, {...}, ...]}
+
+and with large fetch sizes and the [all] fieldset, a page can be several
+megabytes long.  Decoding a page with json.loads() requires the whole page
+to be downloaded and turned into one large dict before the first record can
+be used.  The function stream_items() in this module instead decodes the
+text as it arrives from the network, and produces the elements of one of
+the arrays (e.g., "publications") one at a time, so that records can be
+used as soon as they have been received and the memory used at any given
+time is bounded by the size of a record rather than the size of a page.
+
+The decoding is done with json.JSONDecoder.raw_decode(), which decodes one
+JSON value at a given position in a string.  The code here only has to deal
+with the structure of the top-level object and of the array being streamed.
+
+Authors
+-------
+
+Michael Hucka <mhucka@caltech.edu> -- Caltech Library
+
+Copyright
+---------
+
+Copyright (c) 2019 by the California Institute of Technology.  This code is
+open-source software released under a 3-clause BSD license.  Please see the
+file "LICENSE" for more information.
+'''
+
+import codecs
+import json
+
+from .exceptions import DataMismatch
+
+
+# Constants.
+# .............................................................................
+
+_DELIMITERS = ' \t\r\n,:]}'
+'''Characters that can follow a complete value in JSON text.'''
+
+_CHUNK_SIZE = 64 * 1024
+'''Number of bytes read from the network at a time when streaming.'''
+
+
+# Exported functions.
+# .............................................................................
+
+def stream_items(chunks, array_key):
+    '''Decode a JSON object from the iterable 'chunks' of bytes, and return a
+    generator of (key, value) pairs for its top-level members.  The member
+    named 'array_key' must be an array; instead of one pair for the whole
+    array, the generator produces a pair (array_key, element) for each of
+    its elements, as soon as the element has been received.'''
+    reader = _Reader(chunks)
+    reader.expect('{')
+    if reader.peek() == '}':
+        return
+    while True:
+        key = reader.value()
+        reader.expect(':')
+        if key == array_key and reader.peek() == '[':
+            reader.expect('[')
+            if reader.peek() == ']':
+                reader.expect(']')
+            else:
+                while True:
+                    yield (key, reader.value())
+                    if reader.expect(',', ']') == ']':
+                        break
+        else:
+            yield (key, reader.value())
+        if reader.expect(',', '}') == '}':
+            return
+
+
+def stream_response(response, array_key):
+    '''Like stream_items(), but reading from the body of 'response' (a
+    requests.Response object for a request made with stream = True).  The
+    response is closed when the generator is done or closed.'''
+    try:
+        yield from stream_items(response.iter_content(_CHUNK_SIZE), array_key)
+    finally:
+        response.close()
+
+
+# Helper classes.
+# .............................................................................
+
+class _Reader(object):
+    '''Buffer of text decoded incrementally from chunks of UTF-8 bytes.'''
+
+    _decoder = json.JSONDecoder()
+
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._utf8 = codecs.getincrementaldecoder('utf-8')()
+        self._buf = ''
+        self._pos = 0
+        self._eof = False
+
+
+    def peek(self):
+        '''Return the next character that isn't whitespace, without consuming it.'''
+        while True:
+            while self._pos < len(self._buf) and self._buf[self._pos].isspace():
+                self._pos += 1
+            if self._pos < len(self._buf):
+                return self._buf[self._pos]
+            if not self._more():
+                raise DataMismatch('Unexpected end of data from Dimensions')
+
+
+    def expect(self, *chars):
+        '''Consume the next character that isn't whitespace, which must be one
+        of 'chars', and return it.'''
+        char = self.peek()
+        if char not in chars:
+            raise DataMismatch('Unexpected "{}" in data from Dimensions'.format(char))
+        self._pos += 1
+        return char
+
+
+    def value(self):
+        '''Decode and return the next JSON value.'''
+        self.peek()
+        while True:
+            try:
+                value, end = self._decoder.raw_decode(self._buf, self._pos)
+                # A number that ends where the buffer ends may be incomplete
+                # (e.g., "1" of "1.25"), so we must see what follows it.
+                if self._eof or (end < len(self._buf) and self._buf[end] in _DELIMITERS):
+                    self._pos = end
+                    return value
+            except json.JSONDecodeError:
+                if self._eof:
+                    raise DataMismatch('Unable to decode data from Dimensions')
+            self._more()
+
+
+    def _more(self):
+        # Read another chunk.  Drop the text we're done with first, so that
+        # the buffer doesn't grow to the size of the whole input.
+        if self._eof:
+            return False
+        self._buf = self._buf[self._pos:]
+        self._pos = 0
+        chunk = next(self._chunks, None)
+        if chunk is None:
+            self._eof = True
+            self._buf += self._utf8.decode(b'', final = True)
+            return False
+        self._buf += self._utf8.decode(chunk)
+        return True
+
@@ -0,0 +1,132 @@
+'''
+timeouts.py: adaptive timeouts for network operations in Sidewall
+
+A fixed timeout on network requests is wrong in both directions: a page of
+1000 results with all fields can take Dimensions longer to produce than a
+timeout that suits small searches, and a small search on a dead connection
+waits the full timeout before it is retried.  AdaptiveTimeout chooses the
+timeouts for each request based on what it has observed so far.
+
+The "requests" package takes a pair of timeouts, (connect, read).  The
+connect timeout limits the time to open a connection, and is short and
+fixed.  The read timeout limits the time the server can go without sending
+data, and the longest such gap is usually the wait before the first byte of
+the response, while the server works on the query.  AdaptiveTimeout keeps
+exponentially weighted moving averages of that wait and of the rate at
+which data arrives, and sets the read timeout to a multiple of the time it
+expects the request to take, given the size of the response expected by
+the caller, within the limits 'minimum' and 'maximum'.  When a request
+times out anyway, the estimates are raised, so that a server that has
+become slower is given more time on the next try.
+
+The timeouts can be changed using set_timeouts().  For example,
+
+    from sidewall import AdaptiveTimeout, set_timeouts
+    set_timeouts(AdaptiveTimeout(connect = 3, maximum = 60))
+
+Authors
+-------
+
+Michael Hucka <mhucka@caltech.edu> -- Caltech Library
+
+Copyright
+---------
+
+Copyright (c) 2019 by the California Institute of Technology.  This code is
+open-source software released under a 3-clause BSD license.  Please see the
+file "LICENSE" for more information.
+'''
+
+import threading
+
+from .debug import log
+
+
+# Constants.
+# .............................................................................
+
+_SMOOTHING = 0.2
+'''Weight given to each new observation in the moving averages.'''
+
+_INITIAL_WAIT = 1
+'''Wait before the first byte of a response (in seconds) assumed before
+any responses have been observed.'''
+
+_INITIAL_RATE = 100 * 1024
+'''Transfer rate (in bytes per second) assumed before any responses have
+been observed.'''
+
+
+# Classes.
+# .............................................................................
+
+class AdaptiveTimeout(object):
+    '''Source of timeouts for network requests.  'connect' is the timeout
+    (in seconds) for opening connections.  Read timeouts are 'factor' times
+    the expected duration of a request, but at least 'minimum' and at most
+    'maximum' seconds.'''
+
+    def __init__(self, connect = 5, minimum = 5, maximum = 120, factor = 4):
+        self.connect = connect
+        self.minimum = minimum
+        self.maximum = maximum
+        self.factor  = factor
+        self._wait   = _INITIAL_WAIT
+        self._rate   = _INITIAL_RATE
+        self._lock   = threading.Lock()
+
+
+    def timeout(self, expected_size = None):
+        '''Return a tuple of (connect timeout, read timeout) for a request
+        whose response is expected to be 'expected_size' bytes long.'''
+        with self._lock:
+            expected = self._wait + (expected_size or 0) / self._rate
+        read = min(self.maximum, max(self.minimum, self.factor * expected))
+        return (self.connect, read)
+
+
+    def record(self, wait, size = None, duration = None):
+        '''Record a response that began arriving after 'wait' seconds and
+        that took 'duration' seconds in all to deliver 'size' bytes.  If
+        'size' is None, only the wait is recorded.'''
+        with self._lock:
+            self._wait = _averaged(self._wait, wait)
+            if size and duration and duration > 0:
+                self._rate = _averaged(self._rate, size / duration)
+
+
+    def record_timeout(self):
+        '''Record that a request timed out.'''
+        with self._lock:
+            self._wait = min(self.maximum, 2 * self._wait)
+            self._rate = self._rate / 2
+            if __debug__: log('request timed out; expected wait raised to {:.2f} s',
+                              self._wait)
+
+
+# Exported functions.
+# .............................................................................
+
+def set_timeouts(timeouts):
+    '''Make 'timeouts' (an AdaptiveTimeout object) the source of the timeouts
+    used by Sidewall for network requests.'''
+    global _timeouts
+    _timeouts = timeouts
+
+
+def current_timeouts():
+    '''Return the current AdaptiveTimeout object.'''
+    return _timeouts
+
+
+# Helper functions.
+# .............................................................................
+
+def _averaged(average, value):
+    return (1 - _SMOOTHING) * average + _SMOOTHING * value
+
+
+# Module variables.
+# .............................................................................
+
+_timeouts = AdaptiveTimeout()
@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+# =============================================================================
+# @file    benchmark-compression.py
+# @brief   Compare bytes transferred per page with and without compression
+# @author  Michael Hucka <mhucka@caltech.edu>
+# @license Please see the file named LICENSE in the project directory
+# @website https://github.com/caltechlibrary/sidewall
+# =============================================================================
+
+# This fetches the same pages of results from Dimensions twice: once forcing
+# uncompressed responses (Accept-Encoding: identity), and once with the
+# gzip/deflate compression that requests sessions, including Sidewall's, ask
+# for by default.  For each page, it reports the number of bytes actually
+# received over the network and the time taken, to show how much the
+# compression saves.  Note that each page fetched counts against the
+# Dimensions API rate limit.
+
+import os
+import sys
+from   time import perf_counter
+
+# Allow this program to be executed directly from the 'tests' directory.
+try:
+    thisdir = os.path.dirname(os.path.abspath(__file__))
+    sys.path.insert(0, os.path.join(thisdir, '..'))
+except:
+    sys.path.insert(0, '..')
+
+import sidewall
+from sidewall import dimensions
+
+if len(sys.argv) > 1 and sys.argv[1] == '-d':
+    sidewall.set_debug(True)
+
+query = ('search publications where research_orgs.id = "grid.20861.3d"'
+         ' return publications[all]')
+pages = 3
+fetch_size = 1000
+
+dimensions.login()
+session = dimensions._session
+
+
+def fetch(page, encoding):
+    headers = {'Authorization': 'JWT ' + dimensions._dimensions_token,
+               'Accept-Encoding': encoding}
+    data = query + ' limit {} skip {}'.format(fetch_size, page * fetch_size)
+    start = perf_counter()
+    resp = session.post(dimensions._dsl_url, data = data, headers = headers, stream = True)
+    # Reading the raw stream without decoding gives the bytes on the wire.
+    wire_bytes = len(resp.raw.read(decode_content = False))
+    return (wire_bytes, perf_counter() - start)
+
+
+print('{:>4}  {:>14}  {:>8}  {:>14}  {:>8}  {:>6}'.format(
+    'page', 'identity bytes', 'seconds', 'gzip bytes', 'seconds', 'ratio'))
+totals = [0, 0]
+for page in range(pages):
+    (plain, plain_time) = fetch(page, 'identity')
+    (gzip, gzip_time) = fetch(page, session.headers['Accept-Encoding'])
+    totals[0] += plain
+    totals[1] += gzip
+    print('{:>4}  {:>14,}  {:>8.2f}  {:>14,}  {:>8.2f}  {:>6.1f}'.format(
+        page, plain, plain_time, gzip, gzip_time, plain / max(1, gzip)))
+print('Total bytes: {:,} uncompressed, {:,} compressed'.format(*totals))
@@ -23,10 +23,24 @@ except:
 import sidewall
 from sidewall import dimensions
 
-if len(sys.argv) > 1 and sys.argv[1] == '-d':
+# Usage: profile-sidewall.py [-d] [-r cassette | -p cassette]
+# With -r, the network interactions are recorded in the given cassette file.
+# With -p, they are played back from the file instead of using the network,
+# so that runs can be compared without network or rate limit variations.
+
+args = sys.argv[1:]
+if '-d' in args:
     sidewall.set_debug(True)
 
-dimensions.login()
+if '-r' in args:
+    sidewall.use_cassette(args[args.index('-r') + 1], mode = 'record')
+    dimensions.login()
+elif '-p' in args:
+    sidewall.use_cassette(args[args.index('-p') + 1], mode = 'replay')
+    # Credentials are not stored in cassettes, so any values will do.
+    dimensions.login(username = 'user', password = 'password', use_keyring = False)
+else:
+    dimensions.login()
 
 print('Sending query & building objects.')
 
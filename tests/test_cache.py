@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+# =============================================================================
+# @file    test_cache.py
+# @brief   Tests of Sidewall's in-memory and disk caches
+# @author  Michael Hucka <mhucka@caltech.edu>
+# @license Please see the file named LICENSE in the project directory
+# @website https://github.com/caltechlibrary/sidewall
+# =============================================================================
+
+# These tests need neither network access nor a Dimensions account.  Run
+# them using
+#
+#     python3 -m unittest discover tests
+#
+# or using pytest.
+
+import gc
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+
+# Allow this program to be executed directly from the 'tests' directory.
+try:
+    thisdir = os.path.dirname(os.path.abspath(__file__))
+    sys.path.insert(0, os.path.join(thisdir, '..'))
+except:
+    thisdir = '.'
+    sys.path.insert(0, '..')
+
+from sidewall import dimensions, queryresults, Author, Organization
+from sidewall.cache import ObjectCache, DiskCache
+
+
+# Helpers.
+# .............................................................................
+
+def _author(n):
+    return Author({'researcher_id': 'ur.{}'.format(n), 'first_name': 'A',
+                   'last_name': 'Person{}'.format(n)})
+
+
+def _publication(n, authors):
+    return {'id': 'pub.scope.{}'.format(n), 'title': 'Title {}'.format(n),
+            'author_affiliations': [[{'researcher_id': 'ur.{}'.format(a),
+                                      'first_name': 'A', 'last_name': 'B',
+                                      'affiliations': []} for a in authors]]}
+
+
+def _results(record):
+    return queryresults(dimensions, 'search publications return publications',
+                        'search publications return publications', None, 1,
+                        {'publications': [record]}, 'publications', 10)
+
+
+# Tests.
+# .............................................................................
+
+class TestEviction(unittest.TestCase):
+
+    def test_least_recently_used_first(self):
+        cache = ObjectCache(max_items = 3)
+        for n in range(3):
+            cache['key{}'.format(n)] = {'n': n}
+        cache.get('key0')
+        cache['key3'] = {'n': 3}
+        self.assertIsNone(cache.get('key1'))
+        self.assertEqual(cache.get('key0'), {'n': 0})
+        self.assertEqual(cache.stats()['evictions'], 1)
+
+
+    def test_byte_limit(self):
+        cache = ObjectCache()
+        for n in range(10):
+            cache['key{}'.format(n)] = {'text': 'x' * 1000}
+        cache.set_limits(max_items = None, max_bytes = 5000)
+        self.assertLess(len(cache), 10)
+        self.assertLessEqual(cache.stats()['bytes'], 5000)
+        self.assertIsNotNone(cache.get('key9'))
+
+
+    def test_scoped_values_evicted_first(self):
+        cache = ObjectCache(max_items = 2)
+        cache['grid.1'] = Organization({'id': 'grid.1'})
+        cache.put('ur.1', _author(1), scope = 1)
+        cache['key'] = {'n': 1}
+        self.assertIsNone(cache.get('ur.1', scope = 1))
+        self.assertIsNotNone(cache.get('grid.1'))
+
+
+class TestScopes(unittest.TestCase):
+
+    def test_scoped_values(self):
+        cache = ObjectCache()
+        first, second = _author(1), _author(2)
+        cache.put('ur.1', first, scope = 1)
+        cache.put('ur.1', second, scope = 2)
+        self.assertIs(cache.get('ur.1', scope = 1), first)
+        self.assertIs(cache.get('ur.1', scope = 2), second)
+        self.assertIsNone(cache.get('ur.1'))
+        cache.clear_scoped(1)
+        self.assertIsNone(cache.get('ur.1', scope = 1))
+        self.assertIs(cache.get('ur.1', scope = 2), second)
+        self.assertEqual(cache.stats()['scopes'], 1)
+
+
+    def test_persistent_values(self):
+        cache = ObjectCache()
+        org = Organization({'id': 'grid.1'})
+        cache.put('grid.1', org, scope = 1)
+        cache['search researchers'] = {'researchers': []}
+        cache.clear_scoped(1)
+        self.assertIs(cache.get('grid.1', scope = 2), org)
+        self.assertEqual(cache.get('search researchers'), {'researchers': []})
+        self.assertEqual(cache.stats()['scoped_items'], 0)
+
+
+    def test_eviction_updates_scopes(self):
+        cache = ObjectCache(max_items = 2)
+        for n in range(3):
+            cache.put('ur.{}'.format(n), _author(n), scope = 1)
+        self.assertEqual(len(cache), 2)
+        self.assertIsNone(cache.get('ur.0', scope = 1))
+        cache.clear_scoped(1)
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(cache.stats()['scopes'], 0)
+
+
+    def test_queries_have_separate_scopes(self):
+        first = _results(_publication(1, [10, 11]))
+        second = _results(_publication(2, [10]))
+        first_authors = next(first).authors
+        second_authors = next(second).authors
+        self.assertNotEqual(first._scope, second._scope)
+        # Starting the second query doesn't drop the objects of the first.
+        author = first_authors[0]
+        self.assertIs(dimensions._cache.get('ur.10', scope = first._scope), author)
+        self.assertIsNot(second_authors[0], author)
+        # The scope of a query is dropped when its results object is.
+        scope = first._scope
+        del first
+        gc.collect()
+        self.assertIsNone(dimensions._cache.get('ur.10', scope = scope))
+        self.assertIs(dimensions._cache.get('ur.10', scope = second._scope),
+                      second_authors[0])
+
+
+class TestDiskCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'cache.db')
+
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir, ignore_errors = True)
+
+
+    def test_values_persist(self):
+        cache = DiskCache(self.path)
+        cache.put('search publications', {'publications': [{'id': 'pub.1'}]},
+                  'publications')
+        cache.close()
+        cache = DiskCache(self.path)
+        self.assertEqual(cache.get('search publications', 'publications'),
+                         {'publications': [{'id': 'pub.1'}]})
+        self.assertEqual(len(cache), 1)
+        cache.close()
+
+
+    def test_ttl_by_kind(self):
+        cache = DiskCache(self.path, ttl = {'publications': 0.1, 'grants': None})
+        cache.put('pubs', {'publications': []}, 'publications')
+        cache.put('grants', {'grants': []}, 'grants')
+        time.sleep(0.2)
+        self.assertIsNone(cache.get('pubs', 'publications'))
+        self.assertEqual(cache.get('grants', 'grants'), {'grants': []})
+        self.assertEqual(len(cache), 1)
+        cache.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+# =============================================================================
+# @file    test_export.py
+# @brief   Tests of the columnar export of results in sidewall/export.py
+# @author  Michael Hucka <mhucka@caltech.edu>
+# @license Please see the file named LICENSE in the project directory
+# @website https://github.com/caltechlibrary/sidewall
+# =============================================================================
+
+# These tests use the publication records in test-data and need neither
+# network access nor a Dimensions account.  Run them using
+#
+#     python3 -m unittest discover tests
+#
+# or using pytest.
+
+import csv
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+# Allow this program to be executed directly from the 'tests' directory.
+try:
+    thisdir = os.path.dirname(os.path.abspath(__file__))
+    sys.path.insert(0, os.path.join(thisdir, '..'))
+except:
+    thisdir = '.'
+    sys.path.insert(0, '..')
+
+from sidewall import dimensions, queryresults, Publication
+from sidewall.export import export_columns
+
+try:
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+
+# Helpers.
+# .............................................................................
+
+with open(os.path.join(thisdir, 'test-data', 'example-publications.json')) as f:
+    RECORDS = json.load(f)['publications']
+
+QUERY = 'search publications return publications'
+
+def _results(raw = False):
+    # All the records are in the first page, so no network access is needed.
+    return queryresults(dimensions, QUERY, QUERY, None, len(RECORDS),
+                        {'publications': list(RECORDS)}, 'publications',
+                        len(RECORDS), raw = raw)
+
+
+# Tests.
+# .............................................................................
+
+class TestExport(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir, ignore_errors = True)
+
+
+    def test_columns(self):
+        columns = export_columns(Publication)
+        self.assertIn('id', columns)
+        self.assertIn('journal', columns)
+        self.assertIn('references', columns)
+        # Fields holding lists of objects are not exported.
+        self.assertNotIn('author_affiliations', columns)
+        self.assertNotIn('FOR', columns)
+
+
+    def test_values(self):
+        batch = next(_results(raw = True).iter_batches())
+        record = RECORDS[0]
+        first = {column: values[0] for column, values in batch.items()}
+        self.assertEqual(first['id'], record['id'])
+        self.assertEqual(first['title'], record['title'])
+        # Objects are represented by their ids and lists of values are joined.
+        self.assertEqual(first['journal'], record['journal']['id'])
+        self.assertEqual(first['references'], '; '.join(record['references']))
+
+
+    def test_batches(self):
+        batches = list(_results(raw = True).iter_batches(n = 8))
+        self.assertEqual([len(batch['id']) for batch in batches], [8, 8, 4])
+        self.assertEqual(sum((batch['id'] for batch in batches), []),
+                         [record['id'] for record in RECORDS])
+
+
+    def test_objects_and_records_agree(self):
+        from_records = list(_results(raw = True).iter_batches())
+        from_objects = list(_results().iter_batches())
+        self.assertEqual(from_objects, from_records)
+
+
+    def test_csv(self):
+        path = os.path.join(self.tmpdir, 'results.csv')
+        self.assertEqual(_results(raw = True).to_csv(path, n = 7), len(RECORDS))
+        with open(path, newline = '') as f:
+            rows = list(csv.reader(f))
+        self.assertEqual(rows[0], export_columns(Publication))
+        self.assertEqual(len(rows), len(RECORDS) + 1)
+        self.assertEqual([row[rows[0].index('id')] for row in rows[1:]],
+                         [record['id'] for record in RECORDS])
+
+
+    @unittest.skipIf(pyarrow is None, 'pyarrow is not installed')
+    def test_parquet(self):
+        path = os.path.join(self.tmpdir, 'results.parquet')
+        self.assertEqual(_results(raw = True).to_parquet(path, n = 7), len(RECORDS))
+        table = pyarrow.parquet.read_table(path)
+        self.assertEqual(table.num_rows, len(RECORDS))
+        self.assertEqual(table.column_names, export_columns(Publication))
+        self.assertEqual(table.column('id').to_pylist(),
+                         [record['id'] for record in RECORDS])
+
+
+if __name__ == '__main__':
+    unittest.main()
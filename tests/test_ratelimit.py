@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+# =============================================================================
+# @file    test_ratelimit.py
+# @brief   Tests of the rate limits in sidewall/ratelimit.py
+# @author  Michael Hucka <mhucka@caltech.edu>
+# @license Please see the file named LICENSE in the project directory
+# @website https://github.com/caltechlibrary/sidewall
+# =============================================================================
+
+# These tests need neither network access nor a Dimensions account.  Run
+# them using
+#
+#     python3 -m unittest discover tests
+#
+# or using pytest.
+
+import os
+import shutil
+import sys
+import tempfile
+import threading
+from   time import perf_counter
+import unittest
+
+# Allow this program to be executed directly from the 'tests' directory.
+try:
+    thisdir = os.path.dirname(os.path.abspath(__file__))
+    sys.path.insert(0, os.path.join(thisdir, '..'))
+except:
+    thisdir = '.'
+    sys.path.insert(0, '..')
+
+from sidewall.ratelimit import RateLimit, SharedRateLimit, fcntl
+
+
+# Helpers.
+# .............................................................................
+
+_SLACK = 0.05
+'''Seconds allowed for the scheduling of threads when measuring times.'''
+
+def _most_in_window(times, window):
+    '''Return the largest number of the sorted 'times' in any period of
+    'window' seconds, less the allowance for scheduling delays.'''
+    most = 0
+    for (i, start) in enumerate(times):
+        most = max(most, len([t for t in times[i:] if t < start + window - _SLACK]))
+    return most
+
+
+# Tests.
+# .............................................................................
+
+class TestRateLimit(unittest.TestCase):
+
+    def test_calls_per_window(self):
+        limit = RateLimit(10, 1)
+        times = []
+        for _ in range(15):
+            limit.acquire()
+            times.append(perf_counter())
+        self.assertLessEqual(_most_in_window(times, 1), 10)
+        # The calls are spaced evenly rather than bunched up.
+        self.assertGreater(times[-1] - times[0], 1.2)
+
+
+    def test_idle_bucket(self):
+        # Being idle doesn't let a burst of calls accumulate.
+        limit = RateLimit(20, 1)
+        limit.acquire()
+        threading.Event().wait(0.5)
+        times = []
+        for _ in range(5):
+            limit.acquire()
+            times.append(perf_counter())
+        self.assertGreater(times[-1] - times[0], 0.15)
+
+
+    def test_timeout(self):
+        limit = RateLimit(1, 10)
+        self.assertTrue(limit.acquire())
+        self.assertFalse(limit.try_acquire())
+        started = perf_counter()
+        self.assertFalse(limit.acquire(timeout = 0.2))
+        self.assertGreater(perf_counter() - started, 0.15)
+
+
+    def test_threads(self):
+        limit = RateLimit(20, 1)
+        times = []
+        lock = threading.Lock()
+
+        def worker():
+            for _ in range(5):
+                limit.acquire()
+                with lock:
+                    times.append(perf_counter())
+
+        threads = [threading.Thread(target = worker) for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(times), 25)
+        self.assertLessEqual(_most_in_window(sorted(times), 1), 20)
+
+
+class TestAdaptiveRateLimit(unittest.TestCase):
+
+    def test_no_increase_without_waiting(self):
+        # Calls slower than the rate limit don't raise it.
+        limit = RateLimit(5, 0.5, adaptive = True)
+        for _ in range(20):
+            threading.Event().wait(0.15)
+            limit.acquire()
+            limit.record_success()
+        self.assertEqual(limit.max_calls, 5)
+
+
+    def test_increase_when_waiting(self):
+        limit = RateLimit(5, 0.1, adaptive = True, max_rate = 7)
+        for _ in range(60):
+            limit.acquire()
+            limit.record_success()
+        self.assertEqual(limit.max_calls, 7)
+
+
+    def test_decrease(self):
+        limit = RateLimit(8, 0.1, adaptive = True)
+        limit.record_throttled()
+        self.assertEqual(limit.max_calls, 4)
+        # Only one decrease per time window.
+        limit.record_throttled()
+        self.assertEqual(limit.max_calls, 4)
+
+
+    def test_saved_rate_is_capped(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmpdir, 'rate.json')
+            with open(path, 'w') as f:
+                f.write('{"max_calls": 50, "time_limit": 60}')
+            limit = RateLimit(22, 60, adaptive = True, rate_file = path, max_rate = 30)
+            self.assertEqual(limit.max_calls, 30)
+        finally:
+            shutil.rmtree(tmpdir, ignore_errors = True)
+
+
+@unittest.skipIf(fcntl is None, 'file locking is not available')
+class TestSharedRateLimit(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'rate')
+
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir, ignore_errors = True)
+
+
+    def test_shared_bucket(self):
+        # Two objects using the same file stand in for two processes.
+        first = SharedRateLimit(10, 1, self.path)
+        second = SharedRateLimit(10, 1, self.path)
+        self.assertTrue(first.acquire())
+        self.assertFalse(second.try_acquire())
+        times = []
+        for n in range(10):
+            (first if n % 2 else second).acquire()
+            times.append(perf_counter())
+        self.assertLessEqual(_most_in_window(times, 1), 10)
+
+
+if __name__ == '__main__':
+    unittest.main()
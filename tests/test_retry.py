@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+# =============================================================================
+# @file    test_retry.py
+# @brief   Tests of the retrying of network calls
+# @author  Michael Hucka <mhucka@caltech.edu>
+# @license Please see the file named LICENSE in the project directory
+# @website https://github.com/caltechlibrary/sidewall
+# =============================================================================
+
+# These tests need neither network access nor a Dimensions account.  Run
+# them using
+#
+#     python3 -m unittest discover tests
+#
+# or using pytest.
+
+from   datetime import timedelta
+import os
+import sys
+from   time import perf_counter
+import unittest
+
+import requests
+import urllib3
+
+# Allow this program to be executed directly from the 'tests' directory.
+try:
+    thisdir = os.path.dirname(os.path.abspath(__file__))
+    sys.path.insert(0, os.path.join(thisdir, '..'))
+except:
+    thisdir = '.'
+    sys.path.insert(0, '..')
+
+from sidewall import RetryPolicy, set_retry_policy
+from sidewall.exceptions import NetworkFailure, ServiceFailure, RequestError
+from sidewall.network import net, set_transport, current_transport
+from sidewall.retry import retry_policy, retry_after
+
+
+# Helpers.
+# .............................................................................
+
+def _response(code, headers = {}):
+    response = requests.Response()
+    response.status_code = code
+    response.headers.update(headers)
+    response._content = b'{}'
+    response.elapsed = timedelta(0)
+    return response
+
+
+class _ScriptedTransport(object):
+    '''Transport that produces the given outcomes in turn, repeating the last
+    one, and counts the calls made.'''
+
+    offline = True
+
+    def __init__(self, *outcomes):
+        self.outcomes = list(outcomes)
+        self.calls = 0
+
+
+    def request(self, get_or_post, url, session, deadline = None, **kwargs):
+        outcome = self.outcomes[min(self.calls, len(self.outcomes) - 1)]
+        self.calls += 1
+        if isinstance(outcome, Exception):
+            raise outcome
+        return _response(outcome)
+
+
+def _connection_reset():
+    reason = urllib3.exceptions.ProtocolError('Connection aborted.',
+                                              ConnectionResetError(104))
+    return requests.exceptions.ConnectionError(reason)
+
+
+# Tests.
+# .............................................................................
+
+class TestRetries(unittest.TestCase):
+
+    def setUp(self):
+        self.saved_policy = retry_policy()
+        self.saved_transport = current_transport()
+        set_retry_policy(RetryPolicy(max_retries = 3, base_delay = 0.001,
+                                     max_delay = 0.01))
+
+
+    def tearDown(self):
+        set_retry_policy(self.saved_policy)
+        set_transport(self.saved_transport)
+
+
+    def call(self, transport):
+        set_transport(transport)
+        return net('post', 'https://standin.invalid/api/dsl.json')
+
+
+    def test_attempts_on_connection_reset(self):
+        transport = _ScriptedTransport(_connection_reset())
+        (response, error) = self.call(transport)
+        self.assertIsInstance(error, NetworkFailure)
+        self.assertEqual(transport.calls, 4)
+
+
+    def test_attempts_on_timeout(self):
+        transport = _ScriptedTransport(requests.exceptions.ReadTimeout())
+        (response, error) = self.call(transport)
+        self.assertIsInstance(error, ServiceFailure)
+        self.assertEqual(transport.calls, 4)
+
+
+    def test_attempts_on_server_error(self):
+        transport = _ScriptedTransport(503)
+        (response, error) = self.call(transport)
+        self.assertIsInstance(error, ServiceFailure)
+        self.assertEqual(transport.calls, 4)
+
+
+    def test_recovery(self):
+        transport = _ScriptedTransport(_connection_reset(), 502, 202, 200)
+        (response, error) = self.call(transport)
+        self.assertIsNone(error)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(transport.calls, 4)
+
+
+    def test_no_retry(self):
+        transport = _ScriptedTransport(400)
+        (response, error) = self.call(transport)
+        self.assertIsInstance(error, RequestError)
+        self.assertEqual(transport.calls, 1)
+
+
+    def test_policy_deadline(self):
+        set_retry_policy(RetryPolicy(max_retries = 100, base_delay = 0.05,
+                                     max_delay = 0.05, deadline = 0.3))
+        transport = _ScriptedTransport(_connection_reset())
+        started = perf_counter()
+        self.call(transport)
+        self.assertLess(perf_counter() - started, 0.5)
+        self.assertLess(transport.calls, 100)
+
+
+class TestRetryAfter(unittest.TestCase):
+
+    def test_seconds(self):
+        self.assertEqual(retry_after(_response(429, {'Retry-After': '7'})), 7)
+
+
+    def test_date(self):
+        value = retry_after(_response(429, {'Retry-After': 'Wed, 21 Oct 2015 07:28:00 GMT'}))
+        self.assertEqual(value, 0)
+
+
+    def test_missing(self):
+        self.assertIsNone(retry_after(_response(429)))
+        self.assertIsNone(retry_after(None))
+
+
+    def test_delay_honors_retry_after(self):
+        policy = RetryPolicy(base_delay = 0.001, max_delay = 0.01)
+        self.assertGreaterEqual(policy.delay(1, retry_after = 2), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,463 @@
+#!/usr/bin/env python3
+# =============================================================================
+# @file    test_standin.py
+# @brief   Tests of Sidewall queries against the local stand-in server
+# @author  Michael Hucka <mhucka@caltech.edu>
+# @license Please see the file named LICENSE in the project directory
+# @website https://github.com/caltechlibrary/sidewall
+# =============================================================================
+
+# These tests run Sidewall against the stand-in for the Dimensions API in
+# sidewall/standin.py, so they need neither network access nor a Dimensions
+# account.  The results are synthetic publication records made from the
+# first record in test-data/example-publications.json.  Run them using
+#
+#     python3 -m unittest discover tests
+#
+# or using pytest.
+
+import asyncio
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+
+import requests
+
+# Allow this program to be executed directly from the 'tests' directory.
+try:
+    thisdir = os.path.dirname(os.path.abspath(__file__))
+    sys.path.insert(0, os.path.join(thisdir, '..'))
+except:
+    thisdir = '.'
+    sys.path.insert(0, '..')
+
+import sidewall.network
+from sidewall import dimensions, RetryPolicy, set_retry_policy, Cursor
+from sidewall import use_cassette, AsyncDimensions
+from sidewall.network import LiveTransport, set_transport
+from sidewall.ratelimit import RateLimit
+from sidewall.retry import retry_policy
+from sidewall.standin import StandinServer
+
+
+# Test configuration.
+# .............................................................................
+
+NUM_RECORDS = 250
+'''Number of publication records served by the stand-in.'''
+
+FETCH_SIZE = 30
+'''Page size used in the tests.'''
+
+QUERY = 'search publications return publications'
+'''Query used in the tests.'''
+
+
+# Setup and teardown.
+# .............................................................................
+
+_saved = {}
+
+def setUpModule():
+    # The stand-in doesn't enforce a rate limit, and waiting on the
+    # Dimensions rate limit would make the tests take many minutes.
+    _saved['rate_limit'] = sidewall.network._DIMENSIONS_RATE_LIMIT
+    _saved['policy'] = retry_policy()
+    sidewall.network._DIMENSIONS_RATE_LIMIT = RateLimit(100000, 1)
+    set_retry_policy(RetryPolicy(base_delay = 0.01, max_delay = 0.05))
+    _saved['tmpdir'] = tempfile.mkdtemp()
+    with open(os.path.join(thisdir, 'test-data', 'example-publications.json')) as f:
+        base = json.load(f)['publications'][0]
+    records = []
+    for n in range(NUM_RECORDS):
+        record = dict(base, id = 'pub.{}'.format(n), year = 1990 + n % 30)
+        records.append(record)
+    _saved['fixture'] = os.path.join(_saved['tmpdir'], 'publications.json')
+    with open(_saved['fixture'], 'w') as f:
+        json.dump({'_stats': {'total_count': NUM_RECORDS}, 'publications': records}, f)
+
+
+def tearDownModule():
+    sidewall.network._DIMENSIONS_RATE_LIMIT = _saved['rate_limit']
+    set_retry_policy(_saved['policy'])
+    dimensions.set_base_url()
+    shutil.rmtree(_saved['tmpdir'], ignore_errors = True)
+
+
+class _RecordingServer(StandinServer):
+    '''Stand-in server that keeps a list of the queries it is sent and
+    counts the logins.'''
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.queries = []
+        self.logins = 0
+
+
+    def _search(self, query):
+        self.queries.append(query)
+        return super()._search(query)
+
+
+    def _login(self, body):
+        self.logins += 1
+        return super()._login(body)
+
+
+class _BrokenBody(object):
+    '''Stand-in for the raw body of a response, which fails with a network
+    error after 'limit' bytes.'''
+
+    def __init__(self, raw, limit):
+        self._raw = raw
+        self._left = limit
+
+
+    def read(self, size = -1, **kwargs):
+        if self._left <= 0:
+            raise requests.exceptions.ChunkedEncodingError('Connection broken')
+        data = self._raw.read(min(size, self._left), decode_content = True)
+        self._left -= len(data)
+        return data
+
+
+    def close(self):
+        self._raw.close()
+
+
+class _BreakingTransport(LiveTransport):
+    '''Transport whose first 'breaks' streamed responses fail while their
+    bodies are being read.'''
+
+    def __init__(self, breaks, limit):
+        self.breaks = breaks
+        self.limit = limit
+
+
+    def request(self, get_or_post, url, session, deadline = None, **kwargs):
+        response = super().request(get_or_post, url, session, deadline, **kwargs)
+        if kwargs.get('stream') and self.breaks > 0:
+            self.breaks -= 1
+            response.raw = _BrokenBody(response.raw, self.limit)
+        return response
+
+
+class StandinTestCase(unittest.TestCase):
+    '''Base class of tests that use a stand-in server for each test.'''
+
+    server_options = {}
+
+    def setUp(self):
+        self.server = _RecordingServer([_saved['fixture']], **self.server_options)
+        self.server.start()
+        dimensions.set_base_url(self.server.url)
+        dimensions.login(username = 'user', password = 'password', use_keyring = False)
+        self.all_ids = ['pub.{}'.format(n) for n in range(NUM_RECORDS)]
+
+
+    def tearDown(self):
+        self.server.stop()
+
+
+# Tests.
+# .............................................................................
+
+class TestQueryModes(StandinTestCase):
+
+    def check_mode(self, pages, **kwargs):
+        self.server.queries.clear()
+        results = dimensions.query(QUERY, fetch_size = kwargs.pop('fetch_size', FETCH_SIZE),
+                                   **kwargs)
+        self.assertEqual(len(results), NUM_RECORDS)
+        if kwargs.get('raw'):
+            ids = [record['id'] for record in results]
+        else:
+            ids = [pub.id for pub in results]
+        self.assertEqual(ids, self.all_ids)
+        if pages is not None:
+            self.assertEqual(len(self.server.queries), pages)
+
+
+    def test_default(self):
+        self.check_mode(pages = 9)
+
+
+    def test_stream(self):
+        self.check_mode(pages = 9, stream = True)
+
+
+    def test_read_ahead(self):
+        self.check_mode(pages = 9, read_ahead = 2)
+
+
+    def test_auto_fetch_size(self):
+        # Page sizes depend on timing, so only the results are checked.
+        self.check_mode(pages = None, fetch_size = 'auto')
+
+
+    def test_raw(self):
+        self.check_mode(pages = 9, raw = True)
+
+
+    def test_raw_stream(self):
+        self.check_mode(pages = 9, raw = True, stream = True)
+
+
+    def test_limit_results(self):
+        ids = [pub.id for pub in dimensions.query(QUERY, limit_results = 70,
+                                                  fetch_size = FETCH_SIZE)]
+        self.assertEqual(ids, self.all_ids[:70])
+
+
+class TestStreamRecovery(StandinTestCase):
+
+    def tearDown(self):
+        set_transport(None)
+        super().tearDown()
+
+
+    def test_broken_pages(self):
+        # The first three responses break about halfway through a page.
+        set_transport(_BreakingTransport(3, 20000))
+        results = dimensions.query(QUERY, fetch_size = FETCH_SIZE, stream = True)
+        ids = [pub.id for pub in results]
+        self.assertEqual(ids, self.all_ids)
+        self.assertEqual(len(self.server.queries), 12)
+
+
+    def test_retries_exhausted(self):
+        set_transport(_BreakingTransport(100, 20000))
+        with self.assertRaises(sidewall.NetworkFailure):
+            list(dimensions.query(QUERY, fetch_size = FETCH_SIZE, stream = True))
+
+
+class TestCassette(StandinTestCase):
+
+    def tearDown(self):
+        use_cassette(None)
+        super().tearDown()
+
+
+    def test_record_and_replay(self):
+        path = os.path.join(_saved['tmpdir'], 'cassette.jsonl')
+        use_cassette(path, mode = 'record')
+        dimensions.login(username = 'user', password = 'secret', use_keyring = False)
+        recorded = [pub.id for pub in dimensions.query(QUERY, fetch_size = FETCH_SIZE)]
+        use_cassette(None)
+        with open(path) as f:
+            lines = f.readlines()
+        # A line for the version, one for the login and one per page.
+        self.assertEqual(len(lines), 11)
+        self.assertNotIn('secret', ''.join(lines))
+
+        self.server.stop()
+        use_cassette(path, mode = 'replay')
+        dimensions.login(username = 'someone', password = 'else', use_keyring = False)
+        replayed = [pub.id for pub in dimensions.query(QUERY, fetch_size = FETCH_SIZE)]
+        self.assertEqual(replayed, recorded)
+        self.assertEqual(replayed, self.all_ids)
+
+
+    def test_missing_interaction(self):
+        path = os.path.join(_saved['tmpdir'], 'empty.jsonl')
+        use_cassette(path, mode = 'record')
+        use_cassette(path, mode = 'replay')
+        with self.assertRaises(sidewall.NetworkFailure):
+            dimensions.query(QUERY, fetch_size = FETCH_SIZE)
+
+
+class TestCursors(StandinTestCase):
+
+    def test_resume_from_cursor(self):
+        results = dimensions.query(QUERY, fetch_size = FETCH_SIZE)
+        got = [next(results).id for _ in range(100)]
+        cursor = results.cursor()
+        self.assertEqual(cursor.position, 100)
+        self.server.queries.clear()
+        rest = [pub.id for pub in dimensions.resume(cursor)]
+        self.assertEqual(got + rest, self.all_ids)
+        # Resuming fetches the page containing result 100 and the ones after.
+        self.assertEqual(len(self.server.queries), 6)
+
+
+    def test_resume_from_checkpoint(self):
+        path = os.path.join(_saved['tmpdir'], 'cursor.json')
+        results = dimensions.query(QUERY, fetch_size = FETCH_SIZE).checkpoint(path)
+        got = []
+        for pub in results:
+            got.append(pub.id)
+            if len(got) == 75:
+                break
+        cursor = Cursor.load(path)
+        self.assertLessEqual(cursor.position, 75)
+        rest = [pub.id for pub in dimensions.resume(path).checkpoint(path)]
+        self.assertEqual(got[:cursor.position] + rest, self.all_ids)
+        self.assertTrue(Cursor.load(path).finished)
+
+
+class TestAsyncCursors(StandinTestCase):
+
+    def test_resume_from_cursor(self):
+        async def first_part():
+            results = await AsyncDimensions().query(QUERY, fetch_size = FETCH_SIZE,
+                                                    read_ahead = 2)
+            got = [(await results.__anext__()).id for _ in range(100)]
+            return (got, results.cursor())
+
+        (got, cursor) = asyncio.run(first_part())
+        self.assertEqual(cursor.position, 100)
+        # The cursor is in the page of results 90 to 119.
+        self.assertEqual((cursor.skip, cursor.offset), (90, 10))
+        rest = [pub.id for pub in dimensions.resume(cursor)]
+        self.assertEqual(got + rest, self.all_ids)
+
+
+    def test_checkpoint(self):
+        path = os.path.join(_saved['tmpdir'], 'async-cursor.json')
+
+        async def iterate(limit):
+            results = await AsyncDimensions().query(QUERY, fetch_size = FETCH_SIZE)
+            got = []
+            async for pub in results.checkpoint(path):
+                got.append(pub.id)
+                if len(got) == limit:
+                    break
+            return got
+
+        got = asyncio.run(iterate(75))
+        cursor = Cursor.load(path)
+        self.assertEqual(cursor.position, 60)
+        rest = [pub.id for pub in dimensions.resume(path)]
+        self.assertEqual(got[:cursor.position] + rest, self.all_ids)
+        self.assertEqual(asyncio.run(iterate(None)), self.all_ids)
+        self.assertTrue(Cursor.load(path).finished)
+
+
+class TestPartitionedQueries(StandinTestCase):
+
+    def test_partitioned_totals(self):
+        results = dimensions.partitioned_query(QUERY, 'year', 1990, 2019,
+                                               fetch_size = FETCH_SIZE,
+                                               max_results = 60)
+        with results:
+            self.assertGreater(len(results.partitions), 1)
+            self.assertEqual(results.total_count, NUM_RECORDS)
+            ids = [pub.id for pub in results]
+        self.assertEqual(sorted(ids), sorted(self.all_ids))
+
+
+    def test_partitioned_limit(self):
+        results = dimensions.partitioned_query(QUERY, 'year', 1990, 2019,
+                                               limit_results = 100,
+                                               fetch_size = FETCH_SIZE,
+                                               max_results = 60, raw = True)
+        with results:
+            ids = [record['id'] for record in results]
+        self.assertEqual(len(ids), 100)
+        self.assertEqual(len(set(ids)), 100)
+
+
+class TestRecovery(StandinTestCase):
+
+    server_options = {'not_ready': 0.2, 'throttle': 0.2, 'errors': 0.1,
+                      'retry_after': 0, 'seed': 1}
+
+    def test_retries(self):
+        ids = [pub.id for pub in dimensions.query(QUERY, fetch_size = FETCH_SIZE)]
+        self.assertEqual(ids, self.all_ids)
+        self.assertGreater(self.server.counts[202], 0)
+        self.assertGreater(self.server.counts[429], 0)
+
+
+class TestBatchedFills(StandinTestCase):
+    '''Tests of the filling of authors using the publication records in
+    test-data, without their current organizations, and made-up researcher
+    and organization records.'''
+
+    @classmethod
+    def setUpClass(cls):
+        with open(os.path.join(thisdir, 'test-data', 'example-publications.json')) as f:
+            publications = json.load(f)
+        ids = set()
+        for pub in publications['publications']:
+            for author in pub.get('author_affiliations', [[]])[0]:
+                author.pop('current_organization_id', None)
+                if author.get('researcher_id'):
+                    ids.add(author['researcher_id'])
+        researchers = [{'id': rid, 'first_name': 'First', 'last_name': 'Last',
+                        'current_research_org': 'grid.{}'.format(n)}
+                       for (n, rid) in enumerate(sorted(ids))]
+        orgs = [{'id': 'grid.{}'.format(n), 'name': 'Org {}'.format(n)}
+                for n in range(len(ids))]
+        cls.fixtures = [os.path.join(_saved['tmpdir'], 'authors.json'),
+                        os.path.join(_saved['tmpdir'], 'people.json')]
+        with open(cls.fixtures[0], 'w') as f:
+            json.dump(publications, f)
+        with open(cls.fixtures[1], 'w') as f:
+            json.dump({'researchers': researchers, 'research_orgs': orgs}, f)
+        cls.num_researchers = len(researchers)
+
+
+    def setUp(self):
+        # Records of filled objects are kept, so start each test without them.
+        dimensions._cache.clear()
+        self.server = _RecordingServer(self.fixtures)
+        self.server.start()
+        dimensions.set_base_url(self.server.url)
+        dimensions.login(username = 'user', password = 'password', use_keyring = False)
+
+
+    def searches(self, source):
+        return [q for q in self.server.queries if q.startswith('search ' + source)]
+
+
+    def test_researchers(self):
+        authors = [author for pub in dimensions.query(QUERY)
+                   for author in pub.authors if author.id]
+        orgs = [author.current_organization for author in authors]
+        self.assertEqual(len(set(author.id for author in authors)),
+                         self.num_researchers)
+        self.assertTrue(all(org and org.id.startswith('grid.') for org in orgs))
+        # All the authors are filled using one search.
+        self.assertEqual(len(self.searches('researchers')), 1)
+
+
+    def test_organizations(self):
+        authors = [author for pub in dimensions.query(QUERY)
+                   for author in pub.authors if author.id]
+        orgs = [author.current_organization for author in authors]
+        names = [org.name for org in orgs]
+        self.assertEqual(names, ['Org {}'.format(org.id[5:]) for org in orgs])
+        # The organizations are filled using one search.
+        self.assertEqual(len(self.searches('research_orgs')), 1)
+
+
+class TestTokenRenewal(StandinTestCase):
+
+    def test_renewal_after_401(self):
+        self.server.expire_tokens()
+        logins = self.server.logins
+        ids = [pub.id for pub in dimensions.query(QUERY, fetch_size = FETCH_SIZE)]
+        self.assertEqual(ids, self.all_ids)
+        self.assertEqual(self.server.counts[401], 1)
+        self.assertEqual(self.server.logins, logins + 1)
+
+
+    def test_renewal_before_expiry(self):
+        # Tokens are renewed when they have less than a minute left.
+        self.server.token_lifetime = 61
+        dimensions.login(username = 'user', password = 'password', use_keyring = False)
+        logins = self.server.logins
+        time.sleep(1.5)
+        ids = [pub.id for pub in dimensions.query(QUERY, limit_results = 10)]
+        self.assertEqual(ids, self.all_ids[:10])
+        self.assertEqual(self.server.counts[401], 0)
+        self.assertGreater(self.server.logins, logins)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+# =============================================================================
+# @file    test_streaming.py
+# @brief   Tests of the incremental JSON decoding in sidewall/streaming.py
+# @author  Michael Hucka <mhucka@caltech.edu>
+# @license Please see the file named LICENSE in the project directory
+# @website https://github.com/caltechlibrary/sidewall
+# =============================================================================
+
+# These tests need neither network access nor a Dimensions account.  Run
+# them using
+#
+#     python3 -m unittest discover tests
+#
+# or using pytest.
+
+import json
+import os
+import sys
+import unittest
+
+# Allow this program to be executed directly from the 'tests' directory.
+try:
+    thisdir = os.path.dirname(os.path.abspath(__file__))
+    sys.path.insert(0, os.path.join(thisdir, '..'))
+except:
+    thisdir = '.'
+    sys.path.insert(0, '..')
+
+from sidewall.exceptions import DataMismatch
+from sidewall.streaming import stream_items
+
+
+# Helpers.
+# .............................................................................
+
+def _chunks(data, size):
+    return [data[start : start + size] for start in range(0, len(data), size)]
+
+
+def _decoded(data, size, key = 'publications'):
+    return list(stream_items(_chunks(data, size), key))
+
+
+def _expected(obj, key = 'publications'):
+    items = []
+    for (name, value) in obj.items():
+        if name == key and isinstance(value, list):
+            items += [(name, item) for item in value]
+        else:
+            items.append((name, value))
+    return items
+
+
+# Tests.
+# .............................................................................
+
+class TestStreamItems(unittest.TestCase):
+
+    def test_chunk_boundaries(self):
+        # Every chunk size splits the text at different places, including
+        # inside strings, numbers, escapes and multibyte UTF-8 characters.
+        obj = {'_stats': {'total_count': 3},
+               'publications': [{'id': 'pub.1', 'title': 'Café ☃ "q"\n',
+                                 'times_cited': 12345, 'altmetric': 1.25e-3},
+                                {'id': 'pub.2', 'authors': [], 'open': True,
+                                 'doi': None},
+                                {'id': 'pub.3', 'pages': '1–9', 'year': -7}]}
+        for text in [json.dumps(obj), json.dumps(obj, indent = 2),
+                     json.dumps(obj, ensure_ascii = False)]:
+            data = text.encode('utf-8')
+            for size in range(1, 40):
+                self.assertEqual(_decoded(data, size), _expected(obj),
+                                 'chunk size {}'.format(size))
+
+
+    def test_trailing_number(self):
+        # A number at the end of a chunk may continue in the next one.
+        data = b'{"publications": [], "_stats": {"total_count": 1234}}'
+        for size in range(1, len(data)):
+            self.assertEqual(_decoded(data, size),
+                             [('_stats', {'total_count': 1234})])
+
+
+    def test_other_members(self):
+        obj = {'publications': {'not': 'a list'}, 'other': [1, 2]}
+        data = json.dumps(obj).encode('utf-8')
+        self.assertEqual(_decoded(data, 3), list(obj.items()))
+
+
+    def test_empty(self):
+        self.assertEqual(_decoded(b'{}', 1), [])
+        self.assertEqual(_decoded(b'{"publications": []}', 1), [])
+
+
+    def test_truncated(self):
+        data = b'{"publications": [{"id": "pub.1"}, {"id": "pu'
+        with self.assertRaises(DataMismatch):
+            _decoded(data, 5)
+
+
+    def test_malformed(self):
+        with self.assertRaises(DataMismatch):
+            _decoded(b'{"publications": [{"id": "pub.1"} {"id": "pub.2"}]}', 4)
+
+
+if __name__ == '__main__':
+    unittest.main()